@@ -1,6 +1,6 @@
 import sys
 
-from git_rv import get_parser
+import utils
 
 
 def main(argv):
@@ -18,6 +18,14 @@ def main(argv):
         print 'ERROR: git-rv invoked through non-standard path'
         return 1
 
+    if remaining == [utils.STATUS_COMMAND]:
+        # Status is meant to be run from a shell prompt, so it skips loading
+        # upload.py and building the full argument parser.
+        from status import StatusAction
+        StatusAction.callback(None, remaining)
+        return 0
+
+    from git_rv import get_parser
     parser = get_parser()
     args = parser.parse_args(remaining)
     args.callback(args, remaining)
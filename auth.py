@@ -0,0 +1,278 @@
+# Copyright 2013 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Credential caching for git-rv command line tool.
+
+upload.py asks for a new OAuth 2.0 access token (via a browser consent flow)
+every time an RPC server authenticates, and the Rietveld API needs an XSRF
+token for every modifying request. Both are cached here, per review server,
+in a file readable only by the current user, so that export, sync and submit
+can share them until they expire.
+"""
+
+
+import contextlib
+import fcntl
+import os
+import time
+
+import upload
+
+import utils
+
+
+ACCESS_TOKENS = 'access_tokens'
+AVOIDED_ROUND_TRIPS = 'avoided_round_trips'
+CREDENTIALS_PATH = os.path.expanduser('~/.git_rv_credentials')
+CREDENTIALS_LOCK_PATH = CREDENTIALS_PATH + '.lock'
+EXPIRES = 'expires'
+TOKEN = 'token'
+XSRF_TOKENS = 'xsrf_tokens'
+# Google OAuth 2.0 access tokens are valid for an hour and Rietveld XSRF tokens
+# for several hours; cached tokens are dropped well before that.
+ACCESS_TOKEN_LIFETIME = 50 * 60
+XSRF_TOKEN_LIFETIME = 60 * 60
+# HTTP status codes which indicate a cached token was rejected.
+UNAUTHORIZED_STATUSES = (401, 403)
+SIGN_IN_REQUIRED_TEMPLATE = ('No cached credentials for %s and signing in '
+                             'is not allowed.')
+
+
+class SignInRequiredError(utils.GitRvException):
+    """Error raised when signing in would prompt the user but can't."""
+
+
+@contextlib.contextmanager
+def _locked():
+    """Holds an exclusive lock on the credential cache.
+
+    Each read-modify-write of the cache is done while holding the lock, so
+    concurrent commands, or threads within a command, don't lose each other's
+    updates. The lock is an flock on a separate file, which also excludes
+    other threads since each call opens the file anew.
+    """
+    fd = os.open(CREDENTIALS_LOCK_PATH, os.O_WRONLY | os.O_CREAT, 0600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
+def _load():
+    """Loads the credential cache.
+
+    Should only be called while holding the lock from _locked.
+
+    Returns:
+        Dictionary containing the cached credentials. If the cache does not
+            exist or can't be parsed, returns an empty cache.
+    """
+    try:
+        with open(CREDENTIALS_PATH, 'rb') as fh:
+            credentials = utils.json.load(fh)
+    except (IOError, ValueError):
+        credentials = {}
+    credentials.setdefault(ACCESS_TOKENS, {})
+    credentials.setdefault(XSRF_TOKENS, {})
+    credentials.setdefault(AVOIDED_ROUND_TRIPS, 0)
+    return credentials
+
+
+def _save(credentials):
+    """Writes the credential cache, readable only by the current user.
+
+    Should only be called while holding the lock from _locked.
+
+    Args:
+        credentials: Dictionary containing the cached credentials.
+    """
+    utils.write_file_atomically(CREDENTIALS_PATH, utils.json.dumps(credentials),
+                                mode=0600)
+
+
+def _get_cached(kind, server):
+    """Gets an unexpired cached token.
+
+    If one is found, the counter of avoided round trips is incremented.
+
+    Args:
+        kind: String; one of ACCESS_TOKENS or XSRF_TOKENS.
+        server: String; the address of the Rietveld server.
+
+    Returns:
+        String containing the cached token, or None if there is no unexpired
+            token for the server.
+    """
+    with _locked():
+        credentials = _load()
+        cached = credentials[kind].get(server)
+        if cached is None or cached[EXPIRES] <= time.time():
+            return None
+
+        credentials[AVOIDED_ROUND_TRIPS] += 1
+        _save(credentials)
+    print 'Using cached credentials for %s (%d round trips avoided).' % (
+            server, credentials[AVOIDED_ROUND_TRIPS])
+    return cached[TOKEN]
+
+
+def _set_cached(kind, server, token, lifetime):
+    """Stores a token in the cache.
+
+    Args:
+        kind: String; one of ACCESS_TOKENS or XSRF_TOKENS.
+        server: String; the address of the Rietveld server.
+        token: String; the token to be cached.
+        lifetime: Number of seconds before the cached token expires.
+    """
+    with _locked():
+        credentials = _load()
+        credentials[kind][server] = {TOKEN: token,
+                                     EXPIRES: time.time() + lifetime}
+        _save(credentials)
+
+
+def forget(server):
+    """Removes all cached tokens for a server.
+
+    Should be called when the server rejects a request made with a cached
+    token, so that the next request authenticates again.
+
+    Args:
+        server: String; the address of the Rietveld server.
+    """
+    with _locked():
+        credentials = _load()
+        credentials[ACCESS_TOKENS].pop(server, None)
+        credentials[XSRF_TOKENS].pop(server, None)
+        _save(credentials)
+
+
+def forget_xsrf_token(server):
+    """Removes the cached XSRF token for a server.
+
+    Rietveld rejects a stale XSRF token with a 403, even though the access
+    token is still good, so only the XSRF token needs to be fetched again.
+
+    Args:
+        server: String; the address of the Rietveld server.
+    """
+    with _locked():
+        credentials = _load()
+        credentials[XSRF_TOKENS].pop(server, None)
+        _save(credentials)
+
+
+def _caching_get_access_token(original):
+    """Wraps upload.GetAccessToken so that access tokens are cached.
+
+    Args:
+        original: The GetAccessToken function from upload.py.
+
+    Returns:
+        Function with the same signature as original which returns a cached
+            access token if there is one and otherwise defers to original,
+            unless its cached_only attribute is set.
+    """
+    def get_access_token(server=upload.DEFAULT_REVIEW_SERVER,
+                         port=upload.DEFAULT_OAUTH2_PORT,
+                         open_local_webbrowser=True):
+        """Gets a cached OAuth 2.0 access token or a fresh one.
+
+        Raises:
+            SignInRequiredError: If there is no cached token and only cached
+                tokens may be used.
+        """
+        access_token = _get_cached(ACCESS_TOKENS, server)
+        if access_token is None:
+            if get_access_token.cached_only:
+                raise SignInRequiredError(SIGN_IN_REQUIRED_TEMPLATE %
+                                          (server,))
+            access_token = original(server=server, port=port,
+                                    open_local_webbrowser=open_local_webbrowser)
+            if access_token is not None:
+                _set_cached(ACCESS_TOKENS, server, access_token,
+                            ACCESS_TOKEN_LIFETIME)
+        return access_token
+
+    get_access_token.git_rv_original = original
+    get_access_token.cached_only = False
+    return get_access_token
+
+
+def _forgetting_authenticate(original):
+    """Wraps upload.HttpRpcServer._Authenticate so rejected tokens are dropped.
+
+    upload.py only signs in again on a server which is already authenticated
+    when a request was rejected with a 401, in which case the cached access
+    token is the one which was rejected.
+
+    Args:
+        original: The _Authenticate method of upload.HttpRpcServer.
+
+    Returns:
+        Method with the same signature as original which forgets the cached
+            tokens for the server before signing in again.
+    """
+    def authenticate(self):
+        """Forgets a rejected access token and signs in."""
+        if (self.authenticated and
+            isinstance(self.auth_function, upload.OAuth2Creds)):
+            forget(self.auth_function.server)
+        original(self)
+
+    authenticate.git_rv_original = original
+    return authenticate
+
+
+def install_access_token_cache(cached_only=False):
+    """Makes OAuth 2.0 sign ins from upload.py use the credential cache.
+
+    upload.OAuth2Creds looks up GetAccessToken in the upload module each time
+    it is called, so replacing it there covers both upload.RealMain (used by
+    export and sync) and upload.GetRpcServer (used by submit). A token which
+    the server rejects with a 401 is forgotten, so the next sign in gets a new
+    one. Safe to call more than once.
+
+    Args:
+        cached_only: Boolean; whether signing in should fail with
+            SignInRequiredError rather than start the OAuth 2.0 flow when
+            there is no cached token, for processes which can't prompt the
+            user. Defaults to False.
+    """
+    if not hasattr(upload.GetAccessToken, 'git_rv_original'):
+        upload.GetAccessToken = _caching_get_access_token(upload.GetAccessToken)
+    upload.GetAccessToken.cached_only = cached_only
+    if not hasattr(upload.HttpRpcServer._Authenticate, 'git_rv_original'):
+        upload.HttpRpcServer._Authenticate = _forgetting_authenticate(
+                upload.HttpRpcServer._Authenticate)
+
+
+def get_xsrf_token(rpc_server, server):
+    """Gets an XSRF token for the Rietveld API, using the cache if possible.
+
+    Args:
+        rpc_server: An authenticated instance of upload.HttpRpcServer.
+        server: String; the address of the Rietveld server.
+
+    Returns:
+        String containing the XSRF token.
+    """
+    xsrf_token = _get_cached(XSRF_TOKENS, server)
+    if xsrf_token is None:
+        xsrf_token = rpc_server.Send('/' + utils.XSRF_TOKEN,
+                                     extra_headers=utils.XSRF_HEADERS)
+        _set_cached(XSRF_TOKENS, server, xsrf_token, XSRF_TOKEN_LIFETIME)
+    return xsrf_token
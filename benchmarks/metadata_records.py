@@ -0,0 +1,144 @@
+# Copyright 2013 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Micro-benchmark for loading and serializing branch metadata records.
+
+Creates the serialized metadata for many review branches, as stored in the
+git config, then times deserializing it into RietveldInfo objects and
+serializing it again. No git commands are run.
+
+Usage:
+    python benchmarks/metadata_records.py [--records=10000] [--repeat=5]
+        [--legacy]
+"""
+
+
+import argparse
+import base64
+import os
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import utils
+
+
+def make_config_values(count, legacy=False):
+    """Creates serialized metadata for a number of review branches.
+
+    Args:
+        count: Integer; the number of branches.
+        legacy: Boolean; indicating whether to use the base64 encoding of
+            metadata version 1. Defaults to False.
+
+    Returns:
+        List of (branch name, serialized metadata) tuples.
+    """
+    result = []
+    for index in xrange(count):
+        commit_hash = '%040x' % (index,)
+        branch_info = {
+            utils.SERVER: utils.CODE_REVIEW,
+            utils.CC: ['cc%d@example.com' % (index,)],
+            utils.REVIEWERS: ['reviewer@example.com'],
+            utils.PRIVATE: False,
+            utils.APPROVED: index % 2 == 0,
+            utils.REMOTE_INFO: {
+                'remote': 'origin',
+                'branch': 'master',
+                'url': 'https://github.com/example/project',
+                'commit_hash': commit_hash,
+                'last_synced': commit_hash,
+            },
+            utils.REVIEW_INFO: {
+                'issue': 1000000 + index,
+                'subject': 'Change number %d.' % (index,),
+                'description': 'Longer description of change %d.' % (index,),
+                'last_commit': commit_hash,
+            },
+        }
+        if legacy:
+            opaque_info = base64.b64encode(utils.json.dumps(branch_info))
+        else:
+            opaque_info = utils.encode_metadata(branch_info)
+        result.append(('branch-%d' % (index,), opaque_info))
+    return result
+
+
+def best_time(function, repeat):
+    """Times a function, keeping the best of several runs.
+
+    Args:
+        function: Callable with no arguments.
+        repeat: Integer; the number of runs.
+
+    Returns:
+        Tuple of the best time in seconds and the result of the last run.
+    """
+    best = None
+    for _ in xrange(repeat):
+        start = time.time()
+        result = function()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def main():
+    """Runs the benchmark and prints the results."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--records', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--legacy', action='store_true',
+                        help='Load metadata in the version 1 encoding.')
+    args = parser.parse_args()
+
+    config_values = make_config_values(args.records, legacy=args.legacy)
+
+    def load():
+        return [utils.RietveldInfo.from_config_value(branch_name, opaque_info)
+                for branch_name, opaque_info in config_values]
+
+    def to_dict():
+        return [rietveld_info.to_dict() for rietveld_info in records]
+
+    def serialize():
+        return [utils.encode_metadata(rietveld_info.to_dict())
+                for rietveld_info in records]
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    load_time, records = best_time(load, args.repeat)
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    to_dict_time, _ = best_time(to_dict, args.repeat)
+    serialize_time, _ = best_time(serialize, args.repeat)
+
+    per_record = 1e6 / args.records
+    print 'Records:         %d' % (args.records,)
+    print 'Load:            %.3f s (%.1f us/record)' % (
+            load_time, load_time * per_record)
+    print 'to_dict:         %.3f s (%.1f us/record)' % (
+            to_dict_time, to_dict_time * per_record)
+    print 'Serialize:       %.3f s (%.1f us/record)' % (
+            serialize_time, serialize_time * per_record)
+    print 'Peak RSS growth: %d KB' % (rss_after - rss_before,)
+    print 'Stored size:     %.1f bytes/record' % (
+            sum(len(opaque_info) for _, opaque_info in config_values) /
+            float(args.records),)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,315 @@
+# Copyright 2013 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Comments command for git-rv command line tool.
+
+Prints the messages in the review of the current branch which haven't been
+seen yet, and optionally the inline comments on the latest patch set at their
+lines in the working tree.
+"""
+
+
+import re
+
+import utils
+
+
+COMMENT_AUTHOR = 'author_email'
+COMMENT_DRAFT = 'draft'
+COMMENT_LEFT = 'left'
+COMMENT_LINENO = 'lineno'
+COMMENT_TEXT = 'text'
+DIFF_HUNK_REGEX = re.compile(r'^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
+FILES = 'files'
+# In the patch set API, the inline comments on a file are its messages.
+INLINE_COMMENTS = 'messages'
+MESSAGE_DATE = 'date'
+MESSAGE_DISAPPROVAL = 'disapproval'
+MESSAGE_SENDER = 'sender'
+MESSAGE_TEXT = 'text'
+PATCHSET_COMMENTS_URI_PATH_TEMPLATE = '/api/%d/%d?comments=true'
+PATCHSETS = 'patchsets'
+
+
+def _get_line_offsets(commit, path):
+    """Gets the changes to a file between a commit and the working tree.
+
+    Args:
+        commit: String; the hash of the commit.
+        path: String; the path of the file.
+
+    Returns:
+        List of (old_start, old_end, new_end) triples, one for each changed
+            block of lines in order. Lines from old_start up to but not
+            including old_end were changed, and line old_end in the commit is
+            line new_end in the working tree.
+    """
+    diff_output = utils.capture_command(
+            'git', 'diff', '--no-ext-diff', '--no-color', '--unified=0',
+            commit, '--', path, single_line=False)
+
+    offsets = []
+    for line in diff_output.splitlines():
+        match = DIFF_HUNK_REGEX.match(line)
+        if match is None:
+            continue
+        old_start, old_count, new_start, new_count = match.groups()
+        old_start, new_start = int(old_start), int(new_start)
+        old_count = 1 if old_count is None else int(old_count)
+        new_count = 1 if new_count is None else int(new_count)
+        # A block without lines is given as the line before it.
+        if old_count == 0:
+            old_start += 1
+        if new_count == 0:
+            new_start += 1
+        offsets.append((old_start, old_start + old_count,
+                        new_start + new_count))
+    return offsets
+
+
+def _map_line(offsets, lineno):
+    """Maps a line in a commit to the same line in the working tree.
+
+    Args:
+        offsets: List of triples for the file, as returned by
+            _get_line_offsets.
+        lineno: Integer; the line number in the commit.
+
+    Returns:
+        Integer; the line number in the working tree, or None if the line has
+            been changed since.
+    """
+    mapped_lineno = lineno
+    for old_start, old_end, new_end in offsets:
+        if lineno < old_start:
+            break
+        elif lineno < old_end:
+            return None
+        mapped_lineno = lineno - old_end + new_end
+    return mapped_lineno
+
+
+class CommentsAction(object):
+    """A state machine which prints new comments in the current review.
+
+    Attributes:
+        state: The current state of the CommentsAction state machine.
+        __branch: String; containing the name of the current branch.
+        __show_all: Boolean; whether to print all messages rather than only
+            those which haven't been seen yet.
+        __inline: Boolean; whether to print the inline comments on the latest
+            patch set as well.
+    """
+
+    GET_REVIEW = 0
+    SHOW_MESSAGES = 1
+    SHOW_INLINE_COMMENTS = 2
+    FINISHED = 3
+
+    def __init__(self, show_all=False, inline=False):
+        """Constructor for CommentsAction.
+
+        Args:
+            show_all: Boolean; whether to print all messages rather than only
+                those which haven't been seen yet. Defaults to False.
+            inline: Boolean; whether to print the inline comments on the
+                latest patch set as well. Defaults to False.
+        """
+        self.__branch = utils.get_current_branch()
+        self.__show_all = show_all
+        self.__inline = inline
+        self.state = self.GET_REVIEW
+        self.advance()
+
+    @classmethod
+    def callback(cls, args, unused_argv):
+        """A callback to begin a CommentsAction after arguments are parsed.
+
+        Args:
+            args: An argparse.Namespace object to extract parameters from.
+            unused_argv: The original command line arguments that were parsed
+                to create args. These are unused.
+
+        Returns:
+            An instance of CommentsAction. Just by instantiating the instance,
+                the state machine will begin working.
+        """
+        return cls(show_all=args.show_all, inline=args.inline)
+
+    def get_review(self):
+        """Gets the review info and issue metadata for the current branch.
+
+        If the branch is in review, sets state to SHOW_MESSAGES, otherwise
+        notifies the user and sets state to FINISHED. In either case, advances
+        the state machine.
+        """
+        next_state_kwargs = {}
+        rietveld_info = utils.RietveldInfo.from_branch(branch_name=self.__branch)
+        if rietveld_info is None or rietveld_info.review_info is None:
+            print 'No review data found in branch %r.' % (self.__branch,)
+            self.state = self.FINISHED
+        else:
+            next_state_kwargs['rietveld_info'] = rietveld_info
+            next_state_kwargs['issue_metadata'] = utils.get_issue_metadata(
+                    issue=rietveld_info.review_info.issue,
+                    server=rietveld_info.server)
+            self.state = self.SHOW_MESSAGES
+        self.advance(**next_state_kwargs)
+
+    def show_messages(self, rietveld_info, issue_metadata):
+        """Prints the messages which haven't been seen yet.
+
+        The number of messages seen is stored as last_message_index in the
+        review info, so each message is only printed once.
+
+        If inline comments were requested, sets state to SHOW_INLINE_COMMENTS,
+        even if there are no new messages, otherwise sets state to FINISHED. In
+        either case, advances the state machine.
+
+        Args:
+            rietveld_info: RietveldInfo object for the current branch.
+            issue_metadata: Parsed dictionary from the JSON payload for the
+                issue.
+        """
+        next_state_kwargs = {}
+        self.state = self.FINISHED
+
+        review_info = rietveld_info.review_info
+        issue = review_info.issue
+        messages = issue_metadata.get(utils.MESSAGES) or []
+        first_index = review_info.last_message_index or 0
+        if self.__show_all or first_index > len(messages):
+            first_index = 0
+
+        if first_index == len(messages):
+            print 'No new messages in issue %d.' % (issue,)
+        else:
+            for index in xrange(first_index, len(messages)):
+                message = messages[index]
+                verdict = ''
+                if message.get(utils.APPROVAL):
+                    verdict = ' (LGTM)'
+                elif message.get(MESSAGE_DISAPPROVAL):
+                    verdict = ' (not LGTM)'
+                print ('Message %d from %s on %s%s:' % (
+                        index + 1, message.get(MESSAGE_SENDER),
+                        message.get(MESSAGE_DATE), verdict)).encode('utf-8')
+                for line in (message.get(MESSAGE_TEXT) or '').splitlines():
+                    print ('    %s' % (line,)).rstrip().encode('utf-8')
+                print
+
+        if self.__inline:
+            next_state_kwargs['rietveld_info'] = rietveld_info
+            next_state_kwargs['issue_metadata'] = issue_metadata
+            self.state = self.SHOW_INLINE_COMMENTS
+
+        if review_info.last_message_index != len(messages):
+            review_info.last_message_index = len(messages)
+            rietveld_info.save()
+
+        self.advance(**next_state_kwargs)
+
+    def show_inline_comments(self, rietveld_info, issue_metadata):
+        """Prints the published inline comments on the latest patch set.
+
+        Comments are printed as "path:line:" with the line in the working
+        tree, found by following the changes since the commit the comment was
+        made on (the exported commit, or its base for comments on the left
+        side of the diff). This needs the patch set to be archived in refs/rv;
+        otherwise, or if the line has been changed since, the line in the
+        patch set is given instead.
+
+        Sets state to FINISHED and advances the state machine.
+
+        Args:
+            rietveld_info: RietveldInfo object for the current branch.
+            issue_metadata: Parsed dictionary from the JSON payload for the
+                issue.
+
+        Raises:
+            RietveldRequestError: If the request for the patch set does not
+                return a 200 status code.
+        """
+        self.state = self.FINISHED
+
+        issue = rietveld_info.review_info.issue
+        patchsets = issue_metadata.get(PATCHSETS) or []
+        if not patchsets:
+            self.advance()
+            return
+        patchset = patchsets[-1]
+
+        patchset_path = PATCHSET_COMMENTS_URI_PATH_TEMPLATE % (issue, patchset)
+        patchset_files = utils.json.loads(utils.read_server_paths(
+                rietveld_info.server, [patchset_path])[0]).get(FILES, {})
+        archived_commits = utils.get_patchsets(issue).get(patchset, {})
+
+        line_offsets = {}
+        for path in sorted(patchset_files):
+            comments = [comment for comment in
+                        patchset_files[path].get(INLINE_COMMENTS) or []
+                        if not comment.get(COMMENT_DRAFT)]
+            comments.sort(key=lambda comment: (comment.get(COMMENT_LINENO),
+                                               comment.get(MESSAGE_DATE)))
+            for comment in comments:
+                lineno = comment.get(COMMENT_LINENO)
+                kind = (utils.PATCHSET_BASE if comment.get(COMMENT_LEFT)
+                        else utils.PATCHSET_HEAD)
+                mapped_lineno = None
+                commit = archived_commits.get(kind)
+                if commit is not None:
+                    if (commit, path) not in line_offsets:
+                        line_offsets[(commit, path)] = _get_line_offsets(
+                                commit, path)
+                    mapped_lineno = _map_line(line_offsets[(commit, path)],
+                                              lineno)
+
+                if mapped_lineno is None:
+                    location = '%s (line %s of patch set %d)' % (
+                            path, lineno, patchset)
+                else:
+                    location = '%s:%d' % (path, mapped_lineno)
+                text_lines = (comment.get(COMMENT_TEXT) or '').splitlines()
+                print ('%s: %s: %s' % (location, comment.get(COMMENT_AUTHOR),
+                                       text_lines[0] if text_lines else '')
+                       ).encode('utf-8')
+                for line in text_lines[1:]:
+                    print ('    %s' % (line,)).rstrip().encode('utf-8')
+
+        self.advance()
+
+    def advance(self, *args, **kwargs):
+        """Advances by calling the method corresponding to the current state.
+
+        Args:
+            *args: Arguments to be passed to the specified method based on
+                the current state.
+            **kwargs: Keyword arguments to be passed to the specified method
+                based on the current state.
+
+        Raises:
+            GitRvException: If this method is called and the state is not one
+                of the valid states.
+        """
+        if self.state == self.GET_REVIEW:
+            self.get_review(*args, **kwargs)
+        elif self.state == self.SHOW_MESSAGES:
+            self.show_messages(*args, **kwargs)
+        elif self.state == self.SHOW_INLINE_COMMENTS:
+            self.show_inline_comments(*args, **kwargs)
+        elif self.state == self.FINISHED:
+            return
+        else:
+            raise utils.GitRvException('Unexpected state %r in '
+                                       'CommentsAction.' % (self.state,))
@@ -0,0 +1,323 @@
+# Copyright 2013 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Daemon command for git-rv command line tool.
+
+Periodically refreshes the issue metadata for every review branch into the
+local issue cache, so that foreground commands rarely need to wait on the
+code review server.
+"""
+
+
+import errno
+import os
+import random
+import signal
+import sys
+import time
+
+import utils
+
+
+DAEMON_LOG = 'daemon.log'
+DAEMON_PID = 'daemon.pid'
+# Polling intervals are randomly stretched or shrunk by up to this fraction
+# so that many clients don't poll the server in lock step.
+JITTER = 0.2
+# Upper bound (in seconds) on how long the daemon backs off after the server
+# signals that it is overloaded or rate limiting.
+MAX_BACKOFF = 3600
+# HTTP status codes for which the daemon backs off before polling again.
+RATE_LIMIT_STATUSES = (429, 503)
+
+
+class DaemonAction(object):
+    """A state machine which keeps the local issue cache warm.
+
+    Attributes:
+        state: The current state of the DaemonAction state machine.
+        __interval: Number of seconds between refreshes of all issues.
+        __min_delay: Number of seconds to wait between consecutive requests
+            to a code review server.
+        __once: Boolean; indicating whether to refresh a single time and exit.
+        __detach: Boolean; indicating whether to run in the background.
+        __stop: Boolean; indicating whether a running daemon should be stopped
+            instead of starting a new one.
+        __stopping: Boolean; set by the SIGTERM handler to end the poll loop.
+        __backoff: Number of seconds to wait before the next refresh due to
+            rate limiting by the server, or None if not rate limited.
+    """
+
+    STARTING = 0
+    STOP_DAEMON = 1
+    POLL = 2
+    FINISHED = 3
+
+    def __init__(self, interval, min_delay, once=False, detach=False,
+                 stop=False):
+        """Constructor for DaemonAction.
+
+        Args:
+            interval: Number of seconds between refreshes of all issues.
+            min_delay: Number of seconds to wait between consecutive requests
+                to a code review server.
+            once: Boolean; indicating whether to refresh a single time and
+                exit. Defaults to False.
+            detach: Boolean; indicating whether to run in the background.
+                Defaults to False.
+            stop: Boolean; indicating whether a running daemon should be
+                stopped instead of starting a new one. Defaults to False.
+        """
+        self.__interval = interval
+        self.__min_delay = min_delay
+        self.__once = once
+        self.__detach = detach
+        self.__stop = stop
+        self.__stopping = False
+        self.__backoff = None
+        self.__pid_path = utils.get_rv_path(DAEMON_PID)
+        self.state = self.STARTING
+        self.advance()
+
+    @classmethod
+    def callback(cls, args, unused_argv):
+        """A callback to begin a DaemonAction after arguments are parsed.
+
+        Args:
+            args: An argparse.Namespace object to extract parameters from.
+            unused_argv: The original command line arguments that were parsed
+                to create args. These are unused.
+
+        Returns:
+            An instance of DaemonAction. Just by instantiating the instance, the
+                state machine will begin working.
+        """
+        return cls(args.interval, args.min_delay, once=args.once,
+                   detach=args.detach, stop=args.stop)
+
+    def __running_pid(self):
+        """Gets the process ID of a running daemon for this repository.
+
+        Returns:
+            Integer process ID if a daemon is running, otherwise None.
+        """
+        try:
+            with open(self.__pid_path, 'r') as fh:
+                pid = int(fh.read().strip())
+        except (IOError, ValueError):
+            return None
+
+        try:
+            os.kill(pid, 0)
+        except OSError, exc:  # Syntax for python<2.6
+            if exc.errno == errno.ESRCH:
+                return None
+        return pid
+
+    def check_running(self):
+        """Checks whether a daemon is already running for this repository.
+
+        If stopping, sets state to STOP_DAEMON. Otherwise, if a daemon is
+        already running sets state to FINISHED and if not sets state to POLL.
+        In all cases, advances the state machine.
+        """
+        running_pid = self.__running_pid()
+        if self.__stop:
+            self.state = self.STOP_DAEMON
+        elif running_pid is not None:
+            print 'git-rv daemon already running with PID %d.' % (running_pid,)
+            self.state = self.FINISHED
+        else:
+            self.state = self.POLL
+        self.advance()
+
+    def stop_daemon(self):
+        """Stops the daemon running for this repository, if there is one.
+
+        If successful, sets state to FINISHED and advances the state machine.
+        """
+        pid = self.__running_pid()
+        if pid is None:
+            print 'No git-rv daemon is running.'
+        else:
+            os.kill(pid, signal.SIGTERM)
+            print 'Stopped git-rv daemon with PID %d.' % (pid,)
+        self.state = self.FINISHED
+        self.advance()
+
+    def __detach_process(self):
+        """Moves the current process into the background.
+
+        Uses the standard double fork so the daemon is not a session leader
+        and can't re-acquire a terminal. Output is sent to DAEMON_LOG.
+        """
+        if os.fork() > 0:
+            print 'git-rv daemon started, logging to %s.' % (
+                    utils.get_rv_path(DAEMON_LOG),)
+            os._exit(0)
+        os.setsid()
+        if os.fork() > 0:
+            os._exit(0)
+
+        log_fd = os.open(utils.get_rv_path(DAEMON_LOG),
+                         os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0600)
+        null_fd = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(null_fd, sys.stdin.fileno())
+        os.dup2(log_fd, sys.stdout.fileno())
+        os.dup2(log_fd, sys.stderr.fileno())
+
+    def __handle_sigterm(self, unused_signum, unused_frame):
+        """Signal handler which ends the poll loop after the current step."""
+        self.__stopping = True
+
+    def __refresh_issue(self, issue, server, branch_names):
+        """Refreshes the cached metadata for a single issue.
+
+        Also updates the approval flag stored for each branch in review on the
+        issue, if it has changed. The metadata of each branch is read again
+        first, since a command may have changed it during the refresh, and a
+        branch which is no longer in review on the issue is skipped.
+
+        Args:
+            issue: Integer; containing an ID of a code review issue.
+            server: String; the address of the Rietveld server hosting the
+                code review.
+            branch_names: List of strings; the branches in review on the issue.
+
+        Returns:
+            Boolean indicating whether or not more requests may be sent to
+                the server in this refresh.
+        """
+        try:
+            issue_metadata = utils.fetch_issue_metadata(issue, server=server)
+        except utils.RietveldRequestError, exc:
+            if exc.status not in RATE_LIMIT_STATUSES:
+                print 'Refreshing issue %d failed: %s' % (issue, exc)
+                return True
+
+            if exc.retry_after is not None:
+                self.__backoff = exc.retry_after
+            else:
+                self.__backoff = min(2 * (self.__backoff or self.__interval),
+                                     MAX_BACKOFF)
+            print 'Server %r is rate limiting, backing off %d seconds.' % (
+                    server, self.__backoff)
+            return False
+        except (IOError, utils.GitRvException), exc:
+            print 'Refreshing issue %d failed: %s' % (issue, exc)
+            return True
+
+        if utils.MESSAGES in issue_metadata:
+            approved = utils.issue_approved(issue_metadata)
+            for branch_name in branch_names:
+                rietveld_info = utils.RietveldInfo.from_branch(
+                        branch_name=branch_name)
+                if (rietveld_info is None or
+                    rietveld_info.review_info is None or
+                    rietveld_info.review_info.issue != issue):
+                    continue
+                if rietveld_info.approved != approved:
+                    rietveld_info.approved = approved
+                    rietveld_info.save()
+        return True
+
+    def __refresh_all(self):
+        """Refreshes the cached metadata for every review branch.
+
+        Issues whose cached metadata was refreshed recently (for example by a
+        foreground command) are skipped.
+        """
+        self.__backoff = None
+        issues = {}
+        rietveld_infos = utils.RietveldInfo.all_branches()
+        for branch_name, rietveld_info in rietveld_infos.iteritems():
+            if (rietveld_info.server is not None and
+                rietveld_info.review_info is not None and
+                rietveld_info.review_info.issue is not None):
+                issue_key = (rietveld_info.review_info.issue,
+                             rietveld_info.server)
+                issues.setdefault(issue_key, []).append(branch_name)
+
+        fresh_age = self.__interval / 2.0
+        for issue, server in sorted(issues):
+            if self.__stopping:
+                return
+            if utils.read_cached_issue_metadata(
+                    issue, server, max_age=fresh_age) is not None:
+                continue
+            if not self.__refresh_issue(issue, server,
+                                        issues[(issue, server)]):
+                return
+            time.sleep(self.__min_delay)
+
+    def __sleep(self):
+        """Sleeps until the next refresh is due or the daemon is stopped."""
+        delay = self.__backoff or self.__interval
+        delay *= random.uniform(1 - JITTER, 1 + JITTER)
+        wake_time = time.time() + delay
+        while not self.__stopping and time.time() < wake_time:
+            # A signal interrupts the sleep, so the stop flag is checked
+            # promptly.
+            time.sleep(min(wake_time - time.time(), 1.0))
+
+    def poll(self):
+        """Refreshes the issue cache until stopped.
+
+        If --once was used, refreshes a single time. The PID file for the
+        daemon is held for the duration.
+
+        If successful, sets state to FINISHED and advances the state machine.
+        """
+        if self.__detach:
+            self.__detach_process()
+
+        utils.write_file_atomically(self.__pid_path, '%d\n' % (os.getpid(),))
+        signal.signal(signal.SIGTERM, self.__handle_sigterm)
+        try:
+            while not self.__stopping:
+                self.__refresh_all()
+                if self.__once:
+                    break
+                self.__sleep()
+        finally:
+            if os.path.exists(self.__pid_path):
+                os.remove(self.__pid_path)
+
+        self.state = self.FINISHED
+        self.advance()
+
+    def advance(self, *args, **kwargs):
+        """Advances by calling the method corresponding to the current state.
+
+        Args:
+            *args: Arguments to be passed to the specified method based on
+                the current state.
+            **kwargs: Keyword arguments to be passed to the specified method
+                based on the current state.
+
+        Raises:
+            GitRvException: If this method is called and the state is not one
+                of the valid states.
+        """
+        if self.state == self.STARTING:
+            self.check_running(*args, **kwargs)
+        elif self.state == self.STOP_DAEMON:
+            self.stop_daemon(*args, **kwargs)
+        elif self.state == self.POLL:
+            self.poll(*args, **kwargs)
+        elif self.state == self.FINISHED:
+            return
+        else:
+            raise utils.GitRvException('Unexpected state %r in DaemonAction.' %
+                                       (self.state,))
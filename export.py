@@ -22,10 +22,78 @@ things.
 
 from upload import RealMain
 
+import auth
+import presubmit
 import utils
 from utils import GitRvException
 
 
+def upload_patch(args, base_commit, head_commit, issue=None, send_mail=True,
+                 commit_subject=None, commit_description=None):
+    """Calls upload.py to upload the diff between two commits.
+
+    Since the commits are given explicitly, the branch being uploaded doesn't
+    need to be checked out. The commits are archived locally as the new patch
+    set of the issue, for "git rv interdiff".
+
+    Args:
+        args: List of strings; command line arguments for upload.py, without
+            the git-rv command. Flags which only git-rv knows are removed.
+        base_commit: String; the hash of the commit the review is diffed
+            against.
+        head_commit: String; the hash of the commit to upload.
+        issue: Integer; containing an ID of a code review issue. Defaults to
+            None, in which case a new issue is created.
+        send_mail: Boolean; whether to send mail for the upload. Defaults to
+            True.
+        commit_subject: String; the title for the patch set. Defaults to None,
+            in which case none is passed to upload.py.
+        commit_description: String; the description for the patch set. Only
+            used if commit_subject is set. Defaults to None.
+
+    Returns:
+        Long integer; the issue the patch was uploaded to.
+    """
+    # Create copy of args to update
+    command_args = utils.remove_git_rv_args(args)
+    command_args.append(utils.REVISION_TEMPLATE % (base_commit, head_commit))
+
+    # VCS is always git
+    command_args.append(utils.VCS_ARG)
+
+    # Auth method is always OAuth 2.0 and never use cookies
+    command_args.extend(utils.OAUTH2_ARGS)
+
+    # Send mail unless explicitly told not to
+    if send_mail:
+        command_args.append(utils.SEND_MAIL_ARG)
+
+    # Add any issue
+    if issue is not None:
+        command_args.append(utils.ISSUE_ARG_TEMPLATE % (issue,))
+
+    if commit_subject is not None:
+        command_args.extend(['-t', commit_subject, '-m', commit_description])
+
+    # Make sure to execute upload.py
+    command_args.insert(0, 'upload.py')
+
+    # Reuse an OAuth 2.0 access token from a recent command if possible.
+    auth.install_access_token_cache()
+
+    # RealMain returns (issue, patchset)
+    issue, patchset = RealMain(command_args)
+    issue = long(issue)
+    if patchset is not None and str(patchset).isdigit():
+        try:
+            utils.record_patchset(issue, int(patchset), base_commit,
+                                  head_commit)
+        except GitRvException, exc:  # Syntax for python<2.6
+            print 'Could not archive patch set %s of issue %d:\n%s' % (
+                    patchset, issue, exc)
+    return issue
+
+
 class ExportAction(object):
     """A state machine which exports a commit to a review.
 
@@ -93,12 +161,19 @@ class ExportAction(object):
         self.__rietveld_info = utils.RietveldInfo.from_branch(
                 branch_name=self.__branch) or utils.RietveldInfo(self.__branch)
         self.__update_rietveld_info_from_args(args)
+        if args.parent_branch is not None:
+            self.__set_parent(args.parent_branch)
 
         # Add remote info if it isn't already there.
         if self.__rietveld_info.remote_info is None:
             remote_info = utils.get_remote_info(current_branch=self.__branch)
             self.__rietveld_info.remote_info = remote_info
 
+        # Checked before saving, so a failed check leaves the metadata as is.
+        if not args.skip_presubmit and not presubmit.run_checks(
+                self.__rietveld_info.last_synced, self.__current_head):
+            raise GitRvException(utils.PRESUBMIT_FAILED)
+
         self.__rietveld_info.save()
 
         # TODO(dhermes): Should we check if the subject is Truth-y?
@@ -133,6 +208,42 @@ class ExportAction(object):
         if args.reviewers is not None:
             self.__rietveld_info.reviewers = args.reviewers
 
+    def __set_parent(self, parent_branch):
+        """Stacks a new review on the review in another branch.
+
+        The review is diffed against the last commit exported in the parent
+        review and submitted to the same remote branch.
+
+        Args:
+            parent_branch: String; the name of the branch with the parent
+                review.
+
+        Raises:
+            GitRvException: If the review has already been exported, if the
+                parent branch is not in review or if HEAD doesn't contain the
+                last commit exported in the parent review.
+        """
+        if self.__rietveld_info.review_info is not None:
+            if parent_branch == self.__rietveld_info.parent_branch:
+                return
+            raise GitRvException('The parent of a review can only be set when '
+                                 'it is first exported.')
+
+        parent_info = utils.RietveldInfo.from_branch(branch_name=parent_branch)
+        if (parent_branch == self.__branch or parent_info is None or
+            parent_info.review_info is None):
+            raise GitRvException('Branch %r is not a review branch which can '
+                                 'be a parent.' % (parent_branch,))
+        parent_commit = parent_info.review_info.last_commit
+        if not utils.is_ancestor(parent_commit, self.__current_head):
+            raise GitRvException('HEAD does not contain %s, the last commit '
+                                 'exported in branch %r.' % (parent_commit,
+                                                             parent_branch))
+
+        self.__rietveld_info.parent_branch = parent_branch
+        self.__rietveld_info.parent_last_synced = parent_commit
+        self.__rietveld_info.remote_info = parent_info.remote_info.to_dict()
+
     def __get_commit_message_parts(self, commit_subject, commit_description):
         """Gets commit subject and description for the current patch set.
 
@@ -157,9 +268,14 @@ class ExportAction(object):
             return commit_subject, commit_description
 
         if self.__rietveld_info.review_info is None:
-            # RemoteInfo always populated in callback()
-            remote_branch = self.__rietveld_info.remote_info.remote_branch_ref
-            last_commit = self.__rietveld_info.remote_info.commit_hash
+            if self.__rietveld_info.parent_branch is not None:
+                remote_branch = self.__rietveld_info.parent_branch
+                last_commit = self.__rietveld_info.parent_last_synced
+            else:
+                # RemoteInfo always populated in callback()
+                remote_info = self.__rietveld_info.remote_info
+                remote_branch = remote_info.remote_branch_ref
+                last_commit = remote_info.commit_hash
         else:
             remote_branch = None
             last_commit = self.__rietveld_info.review_info.last_commit
@@ -172,7 +288,7 @@ class ExportAction(object):
         """A callback to begin an ExportAction after arguments are parsed.
 
         If the branch is not in a clean state, won't create an ExportAction,
-        will just print 'git diff' and proceed.
+        will just summarize the changes and return.
 
         Args:
             args: An argparse.Namespace object to extract parameters from.
@@ -185,8 +301,7 @@ class ExportAction(object):
         """
         current_branch = utils.get_current_branch()
         if not utils.in_clean_state():
-            print 'Branch %r not in clean state:' % (current_branch,)
-            print utils.capture_command('git', 'diff', single_line=False)
+            utils.print_unclean_state(current_branch, full_diff=args.full_diff)
             return
 
         if args.no_mail and args.send_patch:
@@ -250,37 +365,18 @@ class ExportAction(object):
             raise GitRvException('upload.py called by method other than '
                                  'git-rv export.')
 
-        # Create copy of argv to update, drop the command being executed
-        command_args = self.__argv[1:]
-
-        # TODO(dhermes): Catch failure if this lookup breaks.
-        remote_commit_hash = self.__rietveld_info.remote_info.last_synced
-        command_args.append(utils.REVISION_TEMPLATE % (remote_commit_hash,))
-
-        # VCS is always git
-        command_args.append(utils.VCS_ARG)
-
-        # Auth method is always OAuth 2.0 and never use cookies
-        command_args.extend(utils.OAUTH2_ARGS)
-
-        # Send mail unless explicitly told not to
-        if not self.__no_send_mail:
-            command_args.append(utils.SEND_MAIL_ARG)
-
-        # Add any issue
-        if issue is not None:
-            command_args.append(utils.ISSUE_ARG_TEMPLATE % (issue,))
-
         # Add the message if it wasn't overridden
+        commit_subject = commit_description = None
         if not self.__commit_message_overridden:
-            command_args.extend(['-t', self.__commit_subject,
-                                 '-m', self.__commit_description])
-
-        # Make sure to execute upload.py
-        command_args.insert(0, 'upload.py')
+            commit_subject = self.__commit_subject
+            commit_description = self.__commit_description
 
-        # RealMain returns (issue, patchset)
-        return long(RealMain(command_args)[0])
+        # TODO(dhermes): Catch failure if this lookup breaks.
+        return upload_patch(self.__argv[1:], self.__rietveld_info.last_synced,
+                            self.__current_head, issue=issue,
+                            send_mail=not self.__no_send_mail,
+                            commit_subject=commit_subject,
+                            commit_description=commit_description)
 
     def upload_issue(self):
         """Uploads a new issue.
@@ -344,8 +440,10 @@ class ExportAction(object):
         self.__rietveld_info.review_info = review_info
         self.__rietveld_info.save()
 
+        # The upload may have changed the subject or description, so the
+        # cached issue metadata can't be trusted here.
         success, _ = utils.update_rietveld_metadata_from_issue(
-                rietveld_info=self.__rietveld_info)
+                rietveld_info=self.__rietveld_info, max_age=0)
         if success:
             print 'Metadata update from code server succeeded.'
         else:
@@ -0,0 +1,315 @@
+# Copyright 2013 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Garbage collection command for git-rv command line tool.
+
+Removes review metadata left behind for branches which no longer exist,
+dummy branches left behind by failed submits, archived patch sets of issues
+no longer in review in any branch and stale presubmit results.
+"""
+
+
+import os
+import re
+
+import journal
+import presubmit
+import submit
+import utils
+
+
+# Prefix of the refs of archived patch sets, followed by the issue.
+ARCHIVE_REF_PREFIX = utils.PATCHSET_REF_PREFIX_TEMPLATE.split('%d', 1)[0]
+# Names of the dummy branches created by submit, which appends '_0' until the
+# name is not taken.
+REVIEW_BRANCH_REGEX = re.compile(
+        '^%s(_0)*$' % (submit.BRANCH_NAME_TEMPLATE.replace('%d', r'\d+'),))
+
+
+def _get_config_size():
+    """Gets the size of the git config file of the repository.
+
+    Returns:
+        Integer; the number of bytes in the config file.
+    """
+    return os.path.getsize(os.path.join(utils.get_git_common_dir(), 'config'))
+
+
+class GarbageCollectAction(object):
+    """A state machine which removes stale review metadata and branches.
+
+    Attributes:
+        state: The current state of the GarbageCollectAction state machine.
+        __check_closed: Boolean; whether to also remove the metadata for
+            branches whose issues have been closed on the code review server.
+        __dry_run: Boolean; whether to only report what would be removed.
+        __config_size: Integer; the size of the git config file in bytes when
+            the action began.
+    """
+
+    FIND_GARBAGE = 0
+    CHECK_CLOSED = 1
+    REMOVE_GARBAGE = 2
+    FINISHED = 3
+
+    def __init__(self, check_closed=False, dry_run=False):
+        """Constructor for GarbageCollectAction.
+
+        Args:
+            check_closed: Boolean; whether to also remove the metadata for
+                branches whose issues have been closed on the code review
+                server. Defaults to False.
+            dry_run: Boolean; whether to only report what would be removed.
+                Defaults to False.
+        """
+        self.__check_closed = check_closed
+        self.__dry_run = dry_run
+        self.__config_size = _get_config_size()
+        self.state = self.FIND_GARBAGE
+        self.advance()
+
+    @classmethod
+    def callback(cls, args, unused_argv):
+        """A callback to begin a GarbageCollectAction after arguments are parsed.
+
+        Args:
+            args: An argparse.Namespace object to extract parameters from.
+            unused_argv: The original command line arguments that were parsed
+                to create args. These are unused.
+
+        Returns:
+            An instance of GarbageCollectAction. Just by instantiating the
+                instance, the state machine will begin working.
+        """
+        return cls(check_closed=args.check_closed, dry_run=args.dry_run)
+
+    def find_garbage(self):
+        """Cross-checks the review metadata against the refs in the repository.
+
+        Lists the branches and archived patch sets with a single
+        "git for-each-ref" and compares them with the metadata of every review
+        branch. Metadata is garbage if its branch no longer exists. A branch is
+        garbage if it is named like a submit dummy branch and is neither in
+        review nor used by an interrupted command. Archived patch sets are
+        garbage if their issue is not in review in any remaining branch.
+        Cached presubmit results are garbage if their check has changed or
+        they haven't been used for a while.
+
+        Branches with an interrupted command are left alone, since
+        "git rv recover" needs their metadata.
+
+        If checking for closed issues, sets state to CHECK_CLOSED, otherwise
+        sets state to REMOVE_GARBAGE. In either case, advances the state
+        machine.
+        """
+        refs_output = utils.capture_command(
+                'git', 'for-each-ref', '--format=%(refname)',
+                utils.BRANCH_REF_TEMPLATE % ('',), ARCHIVE_REF_PREFIX,
+                single_line=False)
+        branches = set()
+        archived_issues = set()
+        for ref in refs_output.split():
+            if ref.startswith(utils.BRANCH_REF_TEMPLATE % ('',)):
+                branches.add(ref[len(utils.BRANCH_REF_TEMPLATE % ('',)):])
+            else:
+                issue = ref[len(ARCHIVE_REF_PREFIX):].split('/', 1)[0]
+                if issue.isdigit():
+                    archived_issues.add(int(issue))
+
+        protected_branches = set()
+        for entry in journal.load_entries():
+            protected_branches.add(entry[utils.BRANCH].lower())
+            if entry.get(journal.REVIEW_BRANCH) is not None:
+                protected_branches.add(entry[journal.REVIEW_BRANCH])
+
+        # Config names don't keep the case of branch names, so branches are
+        # compared in lower case.
+        lower_branches = set(branch.lower() for branch in branches)
+        rietveld_infos = utils.RietveldInfo.all_branches()
+        orphaned_branches = []
+        live_infos = {}
+        for branch_name, rietveld_info in sorted(rietveld_infos.iteritems()):
+            if branch_name.lower() in protected_branches:
+                continue
+            elif branch_name.lower() in lower_branches:
+                live_infos[branch_name] = rietveld_info
+            else:
+                orphaned_branches.append(branch_name)
+
+        dummy_branches = sorted(
+                branch for branch in branches
+                if REVIEW_BRANCH_REGEX.match(branch) and
+                branch not in rietveld_infos and
+                branch not in protected_branches)
+
+        next_state_kwargs = {
+            'orphaned_branches': orphaned_branches,
+            'dummy_branches': dummy_branches,
+            'live_infos': live_infos,
+            'archived_issues': archived_issues,
+            'stale_results': presubmit.get_stale_cache_paths(),
+        }
+        if self.__check_closed:
+            self.state = self.CHECK_CLOSED
+        else:
+            self.state = self.REMOVE_GARBAGE
+        self.advance(**next_state_kwargs)
+
+    def check_closed(self, orphaned_branches, dummy_branches, live_infos,
+                     archived_issues, stale_results):
+        """Finds the review branches whose issues are closed on the server.
+
+        The issue metadata is requested concurrently, by a bounded pool of
+        threads. Branches whose metadata can't be retrieved are kept.
+
+        Sets state to REMOVE_GARBAGE and advances the state machine.
+
+        Args:
+            orphaned_branches: List of strings; the names of branches which no
+                longer exist but still have metadata.
+            dummy_branches: List of strings; the names of leftover submit dummy
+                branches.
+            live_infos: Dictionary mapping each remaining review branch to its
+                RietveldInfo.
+            archived_issues: Set of integers; the issues with archived patch
+                sets.
+            stale_results: List of strings; the paths of stale presubmit
+                results.
+        """
+        issues = {}
+        for branch_name, rietveld_info in live_infos.iteritems():
+            if (rietveld_info.server is not None and
+                rietveld_info.review_info is not None and
+                rietveld_info.review_info.issue is not None):
+                issue_key = (rietveld_info.review_info.issue,
+                             rietveld_info.server)
+                issues.setdefault(issue_key, []).append(branch_name)
+
+        def get_issue_metadata(issue_key):
+            """Gets the issue metadata for an issue and its server."""
+            issue, server = issue_key
+            return utils.get_issue_metadata(issue=issue, server=server)
+
+        issue_metadata = utils.run_concurrently(get_issue_metadata,
+                                                list(issues))
+
+        closed_branches = []
+        for issue, server in sorted(issues):
+            metadata = issue_metadata[(issue, server)]
+            if isinstance(metadata, Exception):
+                print 'Could not check issue %d:\n%s' % (issue, metadata)
+            elif metadata.get(utils.CLOSED):
+                closed_branches.extend(issues[(issue, server)])
+
+        for branch_name in closed_branches:
+            del live_infos[branch_name]
+
+        self.state = self.REMOVE_GARBAGE
+        self.advance(orphaned_branches=orphaned_branches,
+                     dummy_branches=dummy_branches, live_infos=live_infos,
+                     archived_issues=archived_issues,
+                     stale_results=stale_results,
+                     closed_branches=sorted(closed_branches))
+
+    def remove_garbage(self, orphaned_branches, dummy_branches, live_infos,
+                       archived_issues, stale_results, closed_branches=()):
+        """Removes the garbage found and reports the size of the git config.
+
+        Sets state to FINISHED and advances the state machine.
+
+        Args:
+            orphaned_branches: List of strings; the names of branches which no
+                longer exist but still have metadata.
+            dummy_branches: List of strings; the names of leftover submit dummy
+                branches.
+            live_infos: Dictionary mapping each review branch which is kept to
+                its RietveldInfo.
+            archived_issues: Set of integers; the issues with archived patch
+                sets.
+            stale_results: List of strings; the paths of stale presubmit
+                results.
+            closed_branches: List of strings; the names of branches whose
+                issues are closed on the server. Defaults to the empty tuple.
+        """
+        verb = 'Would remove' if self.__dry_run else 'Removing'
+
+        for branch_name in orphaned_branches:
+            print '%s metadata for deleted branch %r.' % (verb, branch_name)
+            if not self.__dry_run:
+                utils.RietveldInfo.remove(branch_name=branch_name)
+
+        for branch_name in closed_branches:
+            print '%s metadata for branch %r, its issue is closed.' % (
+                    verb, branch_name)
+            if not self.__dry_run:
+                utils.RietveldInfo.remove(branch_name=branch_name)
+
+        current_branch = utils.get_current_branch()
+        for branch_name in dummy_branches:
+            if branch_name == current_branch:
+                continue
+            commit_hash = utils.get_head_commit(current_branch=branch_name)
+            print '%s leftover submit branch %r (was %s).' % (
+                    verb, branch_name, commit_hash)
+            if not self.__dry_run:
+                utils.capture_command('git', 'branch', '-D', branch_name,
+                                      single_line=False)
+
+        live_issues = set(rietveld_info.review_info.issue
+                          for rietveld_info in live_infos.itervalues()
+                          if rietveld_info.review_info is not None)
+        for issue in sorted(archived_issues - live_issues):
+            print '%s archived patch sets of issue %d.' % (verb, issue)
+            if not self.__dry_run:
+                utils.delete_patchset_refs(issue)
+
+        if stale_results:
+            print '%s %d stale presubmit results.' % (verb, len(stale_results))
+            if not self.__dry_run:
+                presubmit.remove_cache_paths(stale_results)
+
+        if not (orphaned_branches or closed_branches or dummy_branches or
+                archived_issues - live_issues or stale_results):
+            print 'Nothing to remove.'
+        if not self.__dry_run:
+            print 'Git config size: %d bytes before, %d bytes after.' % (
+                    self.__config_size, _get_config_size())
+
+        self.state = self.FINISHED
+        self.advance()
+
+    def advance(self, *args, **kwargs):
+        """Advances by calling the method corresponding to the current state.
+
+        Args:
+            *args: Arguments to be passed to the specified method based on
+                the current state.
+            **kwargs: Keyword arguments to be passed to the specified method
+                based on the current state.
+
+        Raises:
+            GitRvException: If this method is called and the state is not one
+                of the valid states.
+        """
+        if self.state == self.FIND_GARBAGE:
+            self.find_garbage(*args, **kwargs)
+        elif self.state == self.CHECK_CLOSED:
+            self.check_closed(*args, **kwargs)
+        elif self.state == self.REMOVE_GARBAGE:
+            self.remove_garbage(*args, **kwargs)
+        elif self.state == self.FINISHED:
+            return
+        else:
+            raise utils.GitRvException('Unexpected state %r in '
+                                       'GarbageCollectAction.' % (self.state,))
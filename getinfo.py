@@ -83,7 +83,15 @@ class GetInfoAction(object):
             rietveld_info: RietveldInfo object for the current branch.
         """
         if rietveld_info is not None:
-            print utils.json.dumps(rietveld_info.to_dict(), indent=2)
+            info = rietveld_info.to_dict()
+            remote_info = rietveld_info.remote_info
+            if remote_info is not None and remote_info.url is not None:
+                # Not stored, but shows how commit links will be created.
+                repository_info = remote_info.repository_info
+                info[utils.COMMIT_LINK_TEMPLATE] = (
+                        repository_info and
+                        repository_info.commit_link_template)
+            print utils.json.dumps(info, indent=2)
         else:
             print 'No review data found in branch %r.' % (self.__branch,)
         self.state = self.FINISHED
@@ -0,0 +1,55 @@
+# Copyright 2013 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Shell prompt support for git-rv, for bash and zsh.
+#
+# git-rv keeps a one line status record for each review branch in
+# {$GIT_COMMON_DIR}/rv/prompt/{$BRANCH}, updated whenever the review metadata
+# for the branch changes. This reads the record without starting Python.
+#
+# To use it, source this file in your ~/.bashrc or ~/.zshrc and add
+# $(__git_rv_ps1) to your prompt, for example:
+#
+#     source ~/git-rv/git-rv-prompt.sh
+#     PS1='\w$(__git_rv_ps1 " [%s]")\$ '
+#
+# In zsh, "setopt PROMPT_SUBST" is also needed. The optional argument is a
+# printf format string for the review status, which defaults to " (%s)". The
+# status is "rv:" followed by the issue number and, when they apply:
+#     *       HEAD has changed since the last export
+#     LGTM    the review has been approved
+#     HALTED  a sync was halted by merge conflicts
+
+__git_rv_ps1 ()
+{
+    local git_dir head branch issue approved sync_halted last_commit status
+    {
+        read -r git_dir
+        read -r head
+        read -r branch
+    } <<EOF
+$(git rev-parse --git-common-dir HEAD --abbrev-ref HEAD 2>/dev/null)
+EOF
+    [ -n "$branch" ] || return 0
+    [ -f "$git_dir/rv/prompt/$branch" ] || return 0
+    read -r issue approved sync_halted last_commit \
+        < "$git_dir/rv/prompt/$branch" || return 0
+    [ "$issue" != "-" ] || return 0
+
+    status="rv:$issue"
+    [ "$last_commit" = "$head" ] || status="$status*"
+    [ "$approved" != "1" ] || status="$status LGTM"
+    [ "$sync_halted" != "1" ] || status="$status HALTED"
+    printf -- "${1:- (%s)}" "$status"
+}
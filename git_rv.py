@@ -25,12 +25,21 @@ import sys
 
 from upload import parser as UPLOAD_PARSER
 
+from comments import CommentsAction
+from daemon import DaemonAction
 from export import ExportAction
+from garbage import GarbageCollectAction
 from getinfo import GetInfoAction
+from interdiff import InterdiffAction
 from mv_branch import RenameBranchAction
+from outbox import OutboxAction
+from patch import PatchAction
+from recover import RecoverAction
 from rm_branch import DeleteBranchAction
+from status import StatusAction
 from submit import SubmitAction
 from sync import SyncAction
+from wait import WaitAction
 import utils
 
 
@@ -160,6 +169,42 @@ def get_parser():
             prog='git-rv', description='git-rv Rietveld interface')
     subparsers = parser.add_subparsers(help='git-rv commands')
 
+    # Comments
+    parser_comments = subparsers.add_parser(
+            utils.COMMENTS,
+            help='Print new messages in the current review.')
+    parser_comments.set_defaults(callback=CommentsAction.callback)
+
+    parser_comments.add_argument(
+            '--all', action='store_true', dest='show_all',
+            help='Print all messages, including those seen before.')
+    parser_comments.add_argument(
+            '--inline', action='store_true', dest='inline',
+            help='Also print the inline comments on the latest patch set, at '
+                 'their lines in the working tree.')
+
+    # Daemon
+    parser_daemon = subparsers.add_parser(
+            utils.DAEMON,
+            help='Keep review metadata for all branches cached locally.')
+    parser_daemon.set_defaults(callback=DaemonAction.callback)
+
+    parser_daemon.add_argument(
+            '--interval', type=int, default=300, dest='interval',
+            help='Seconds between refreshes of all reviews. Defaults to '
+                 '%(default)s.')
+    parser_daemon.add_argument(
+            '--min_delay', type=float, default=1.0, dest='min_delay',
+            help='Minimum seconds between requests to the code review '
+                 'server. Defaults to %(default)s.')
+    parser_daemon.add_argument('--once', action='store_true', dest='once',
+                               help='Refresh all reviews once and exit.')
+    parser_daemon.add_argument('--detach', action='store_true', dest='detach',
+                               help='Run the daemon in the background.')
+    parser_daemon.add_argument('--stop', action='store_true', dest='stop',
+                               help='Stop the daemon running in this '
+                                    'repository.')
+
     # Export
     parser_export = subparsers.add_parser(utils.EXPORT, help='Export changes.')
     parser_export.set_defaults(callback=ExportAction.callback)
@@ -178,6 +223,33 @@ def get_parser():
     # Add argument(s) unique to export
     parser_export.add_argument('--no_mail', action='store_true', dest='no_mail',
                                help='Don\'t send e-mail for this export.')
+    parser_export.add_argument(
+            utils.PARENT_ARG, dest='parent_branch', metavar='BRANCH',
+            help='Stack a new review on the review in BRANCH, so only the '
+                 'changes since its last export are reviewed.')
+    parser_export.add_argument(
+            utils.SKIP_PRESUBMIT_ARG, action='store_true',
+            dest='skip_presubmit',
+            help='Don\'t run the presubmit checks before exporting.')
+    parser_export.add_argument(
+            utils.FULL_DIFF_ARG, action='store_true', dest='full_diff',
+            help='If the branch is not in a clean state, show the full diff '
+                 'through the pager rather than a summary.')
+
+    # Garbage Collect
+    parser_gc = subparsers.add_parser(
+            utils.GC,
+            help='Remove review metadata and branches which are no longer '
+                 'needed.')
+    parser_gc.set_defaults(callback=GarbageCollectAction.callback)
+
+    parser_gc.add_argument(
+            '--closed', action='store_true', dest='check_closed',
+            help='Also remove the review metadata of branches whose issues '
+                 'are closed on the code review server.')
+    parser_gc.add_argument(
+            '--dry_run', action='store_true', dest='dry_run',
+            help='Only print what would be removed.')
 
     # Get Info
     parser_getinfo = subparsers.add_parser(
@@ -188,6 +260,20 @@ def get_parser():
             '-p', '--pull-metadata', action='store_true', dest='pull',
             help='Pull metadata updates from code review server.')
 
+    # Interdiff
+    parser_interdiff = subparsers.add_parser(
+            utils.INTERDIFF,
+            help='Show the changes between two exported patch sets.')
+    parser_interdiff.set_defaults(callback=InterdiffAction.callback)
+
+    parser_interdiff.add_argument(
+            'patchsets', nargs=2, type=int, metavar='PATCHSET',
+            help='The patch sets to compare, oldest first.')
+    parser_interdiff.add_argument(
+            '--issue', type=int, dest='issue',
+            help='Issue to compare patch sets of. Defaults to the issue in '
+                 'review in the current branch.')
+
     # Rename Branch
     parser_mv_branch = subparsers.add_parser(
             utils.MV_BRANCH, help='Rename a Rietveld review branch.')
@@ -199,6 +285,63 @@ def get_parser():
             'branches', nargs=2,
             help='Current branch name and desired new name.')
 
+    # Outbox
+    parser_outbox = subparsers.add_parser(
+            utils.OUTBOX,
+            help='List or send pending updates to the code review server.')
+    parser_outbox.set_defaults(callback=OutboxAction.callback)
+
+    parser_outbox.add_argument('--flush', action='store_true', dest='flush',
+                               help='Send pending updates now.')
+    parser_outbox.add_argument('--retry', action='store_true', dest='retry',
+                               help='Retry failed updates with backoff.')
+    parser_outbox.add_argument(
+            '--no_prompt', action='store_true', dest='no_prompt',
+            help='Only use cached credentials; keep updates which need a new '
+                 'sign in instead of asking for one.')
+
+    # Patch
+    parser_patch = subparsers.add_parser(
+            utils.PATCH,
+            help='Download a patch set of a review into a new branch.')
+    parser_patch.set_defaults(callback=PatchAction.callback)
+
+    parser_patch.add_argument('issue', type=int,
+                              help='Issue to download a patch set of.')
+    parser_patch.add_argument(
+            '--patchset', type=int, dest='patchset',
+            help='Patch set to download. Defaults to the latest patch set.')
+    parser_patch.add_argument(
+            '--branch', dest='branch',
+            help='Name of the branch to create. Defaults to issue-{ISSUE}.')
+    parser_patch.add_argument(
+            '--base', dest='base',
+            help='Commit to apply the patch set onto. Defaults to the base '
+                 'archived for the patch set, or HEAD in the remote branch.')
+    parser_patch.add_argument(
+            '-s', '--server', default=utils.CODE_REVIEW, dest='server',
+            help='The code review server hosting the issue. Defaults to '
+                 '%(default)s.')
+
+    # Recover
+    parser_recover = subparsers.add_parser(
+            utils.RECOVER,
+            help='Finish or undo an interrupted submit or sync.')
+    parser_recover.set_defaults(callback=RecoverAction.callback)
+
+    parser_recover.add_argument(
+            'branch', nargs='?',
+            help='Branch the command was interrupted in. Only needed if '
+                 'commands were interrupted in more than one branch.')
+    recover_group = parser_recover.add_mutually_exclusive_group()
+    recover_group.add_argument(
+            '--forward', action='store_true', dest='forward',
+            help='Finish the interrupted command without redoing the steps '
+                 'which completed.')
+    recover_group.add_argument(
+            '--abort', action='store_true', dest='abort',
+            help='Undo the interrupted command and restore the branch.')
+
     # Delete Branch
     parser_rm_branch = subparsers.add_parser(
             utils.RM_BRANCH, help='Remove a Rietveld review branch.')
@@ -215,6 +358,14 @@ def get_parser():
                              'group.' % (review_server_option_group.title,
                                          REVIEW_SERVER_OPTIONS))
 
+    # Status
+    status_help = ('Show whether the current review needs to be exported, '
+                   'synced or is ready to submit, without contacting the '
+                   'code review server.')
+    parser_status = subparsers.add_parser(utils.STATUS_COMMAND,
+                                          help=status_help)
+    parser_status.set_defaults(callback=StatusAction.callback)
+
     # Submit
     parser_submit = subparsers.add_parser(
             utils.SUBMIT, help='Submit reviewed changes to remote repository.')
@@ -229,6 +380,31 @@ def get_parser():
     parser_submit.add_argument('--leave_open', action='store_false',
                                dest='do_close',
                                help='Don\'t close the issue when submitting.')
+    parser_submit.add_argument(
+            '--push_retries', type=int, default=0, dest='push_retries',
+            help='Number of times to retry a failed push. If the push was '
+                 'rejected because the remote branch moved, the squashed '
+                 'commit is rebuilt on it if it applies cleanly. Defaults to '
+                 '%(default)s.')
+    parser_submit.add_argument(
+            '--queue', nargs='+', metavar='BRANCH', dest='queue',
+            help='Submit several approved review branches in order, each on '
+                 'top of the one before it. All must be reviewed against the '
+                 'same remote branch.')
+    parser_submit.add_argument(
+            '--dry_run', action='store_true', dest='dry_run',
+            help='Report the squashed commit message, the size of the push, '
+                 'whether it would fast-forward and the requests to the '
+                 'code review server, without changing anything. Can\'t be '
+                 'combined with --queue.')
+    parser_submit.add_argument(
+            utils.SKIP_PRESUBMIT_ARG, action='store_true',
+            dest='skip_presubmit',
+            help='Don\'t run the presubmit checks before submitting.')
+    parser_submit.add_argument(
+            utils.FULL_DIFF_ARG, action='store_true', dest='full_diff',
+            help='If the branch is not in a clean state, show the full diff '
+                 'through the pager rather than a summary.')
 
     # TODO(dhermes): Add --no_squash flag and use it correctly.
 
@@ -249,5 +425,56 @@ def get_parser():
                              help='Continue sync after resolving conflicts.')
     parser_sync.add_argument('--no_mail', action='store_true', dest='no_mail',
                              help='Don\'t send e-mail for this sync.')
+    parser_sync.add_argument(
+            utils.STACK_ARG, action='store_true', dest='stack',
+            help='Sync the current branch and every review it is stacked on, '
+                 'from the bottom up, exporting only the reviews which '
+                 'changed.')
+    parser_sync.add_argument(
+            '--dry_run', action='store_true', dest='dry_run',
+            help='Report the files the merge would rewrite, the size of the '
+                 'export and the requests to the code review server, without '
+                 'fetching, merging or uploading anything.')
+    parser_sync.add_argument(
+            utils.FULL_DIFF_ARG, action='store_true', dest='full_diff',
+            help='If the branch is not in a clean state, show the full diff '
+                 'through the pager rather than a summary.')
+
+    # Wait
+    parser_wait = subparsers.add_parser(
+            utils.WAIT, help='Wait for reviews to be approved.')
+    parser_wait.set_defaults(callback=WaitAction.callback)
+
+    # Add review server option subgroup for submitting approved branches
+    _copy_optparse_option_group(
+            review_server_option_group, parser_wait,
+            ignored_destinations=REVIEW_SERVER_IGNORED_OPTIONS)
+
+    # Add argument(s) unique to wait
+    parser_wait.add_argument(
+            'branches', nargs='*', metavar='BRANCH',
+            help='Review branches to wait for. Defaults to the current '
+                 'branch.')
+    parser_wait.add_argument(
+            '--submit', action='store_true', dest='submit',
+            help='Submit each branch as soon as its review is approved.')
+    parser_wait.add_argument('--leave_open', action='store_false',
+                             dest='do_close',
+                             help='Don\'t close issues when submitting.')
+    parser_wait.add_argument(
+            utils.SKIP_PRESUBMIT_ARG, action='store_true',
+            dest='skip_presubmit',
+            help='Don\'t run the presubmit checks when submitting.')
+    parser_wait.add_argument(
+            '--min_interval', type=float, default=30.0, dest='min_interval',
+            help='Seconds between polls of a review which just changed. '
+                 'Defaults to %(default)s.')
+    parser_wait.add_argument(
+            '--max_interval', type=float, default=600.0, dest='max_interval',
+            help='Maximum seconds between polls of a review. Defaults to '
+                 '%(default)s.')
+    parser_wait.add_argument(
+            '--timeout', type=float, dest='timeout',
+            help='Seconds to wait before giving up. Defaults to no limit.')
 
     return parser
@@ -0,0 +1,645 @@
+# Copyright 2013 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Read-only access to refs and config without starting a git process.
+
+Reads HEAD, loose refs, packed-refs and the repository config file directly,
+which takes microseconds rather than the milliseconds needed to start git.
+Only the common repository layout is supported: a ".git" directory or a
+worktree ".git" file, the files ref backend, SHA-1 object names and config
+files using at most "include.path". Anything else raises UnsupportedLayout,
+and callers should ask git instead.
+"""
+
+
+from __future__ import with_statement
+
+import mmap
+import os
+import re
+
+
+COMMONDIR = 'commondir'
+CONFIG = 'config'
+DOT_GIT = '.git'
+GITDIR_PREFIX = 'gitdir:'
+HEAD = 'HEAD'
+HEADS_PREFIX = 'refs/heads/'
+# Include files nested deeper than this are treated as unsupported, as git
+# treats them as an error.
+MAX_INCLUDE_DEPTH = 10
+# Symbolic refs nested deeper than this are treated as unsupported.
+MAX_SYMREF_DEPTH = 5
+PACKED_REFS = 'packed-refs'
+PACKED_REFS_SORTED_TRAIT = 'sorted'
+PACKED_REFS_HEADER = '# pack-refs with:'
+# Refs which belong to a worktree rather than to the whole repository.
+PER_WORKTREE_PREFIXES = ('refs/bisect/', 'refs/rewritten/', 'refs/worktree/')
+REFTABLE = 'reftable'
+SYMREF_PREFIX = 'ref:'
+# These change where or how git finds the repository and its config.
+UNSUPPORTED_ENVIRONMENT = ('GIT_CEILING_DIRECTORIES', 'GIT_COMMON_DIR',
+                           'GIT_CONFIG', 'GIT_CONFIG_COUNT',
+                           'GIT_CONFIG_PARAMETERS',
+                           'GIT_DISCOVERY_ACROSS_FILESYSTEM', 'GIT_DIR',
+                           'GIT_NAMESPACE', 'GIT_WORK_TREE')
+
+# The rules git uses to expand a short name into a ref, in order.
+DWIM_RULES = ('%s', 'refs/%s', 'refs/tags/%s', 'refs/heads/%s',
+              'refs/remotes/%s', 'refs/remotes/%s/HEAD')
+HASH_REGEX = re.compile('^[0-9a-f]{40}$')
+# Repository settings which change how refs and config are read, and the
+# values which don't.
+FALSE_VALUES = ('false', 'no', 'off', '0', '')
+SUPPORTED_CONFIG_VALUES = (
+    ('core.bare', FALSE_VALUES),
+    ('core.worktree', ()),
+    ('extensions.objectformat', ('sha1',)),
+    ('extensions.refstorage', ('files',)),
+    ('extensions.worktreeconfig', FALSE_VALUES),
+)
+# Characters which make a revision more than a plain ref name.
+REVISION_SYNTAX_REGEX = re.compile(r'[\s~^:?*\[\\]|\.\.|@\{|^-|^$')
+TOP_LEVEL_REF_REGEX = re.compile('^[A-Z_]+$')
+VARIABLE_NAME_REGEX = re.compile('^[A-Za-z][A-Za-z0-9-]*$')
+
+_REPOSITORY_CACHE = []
+# Maps a config file path to a tuple of the stat signature of each file read
+# and the parsed values.
+_CONFIG_CACHE = {}
+
+
+class UnsupportedLayout(Exception):
+    """Raised when the repository can't be read without git."""
+
+
+def _read_file(path):
+    """Reads a small file, or returns None if it does not exist.
+
+    Args:
+        path: String; the path of the file.
+
+    Returns:
+        String containing the contents of the file, or None if it can't be
+            read as a file.
+    """
+    try:
+        with open(path, 'rb') as fh:
+            return fh.read()
+    except IOError:
+        return None
+
+
+def _find_repository():
+    """Finds the work tree and git directories for the current directory.
+
+    Returns:
+        Tuple of strings containing the absolute paths of the work tree, the
+            git directory of the worktree and the common git directory.
+
+    Raises:
+        UnsupportedLayout: If the repository is found in a way this module
+            does not implement, e.g. via environment variables, from inside a
+            git directory or in a repository owned by another user.
+    """
+    for name in UNSUPPORTED_ENVIRONMENT:
+        if name in os.environ:
+            raise UnsupportedLayout('%s is set.' % (name,))
+
+    current = os.getcwd()
+    if DOT_GIT in current.split(os.sep):
+        raise UnsupportedLayout('Inside a git directory.')
+
+    while True:
+        dot_git = os.path.join(current, DOT_GIT)
+        if os.path.isdir(dot_git):
+            git_dir = dot_git
+            break
+        elif os.path.isfile(dot_git):
+            contents = _read_file(dot_git) or ''
+            if not contents.startswith(GITDIR_PREFIX):
+                raise UnsupportedLayout('Invalid .git file.')
+            git_dir = os.path.join(
+                    current, contents[len(GITDIR_PREFIX):].strip())
+            break
+
+        parent = os.path.dirname(current)
+        if parent == current:
+            raise UnsupportedLayout('Not in a git repository.')
+        current = parent
+
+    git_dir = os.path.normpath(git_dir)
+    if not os.path.isfile(os.path.join(git_dir, HEAD)):
+        raise UnsupportedLayout('No HEAD in %r.' % (git_dir,))
+    # git refuses to work in repositories owned by other users unless they
+    # are marked safe, which is left for git to decide.
+    if os.stat(current).st_uid != os.getuid():
+        raise UnsupportedLayout('Work tree owned by another user.')
+
+    common_dir = git_dir
+    commondir = _read_file(os.path.join(git_dir, COMMONDIR))
+    if commondir is not None:
+        common_dir = os.path.normpath(
+                os.path.join(git_dir, commondir.strip()))
+
+    if os.path.isdir(os.path.join(common_dir, REFTABLE)):
+        raise UnsupportedLayout('Repository uses reftable.')
+    return current, git_dir, common_dir
+
+
+def get_repository():
+    """Gets the work tree and git directories for the current directory.
+
+    The value is cached since it can't change during a single git-rv command.
+    The repository config is also checked for settings which change how refs
+    and config must be read.
+
+    Returns:
+        Tuple of strings containing the absolute paths of the work tree, the
+            git directory of the worktree and the common git directory.
+
+    Raises:
+        UnsupportedLayout: If the repository can't be read without git.
+    """
+    if not _REPOSITORY_CACHE:
+        repository = _find_repository()
+        # Only local values matter here, since these can't be set globally.
+        values = _get_config_values(os.path.join(repository[2], CONFIG))
+        for key, supported_values in SUPPORTED_CONFIG_VALUES:
+            if key not in values:
+                continue
+            # A key without a value is true.
+            value = values[key]
+            if value is None or value.lower() not in supported_values:
+                raise UnsupportedLayout('%s is set to %r.' % (key, value))
+        _REPOSITORY_CACHE.append(repository)
+    return _REPOSITORY_CACHE[0]
+
+
+def _find_packed_ref(data, ref, start):
+    """Binary searches sorted packed-refs records for a ref.
+
+    Records are "<hash> <ref>" lines, each possibly followed by a "^<hash>"
+    line with the commit a tag points to. Lines have different lengths, so
+    each probe backs up to the start of the line containing it.
+
+    Args:
+        data: A string or mmap.mmap object containing the packed-refs file.
+        ref: String; the full name of a ref.
+        start: Integer; the offset of the first record, after the header.
+
+    Returns:
+        String containing the hash of the ref, or None if it is not packed.
+    """
+    low = start
+    high = len(data)
+    while low < high:
+        middle = (low + high) // 2
+        newline = data.rfind('\n', low, middle)
+        line_start = low if newline < 0 else newline + 1
+
+        # Peeled lines belong to the record before them, so move past them.
+        record_start = line_start
+        while record_start < high and data[record_start] == '^':
+            newline = data.find('\n', record_start, high)
+            record_start = high if newline < 0 else newline + 1
+        if record_start >= high:
+            high = line_start
+            continue
+
+        record_end = data.find('\n', record_start, high)
+        if record_end < 0:
+            record_end = high
+        record = data[record_start:record_end]
+        record_ref = record[41:]
+        if record_ref == ref:
+            return record[:40]
+        elif record_ref < ref:
+            low = record_end + 1
+        else:
+            high = record_start
+    return None
+
+
+def read_packed_ref(common_dir, ref):
+    """Reads a ref from packed-refs.
+
+    The file is memory mapped and binary searched if git has marked it as
+    sorted (which it has since 2.x), otherwise it is scanned.
+
+    Args:
+        common_dir: String; the common git directory of the repository.
+        ref: String; the full name of a ref.
+
+    Returns:
+        String containing the hash of the ref, or None if it is not packed.
+    """
+    try:
+        fh = open(os.path.join(common_dir, PACKED_REFS), 'rb')
+    except IOError:
+        return None
+
+    with fh:
+        if os.fstat(fh.fileno()).st_size == 0:
+            return None
+        data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            start = 0
+            sorted_records = False
+            if data[:len(PACKED_REFS_HEADER)] == PACKED_REFS_HEADER:
+                start = data.find('\n') + 1
+                traits = data[len(PACKED_REFS_HEADER):start].split()
+                sorted_records = PACKED_REFS_SORTED_TRAIT in traits
+
+            if sorted_records:
+                return _find_packed_ref(data, ref, start)
+
+            data.seek(start)
+            for line in iter(data.readline, ''):
+                if line.startswith('^') or line.startswith('#'):
+                    continue
+                if line[41:].rstrip('\n') == ref:
+                    return line[:40]
+            return None
+        finally:
+            data.close()
+
+
+def read_ref(ref, depth=0):
+    """Reads the hash of a ref, following symbolic refs.
+
+    Loose refs are checked before packed-refs, as git does.
+
+    Args:
+        ref: String; the full name of a ref, e.g. refs/heads/master, or HEAD.
+        depth: Integer; the number of symbolic refs followed so far. Defaults
+            to 0.
+
+    Returns:
+        String containing the hash of the ref, or None if it does not exist.
+
+    Raises:
+        UnsupportedLayout: If the repository can't be read without git, or the
+            ref can't be read as git would.
+    """
+    _, git_dir, common_dir = get_repository()
+    if depth > MAX_SYMREF_DEPTH:
+        raise UnsupportedLayout('Symbolic ref %r nested too deeply.' % (ref,))
+    if '..' in ref or ref.startswith('/'):
+        raise UnsupportedLayout('Invalid ref name %r.' % (ref,))
+
+    if ref == HEAD or ref.startswith(PER_WORKTREE_PREFIXES):
+        ref_dir = git_dir
+    else:
+        ref_dir = common_dir
+
+    value = _read_file(os.path.join(ref_dir, ref))
+    if value is not None:
+        value = value.strip()
+        if value.startswith(SYMREF_PREFIX):
+            return read_ref(value[len(SYMREF_PREFIX):].strip(),
+                            depth=depth + 1)
+        elif HASH_REGEX.match(value) is None:
+            raise UnsupportedLayout('Unexpected contents in %r.' % (ref,))
+        return value
+
+    if ref == HEAD:
+        return None
+    return read_packed_ref(common_dir, ref)
+
+
+def _dwim_refs(name):
+    """Gets the refs git would try for a short name, in order.
+
+    Like git, only all-caps names (such as HEAD) are looked up at the top of
+    the git directory.
+
+    Args:
+        name: String; a ref name such as master or origin/master.
+
+    Returns:
+        List of strings, each the full name of a ref.
+    """
+    refs = []
+    for rule in DWIM_RULES:
+        if (rule == '%s' and not name.startswith('refs/') and
+            TOP_LEVEL_REF_REGEX.match(name) is None):
+            continue
+        refs.append(rule % (name,))
+    return refs
+
+
+def resolve_revision(name):
+    """Resolves a plain ref name as "git rev-parse" would.
+
+    The rules git uses to expand a short name are tried in order, e.g.
+    "master" is looked up as refs/tags/master before refs/heads/master.
+
+    Args:
+        name: String; a ref name such as HEAD, master, origin/master or
+            refs/heads/master.
+
+    Returns:
+        String containing the hash the name resolves to, or None if it is not a
+            plain ref name or does not name a ref. In either case, git may
+            still be able to resolve it.
+
+    Raises:
+        UnsupportedLayout: If the repository can't be read without git.
+    """
+    if REVISION_SYNTAX_REGEX.search(name) is not None:
+        return None
+
+    for ref in _dwim_refs(name):
+        value = read_ref(ref)
+        if value is not None:
+            return value
+    return None
+
+
+def get_current_branch():
+    """Gets the name of the current branch from HEAD.
+
+    Returns:
+        String containing the short name of the current branch, or "HEAD" if
+            HEAD is detached, matching "git rev-parse --abbrev-ref HEAD".
+
+    Raises:
+        UnsupportedLayout: If the repository can't be read without git, the
+            current branch has no commits yet, or its short name is ambiguous
+            (in which case git abbreviates it differently).
+    """
+    _, git_dir, _ = get_repository()
+    value = (_read_file(os.path.join(git_dir, HEAD)) or '').strip()
+    if HASH_REGEX.match(value) is not None:
+        return HEAD
+    if not value.startswith(SYMREF_PREFIX):
+        raise UnsupportedLayout('Unexpected contents in HEAD.')
+
+    ref = value[len(SYMREF_PREFIX):].strip()
+    if not ref.startswith(HEADS_PREFIX) or read_ref(ref) is None:
+        raise UnsupportedLayout('HEAD is not a branch with commits.')
+    branch = ref[len(HEADS_PREFIX):]
+
+    for other_ref in _dwim_refs(branch):
+        if other_ref != ref and read_ref(other_ref) is not None:
+            raise UnsupportedLayout('Branch name %r is ambiguous.' % (branch,))
+    return branch
+
+
+def _unquote_subsection(value):
+    """Unescapes a quoted subsection name from a section header.
+
+    Args:
+        value: String; the text between the quotes.
+
+    Returns:
+        String containing the subsection name.
+    """
+    return re.sub(r'\\(.)', r'\1', value)
+
+
+def _parse_value(line, index, lines):
+    """Parses a config value, which may continue onto the following lines.
+
+    Follows git: whitespace outside quotes is collapsed to single spaces and
+    trailing whitespace is dropped, comments end the value and a backslash at
+    the end of a line continues the value on the next line.
+
+    Args:
+        line: String; the rest of the line after the "=".
+        index: Integer; the index of the next line in lines.
+        lines: List of strings; the lines of the config file.
+
+    Returns:
+        Tuple of the value and the index of the line after it.
+
+    Raises:
+        UnsupportedLayout: If the value contains an invalid escape or an
+            unterminated quote.
+    """
+    escapes = {'n': '\n', 't': '\t', 'b': '\b', '"': '"', '\\': '\\'}
+    value = []
+    pending_spaces = 0
+    in_quote = False
+    position = 0
+    while True:
+        if position >= len(line):
+            if in_quote:
+                raise UnsupportedLayout('Unterminated quote in config value.')
+            return ''.join(value), index
+
+        char = line[position]
+        position += 1
+        if char == '\n':
+            if in_quote:
+                raise UnsupportedLayout('Unterminated quote in config value.')
+            return ''.join(value), index
+        elif not in_quote and char in ';#':
+            return ''.join(value), index
+        elif not in_quote and char.isspace():
+            # Leading whitespace is dropped.
+            if any(value):
+                pending_spaces += 1
+            continue
+
+        value.append(' ' * pending_spaces)
+        pending_spaces = 0
+        if char == '"':
+            in_quote = not in_quote
+        elif char == '\\':
+            escaped = line[position:position + 1]
+            position += 1
+            if escaped == '\n':
+                # Line continuation.
+                if index >= len(lines):
+                    return ''.join(value), index
+                line = lines[index]
+                index += 1
+                position = 0
+            elif escaped in escapes:
+                value.append(escapes[escaped])
+            else:
+                raise UnsupportedLayout('Invalid escape in config value.')
+        else:
+            value.append(char)
+
+
+def _parse_config(path, values, signature, depth=0):
+    """Parses a config file, and the files it includes, into values.
+
+    Args:
+        path: String; the path of the config file.
+        values: Dictionary mapping each key (with the section and variable
+            names in lower case) to its last value, updated in place.
+        signature: List of stat signatures of the files read, updated in
+            place.
+        depth: Integer; the number of includes followed so far. Defaults to 0.
+
+    Raises:
+        UnsupportedLayout: If the file uses syntax this parser does not
+            implement, such as "includeIf".
+    """
+    if depth > MAX_INCLUDE_DEPTH:
+        raise UnsupportedLayout('Config includes nested too deeply.')
+
+    try:
+        with open(path, 'rb') as fh:
+            signature.append((path, _stat_signature(fh.fileno())))
+            lines = fh.readlines()
+    except IOError:
+        signature.append((path, None))
+        return
+
+    section = None
+    index = 0
+    while index < len(lines):
+        line = lines[index].lstrip()
+        index += 1
+        if not line or line[0] in ';#':
+            continue
+
+        if line.startswith('['):
+            match = re.match(r'\[\s*([A-Za-z0-9.-]+)\s*(?:"((?:[^"\\]|\\.)*)")?'
+                             r'\s*\]', line)
+            if match is None:
+                raise UnsupportedLayout('Unexpected config section %r.' %
+                                        (line.rstrip(),))
+            name, subsection = match.groups()
+            if subsection is not None:
+                section = '%s.%s' % (name.lower(),
+                                     _unquote_subsection(subsection))
+            else:
+                # Also covers the deprecated [section.subsection] syntax, in
+                # which the subsection is lower cased too.
+                section = name.lower()
+            if section.startswith('includeif.'):
+                raise UnsupportedLayout('Config uses includeIf.')
+            line = line[match.end():].lstrip()
+            if not line or line[0] in ';#':
+                continue
+
+        match = re.match(r'([A-Za-z][A-Za-z0-9-]*)\s*(=?)', line)
+        if match is None or section is None:
+            raise UnsupportedLayout('Unexpected config line %r.' %
+                                    (line.rstrip(),))
+        name, equals = match.groups()
+        rest = line[match.end():]
+        if equals:
+            value, index = _parse_value(rest, index, lines)
+        elif rest.strip() and rest.strip()[0] not in ';#':
+            raise UnsupportedLayout('Unexpected config line %r.' %
+                                    (line.rstrip(),))
+        else:
+            # A variable without a value, which git treats as true.
+            value = None
+
+        key = '%s.%s' % (section, name.lower())
+        if key == 'include.path':
+            if value is None:
+                raise UnsupportedLayout('Config include without a path.')
+            include_path = os.path.expanduser(value)
+            include_path = os.path.join(os.path.dirname(path), include_path)
+            # git also reports the include itself as a value.
+            values[key] = value
+            _parse_config(include_path, values, signature, depth=depth + 1)
+        else:
+            values[key] = value
+
+
+def _stat_signature(fd_or_path):
+    """Gets a signature which changes whenever git rewrites a file.
+
+    git writes config files to a lock file and renames it into place, so the
+    inode changes as well as the modification time and size.
+
+    Args:
+        fd_or_path: An open file descriptor or the path of a file.
+
+    Returns:
+        Tuple of the inode, modification time and size of the file, or None
+            if it does not exist.
+    """
+    try:
+        if isinstance(fd_or_path, int):
+            stat = os.fstat(fd_or_path)
+        else:
+            stat = os.stat(fd_or_path)
+    except OSError:
+        return None
+    return (stat.st_ino, stat.st_mtime, stat.st_size)
+
+
+def _get_config_values(path):
+    """Gets the parsed values of a config file, re-reading it if it changed.
+
+    Args:
+        path: String; the path of the config file.
+
+    Returns:
+        Dictionary mapping each key (with the section and variable names in
+            lower case) to its last value.
+
+    Raises:
+        UnsupportedLayout: If the file uses syntax the parser does not
+            implement.
+    """
+    cached = _CONFIG_CACHE.get(path)
+    if cached is not None:
+        signature, values = cached
+        if all(_stat_signature(file_path) == file_signature
+               for file_path, file_signature in signature):
+            return values
+
+    values = {}
+    signature = []
+    _parse_config(path, values, signature)
+    _CONFIG_CACHE[path] = (signature, values)
+    return values
+
+
+def get_config_value(key):
+    """Gets the value of a key from the repository config file.
+
+    Only the repository's own config (and the files it includes) is read, so
+    a missing key may still be set in the global or system config.
+
+    Args:
+        key: String; the name of a config key, e.g. remote.origin.url.
+
+    Returns:
+        String containing the last value set for the key, or None if it is not
+            set in the repository config.
+
+    Raises:
+        UnsupportedLayout: If the repository or its config can't be read
+            without git, the key is not valid or is set without a value.
+    """
+    _, _, common_dir = get_repository()
+    if '.' not in key:
+        raise UnsupportedLayout('Invalid config key %r.' % (key,))
+    section, _, name = key.rpartition('.')
+    if VARIABLE_NAME_REGEX.match(name) is None:
+        raise UnsupportedLayout('Invalid config key %r.' % (key,))
+    section_name, dot, subsection = section.partition('.')
+    normalized_key = '%s%s%s.%s' % (section_name.lower(), dot, subsection,
+                                    name.lower())
+
+    values = _get_config_values(os.path.join(common_dir, CONFIG))
+    if normalized_key not in values:
+        return None
+    value = values[normalized_key]
+    if value is None:
+        raise UnsupportedLayout('Config key %r has no value.' % (key,))
+    return value
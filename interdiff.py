@@ -0,0 +1,162 @@
+# Copyright 2013 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Interdiff command for git-rv command line tool.
+
+Shows the changes between two patch sets of a review. Every export archives
+the commits of the new patch set under refs/rv/{issue}/, so the interdiff is
+computed locally without any requests to the code review server.
+"""
+
+
+import subprocess
+
+import utils
+
+
+class InterdiffAction(object):
+    """A state machine which shows the changes between two patch sets.
+
+    Attributes:
+        state: The current state of the InterdiffAction state machine.
+        __old_patchset: Integer; the ID of the patch set to compare from.
+        __new_patchset: Integer; the ID of the patch set to compare to.
+        __issue: Integer; the ID of the code review issue, or None to use the
+            issue in review in the current branch.
+    """
+
+    FIND_PATCHSETS = 0
+    SHOW_INTERDIFF = 1
+    FINISHED = 2
+
+    def __init__(self, old_patchset, new_patchset, issue=None):
+        """Constructor for InterdiffAction.
+
+        Args:
+            old_patchset: Integer; the ID of the patch set to compare from.
+            new_patchset: Integer; the ID of the patch set to compare to.
+            issue: Integer; the ID of the code review issue. Defaults to None,
+                in which case the issue in review in the current branch is
+                used.
+        """
+        self.__old_patchset = old_patchset
+        self.__new_patchset = new_patchset
+        self.__issue = issue
+        self.state = self.FIND_PATCHSETS
+        self.advance()
+
+    @classmethod
+    def callback(cls, args, unused_argv):
+        """A callback to begin an InterdiffAction after arguments are parsed.
+
+        Args:
+            args: An argparse.Namespace object to extract parameters from.
+            unused_argv: The original command line arguments that were parsed
+                to create args. These are unused.
+
+        Returns:
+            An instance of InterdiffAction. Just by instantiating the instance,
+                the state machine will begin working.
+        """
+        old_patchset, new_patchset = args.patchsets
+        return cls(old_patchset, new_patchset, issue=args.issue)
+
+    def find_patchsets(self):
+        """Finds the archived commits of both patch sets.
+
+        If both are archived, sets state to SHOW_INTERDIFF, otherwise notifies
+        the user and sets state to FINISHED. In either case, advances the state
+        machine.
+        """
+        next_state_kwargs = {}
+        self.state = self.FINISHED
+
+        issue = self.__issue
+        if issue is None:
+            branch = utils.get_current_branch()
+            rietveld_info = utils.RietveldInfo.from_branch(branch_name=branch)
+            if rietveld_info is None or rietveld_info.review_info is None:
+                print 'No review data found in branch %r.' % (branch,)
+                self.advance()
+                return
+            issue = rietveld_info.review_info.issue
+
+        patchsets = utils.get_patchsets(issue)
+        for patchset in (self.__old_patchset, self.__new_patchset):
+            if len(patchsets.get(patchset, ())) != 2:
+                print 'Patch set %d of issue %d is not archived locally.' % (
+                        patchset, issue)
+                if patchsets:
+                    print 'Archived patch sets: %s.' % (
+                            ', '.join(str(patchset_id) for patchset_id
+                                      in sorted(patchsets)),)
+                break
+        else:
+            next_state_kwargs['old_commits'] = patchsets[self.__old_patchset]
+            next_state_kwargs['new_commits'] = patchsets[self.__new_patchset]
+            self.state = self.SHOW_INTERDIFF
+
+        self.advance(**next_state_kwargs)
+
+    def show_interdiff(self, old_commits, new_commits):
+        """Shows the interdiff through the git pager.
+
+        If both patch sets were diffed against the same base, the interdiff is
+        the diff between the exported commits. Otherwise, as after a sync, the
+        old patch set is first merged onto the new base, so that the changes
+        made to the base in between are left out. Any conflicts in that merge
+        show up as conflict markers in the interdiff.
+
+        Sets state to FINISHED and advances the state machine.
+
+        Args:
+            old_commits: Dictionary with the PATCHSET_BASE and PATCHSET_HEAD
+                commit hashes of the patch set to compare from.
+            new_commits: Dictionary with the PATCHSET_BASE and PATCHSET_HEAD
+                commit hashes of the patch set to compare to.
+        """
+        old_tree = old_commits[utils.PATCHSET_HEAD]
+        new_base = new_commits[utils.PATCHSET_BASE]
+        if old_commits[utils.PATCHSET_BASE] != new_base:
+            old_tree = utils.merge_trees(new_base, old_tree,
+                                         keep_conflicts=True)
+
+        subprocess.call(['git', '--paginate', 'diff', old_tree,
+                         new_commits[utils.PATCHSET_HEAD]])
+
+        self.state = self.FINISHED
+        self.advance()
+
+    def advance(self, *args, **kwargs):
+        """Advances by calling the method corresponding to the current state.
+
+        Args:
+            *args: Arguments to be passed to the specified method based on
+                the current state.
+            **kwargs: Keyword arguments to be passed to the specified method
+                based on the current state.
+
+        Raises:
+            GitRvException: If this method is called and the state is not one
+                of the valid states.
+        """
+        if self.state == self.FIND_PATCHSETS:
+            self.find_patchsets(*args, **kwargs)
+        elif self.state == self.SHOW_INTERDIFF:
+            self.show_interdiff(*args, **kwargs)
+        elif self.state == self.FINISHED:
+            return
+        else:
+            raise utils.GitRvException('Unexpected state %r in '
+                                       'InterdiffAction.' % (self.state,))
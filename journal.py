@@ -0,0 +1,158 @@
+# Copyright 2013 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Write-ahead journal for git-rv commands which rewrite local state.
+
+Submit and sync move a branch through intermediate states (a detached HEAD, a
+temporary review branch, an uncommitted merge) before putting it back. Each of
+these states is recorded, along with the values needed to resume from it,
+before the state is entered. If the command is interrupted, the entry is left
+behind and "git rv recover" uses it to finish or undo the command.
+"""
+
+
+import os
+import time
+import urllib
+
+import utils
+
+
+ARGV = 'argv'
+COMMAND = 'command'
+DO_CLOSE = 'do_close'
+HEAD = 'head'
+JOURNAL_DIRECTORY = 'journal'
+PREVIOUS_LAST_SYNCED = 'previous_last_synced'
+REVIEW_BRANCH = 'review_branch'
+RPC_SERVER_ARGS = 'rpc_server_args'
+SQUASHED_COMMIT = 'squashed_commit'
+STATE = 'state'
+SUCCESS = 'success'
+UPDATED = 'updated'
+
+
+def _entry_path(branch):
+    """Gets the path of the journal entry for a branch.
+
+    Args:
+        branch: String; containing the name of a branch.
+
+    Returns:
+        String containing the path of the journal entry.
+    """
+    return utils.get_rv_path(JOURNAL_DIRECTORY,
+                             '%s.json' % (urllib.quote(branch, safe=''),))
+
+
+def _from_json(value):
+    """Converts the unicode strings loaded from a journal entry to str.
+
+    The entries are written from str values (such as branch names and
+    commit hashes), which is what the commands using them expect.
+
+    Args:
+        value: A value loaded from a journal entry.
+
+    Returns:
+        The value with unicode strings encoded as UTF-8, in dictionaries and
+            lists as well.
+    """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    elif isinstance(value, dict):
+        return dict((_from_json(key), _from_json(item))
+                    for key, item in value.iteritems())
+    elif isinstance(value, list):
+        return [_from_json(item) for item in value]
+    return value
+
+
+def record(entry):
+    """Durably writes a journal entry.
+
+    Should be called before the state recorded in the entry is entered.
+
+    Args:
+        entry: Dictionary containing the journal entry. Must contain the
+            branch, the command and the state being entered.
+    """
+    entry[UPDATED] = int(time.time())
+    utils.write_file_atomically(_entry_path(entry[utils.BRANCH]),
+                                utils.json.dumps(entry))
+
+
+def load(branch):
+    """Loads the journal entry for a branch.
+
+    Args:
+        branch: String; containing the name of a branch.
+
+    Returns:
+        Dictionary containing the journal entry, or None if no command was
+            interrupted in the branch.
+    """
+    try:
+        with open(_entry_path(branch), 'rb') as fh:
+            return _from_json(utils.json.load(fh))
+    except IOError:
+        return None
+
+
+def load_entries():
+    """Loads all journal entries.
+
+    Returns:
+        List of dictionaries, each a journal entry for a branch, sorted by
+            branch.
+    """
+    directory = os.path.dirname(_entry_path(''))
+    entries = []
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith('.json'):
+            continue
+        with open(os.path.join(directory, filename), 'rb') as fh:
+            entries.append(_from_json(utils.json.load(fh)))
+    return entries
+
+
+def clear(branch):
+    """Removes the journal entry for a branch, if there is one.
+
+    Args:
+        branch: String; containing the name of a branch.
+    """
+    path = _entry_path(branch)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def check_not_interrupted(branch):
+    """Checks that no command was left interrupted in a branch.
+
+    Args:
+        branch: String; containing the name of a branch.
+
+    Returns:
+        Boolean indicating whether a new command can be started in the branch.
+            If not, the user is told how to recover.
+    """
+    entry = load(branch)
+    if entry is None:
+        return True
+
+    print 'A "git rv %s" was interrupted in branch %r.' % (entry[COMMAND],
+                                                            branch)
+    print 'Run "git rv recover" to finish or undo it first.'
+    return False
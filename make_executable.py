@@ -36,14 +36,27 @@ ADD_SHEBANG = 'echo \'#!/usr/bin/env python\' | cat - git-rv > %s'
 COMPILE_ARGS = ['python', '-O', '-m', 'compileall']
 MODULE_MAPPING = {
     '__main__': '__main__',
+    'auth': 'auth',
+    'comments': 'comments',
+    'daemon': 'daemon',
     'export': 'export',
+    'garbage': 'garbage',
     'getinfo': 'getinfo',
+    'gitdir': 'gitdir',
     'git_rv': 'git_rv',
+    'interdiff': 'interdiff',
+    'journal': 'journal',
     'mv_branch': 'mv_branch',
+    'outbox': 'outbox',
+    'patch': 'patch',
+    'presubmit': 'presubmit',
+    'recover': 'recover',
     'rm_branch': 'rm_branch',
+    'status': 'status',
     'submit': 'submit',
     'sync': 'sync',
     'utils': 'utils',
+    'wait': 'wait',
     UPLOAD_PY_PATH: 'upload',
 }
 
@@ -0,0 +1,455 @@
+# Copyright 2013 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Outbox command for git-rv command line tool.
+
+Requests to the code review server which don't need to block a command (such
+as closing an issue after it has been submitted) are stored in a local outbox
+and sent in the background. This command lists and flushes pending requests.
+"""
+
+
+import errno
+import fcntl
+import os
+import subprocess
+import sys
+import time
+import urllib
+import urllib2
+
+from upload import GetRpcServer
+
+import auth
+import utils
+
+
+ATTEMPTS = 'attempts'
+DESCRIPTION = 'description'
+FAILURE_MESSAGE = 'failure_message'
+LAST_ERROR = 'last_error'
+OPERATIONS = 'operations'
+OUTBOX_DIRECTORY = 'outbox'
+OUTBOX_LOCK = 'outbox.lock'
+OUTBOX_LOG = 'outbox.log'
+RPC_SERVER_ARGS = 'rpc_server_args'
+URI = 'uri'
+VALUES = 'values'
+# Number of times a background flush tries to send an entry, and the number of
+# seconds it waits before the first retry (doubled after each failure).
+BACKGROUND_ATTEMPTS = 3
+RETRY_DELAY = 2
+# Outcomes of sending an entry. Entries which can't be sent without signing in
+# are kept but not retried.
+SENT = 0
+RETRY = 1
+KEPT = 2
+
+
+def _entry_path(issue):
+    """Gets the path of the outbox entry for an issue.
+
+    Args:
+        issue: Integer; containing an ID of a code review issue.
+
+    Returns:
+        String containing the path of the outbox entry.
+    """
+    return utils.get_rv_path(OUTBOX_DIRECTORY, '%d.json' % (issue,))
+
+
+def _save_entry(entry):
+    """Durably writes an outbox entry.
+
+    Args:
+        entry: Dictionary containing the outbox entry for an issue.
+    """
+    utils.write_file_atomically(_entry_path(entry[utils.ISSUE]),
+                                utils.json.dumps(entry))
+
+
+def load_entries():
+    """Loads all pending outbox entries.
+
+    Returns:
+        List of dictionaries, each an outbox entry for an issue, sorted by
+            issue.
+    """
+    directory = os.path.dirname(_entry_path(0))
+    entries = []
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith('.json'):
+            continue
+        with open(os.path.join(directory, filename), 'rb') as fh:
+            entries.append(utils.json.load(fh))
+    return entries
+
+
+def enqueue(issue, server, rpc_server_args, operations):
+    """Adds requests for an issue to the outbox.
+
+    If the issue already has pending requests, the new ones are sent after
+    them.
+
+    Args:
+        issue: Integer; containing an ID of a code review issue.
+        server: String; the address of the Rietveld server hosting the code
+            review.
+        rpc_server_args: A dictionary of arguments to be passed to
+            GetRpcServer when signing in to send the requests.
+        operations: List of dictionaries, each describing a POST request with
+            the URI, the form VALUES (not including the XSRF token), a
+            DESCRIPTION printed on success and a FAILURE_MESSAGE printed when
+            the request can't be sent.
+    """
+    try:
+        with open(_entry_path(issue), 'rb') as fh:
+            entry = utils.json.load(fh)
+    except IOError:
+        entry = {
+            utils.ISSUE: issue,
+            utils.SERVER: server,
+            RPC_SERVER_ARGS: rpc_server_args,
+            OPERATIONS: [],
+            ATTEMPTS: 0,
+        }
+    entry[OPERATIONS].extend(operations)
+    _save_entry(entry)
+
+
+def flush_in_background():
+    """Starts a detached git-rv process which flushes the outbox.
+
+    The process has no terminal to sign in from, so it only uses cached
+    credentials. The output of the process is appended to OUTBOX_LOG.
+    """
+    log_fd = os.open(utils.get_rv_path(OUTBOX_LOG),
+                     os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0600)
+    with open(os.devnull, 'rb') as null_fh:
+        subprocess.Popen([sys.executable, sys.argv[0], utils.OUTBOX,
+                          '--flush', '--retry', '--no_prompt'],
+                         stdin=null_fh, stdout=log_fd, stderr=log_fd,
+                         close_fds=True, preexec_fn=os.setsid)
+    os.close(log_fd)
+
+
+class OutboxAction(object):
+    """A state machine which lists or sends pending review server requests.
+
+    Attributes:
+        state: The current state of the OutboxAction state machine.
+        __flush: Boolean; indicating whether pending requests should be sent.
+        __retry: Boolean; indicating whether failed entries should be retried
+            with backoff during this flush.
+        __prompt: Boolean; indicating whether the user may be asked to sign
+            in. If not, entries are only sent with cached credentials.
+        __lock_fd: File descriptor holding the outbox lock while flushing, or
+            None.
+    """
+
+    LIST = 0
+    ACQUIRE_LOCK = 1
+    FLUSH = 2
+    FINISHED = 3
+
+    def __init__(self, flush=False, retry=False, prompt=True):
+        """Constructor for OutboxAction.
+
+        Args:
+            flush: Boolean; indicating whether pending requests should be
+                sent. Defaults to False.
+            retry: Boolean; indicating whether failed entries should be retried
+                with backoff during this flush. Defaults to False.
+            prompt: Boolean; indicating whether the user may be asked to sign
+                in. Defaults to True.
+        """
+        self.__flush = flush
+        self.__retry = retry
+        self.__prompt = prompt
+        self.__lock_fd = None
+        self.state = self.LIST
+        self.advance()
+
+    @classmethod
+    def callback(cls, args, unused_argv):
+        """A callback to begin an OutboxAction after arguments are parsed.
+
+        Args:
+            args: An argparse.Namespace object to extract parameters from.
+            unused_argv: The original command line arguments that were parsed
+                to create args. These are unused.
+
+        Returns:
+            An instance of OutboxAction. Just by instantiating the instance, the
+                state machine will begin working.
+        """
+        return cls(flush=args.flush, retry=args.retry,
+                   prompt=not args.no_prompt)
+
+    def list_entries(self):
+        """Prints the pending outbox entries.
+
+        If flushing and there are entries, sets state to ACQUIRE_LOCK,
+        otherwise to FINISHED. In either case, advances the state machine.
+        """
+        entries = load_entries()
+        if not entries:
+            print 'No pending requests to the code review server.'
+        for entry in entries:
+            print 'Issue %d on %s (%d failed attempt(s)):' % (
+                    entry[utils.ISSUE], entry[utils.SERVER], entry[ATTEMPTS])
+            for operation in entry[OPERATIONS]:
+                print '\t%s' % (operation[DESCRIPTION],)
+            if entry.get(LAST_ERROR):
+                print '\tLast error: %s' % (entry[LAST_ERROR],)
+
+        if self.__flush and entries:
+            self.state = self.ACQUIRE_LOCK
+        else:
+            self.state = self.FINISHED
+        self.advance()
+
+    def __try_lock(self):
+        """Tries to take the outbox lock without waiting.
+
+        The lock is an flock, so it is released if the flushing process dies.
+
+        Returns:
+            Boolean indicating whether the lock was taken.
+        """
+        lock_fd = os.open(utils.get_rv_path(OUTBOX_LOCK),
+                          os.O_WRONLY | os.O_CREAT, 0600)
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, exc:  # Syntax for python<2.6
+            os.close(lock_fd)
+            if exc.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            return False
+        self.__lock_fd = lock_fd
+        return True
+
+    def __release_lock(self):
+        """Releases the outbox lock."""
+        os.close(self.__lock_fd)
+        self.__lock_fd = None
+
+    def acquire_lock(self):
+        """Makes sure only one process flushes the outbox at a time.
+
+        If the lock is acquired, sets state to FLUSH, otherwise to FINISHED.
+        In either case, advances the state machine.
+        """
+        if self.__try_lock():
+            self.state = self.FLUSH
+        else:
+            print 'The outbox is already being flushed.'
+            self.state = self.FINISHED
+        self.advance()
+
+    def __get_xsrf_server(self, rpc_server_args):
+        """Gets an authenticated RPC server and XSRF token for API calls.
+
+        Args:
+            rpc_server_args: A dictionary of arguments to be passed to
+                GetRpcServer.
+
+        Returns:
+            Tuple rpc_server, xsrf_token where rpc_server is an authenticated
+                upload.HttpRpcServer instance and xsrf_token is a string used
+                to make API requests to the Rietveld server.
+
+        Raises:
+            SignInRequiredError: If the user may not be prompted and there are
+                no cached credentials for the server.
+        """
+        auth.install_access_token_cache(cached_only=not self.__prompt)
+        rpc_server = GetRpcServer(**rpc_server_args)
+        if not rpc_server.authenticated:
+            rpc_server._Authenticate()
+        xsrf_token = auth.get_xsrf_token(rpc_server,
+                                         rpc_server_args[utils.SERVER])
+        return rpc_server, xsrf_token
+
+    def __send_entry(self, entry):
+        """Sends the pending requests in an outbox entry.
+
+        Each request is removed from the entry (and the entry saved) as soon
+        as it succeeds, so a request is never sent twice. If the server rejects
+        a request with a 4xx status, it is sent once more with a freshly
+        fetched XSRF token, since Rietveld rejects a stale one with a 403. If
+        it is rejected again (for example because the issue is already
+        closed), sending it again won't help, so that request alone is dropped.
+        A rejected sign in is forgotten and the entry kept until the user can
+        sign in again.
+
+        Args:
+            entry: Dictionary containing the outbox entry for an issue.
+
+        Returns:
+            One of SENT, RETRY or KEPT.
+        """
+        server = entry[utils.SERVER]
+        try:
+            rpc_server, xsrf_token = self.__get_xsrf_server(
+                    entry[RPC_SERVER_ARGS])
+            fresh_xsrf_token = False
+            while entry[OPERATIONS]:
+                operation = entry[OPERATIONS][0]
+                values = dict(operation[VALUES])
+                values[utils.XSRF_TOKEN] = xsrf_token
+                try:
+                    rpc_server.Send(operation[URI],
+                                    payload=urllib.urlencode(values))
+                except urllib2.HTTPError, exc:  # Syntax for python<2.6
+                    if exc.code == 401 or not 400 <= exc.code < 500:
+                        raise
+                    elif not fresh_xsrf_token:
+                        auth.forget_xsrf_token(server)
+                        xsrf_token = auth.get_xsrf_token(rpc_server, server)
+                        fresh_xsrf_token = True
+                        continue
+                    print ('Request for issue %d was rejected and dropped: '
+                           '%s' % (entry[utils.ISSUE], exc))
+                    print operation[FAILURE_MESSAGE]
+                else:
+                    print operation[DESCRIPTION]
+                entry[OPERATIONS].pop(0)
+                _save_entry(entry)
+        except auth.SignInRequiredError, exc:
+            entry[LAST_ERROR] = str(exc)
+            _save_entry(entry)
+            return KEPT
+        except (urllib2.URLError, IOError, EOFError), exc:
+            status = getattr(exc, 'code', None)
+            entry[ATTEMPTS] += 1
+            entry[LAST_ERROR] = str(exc)
+            _save_entry(entry)
+            if status in auth.UNAUTHORIZED_STATUSES:
+                # A cached token may have been revoked; sign in again next time.
+                auth.forget(server)
+                return KEPT
+            return RETRY
+
+        os.remove(_entry_path(entry[utils.ISSUE]))
+        return SENT
+
+    def __send_entries(self, entries):
+        """Sends outbox entries, retrying failed ones if requested.
+
+        Args:
+            entries: List of dictionaries, each an outbox entry for an issue.
+
+        Returns:
+            List of the entries which could not be sent.
+        """
+        unsent = []
+        delay = RETRY_DELAY
+        attempts = BACKGROUND_ATTEMPTS if self.__retry else 1
+        for attempt in xrange(attempts):
+            if attempt > 0:
+                time.sleep(delay)
+                delay *= 2
+            failed = []
+            for entry in entries:
+                outcome = self.__send_entry(entry)
+                if outcome == RETRY:
+                    failed.append(entry)
+                elif outcome == KEPT:
+                    unsent.append(entry)
+            entries = failed
+            if not entries:
+                break
+        return unsent + entries
+
+    @staticmethod
+    def __new_entries(unsent):
+        """Loads the entries which weren't left unsent by this flush.
+
+        Args:
+            unsent: Dictionary mapping the issue of each entry which could not
+                be sent to its pending requests.
+
+        Returns:
+            List of dictionaries, each an outbox entry with requests which
+                haven't been tried yet.
+        """
+        return [entry for entry in load_entries()
+                if unsent.get(entry[utils.ISSUE]) != entry[OPERATIONS]]
+
+    def flush(self):
+        """Sends all pending requests in the outbox.
+
+        If retrying, failed entries are attempted up to BACKGROUND_ATTEMPTS
+        times with exponential backoff. Requests queued while flushing (for
+        example by another submit, whose own flush finds the lock taken) are
+        sent too: the outbox is read again after each pass until nothing new
+        is left, also after the lock is released. Entries that still fail, or
+        can't be sent without signing in, are kept so they can be sent later
+        via "git rv outbox --flush".
+
+        If successful, sets state to FINISHED and advances the state machine.
+        """
+        unsent = {}
+        last_errors = {}
+        try:
+            while True:
+                pending = self.__new_entries(unsent)
+                if not pending:
+                    self.__release_lock()
+                    # Another flush may have given up on the lock just before
+                    # it was released.
+                    if not self.__new_entries(unsent) or not self.__try_lock():
+                        break
+                    continue
+                for entry in self.__send_entries(pending):
+                    unsent[entry[utils.ISSUE]] = entry[OPERATIONS]
+                    last_errors[entry[utils.ISSUE]] = entry[LAST_ERROR]
+        finally:
+            if self.__lock_fd is not None:
+                self.__release_lock()
+
+        for issue in sorted(unsent):
+            print 'Requests for issue %d could not be sent: %s' % (
+                    issue, last_errors[issue])
+            for operation in unsent[issue]:
+                print operation[FAILURE_MESSAGE]
+
+        self.state = self.FINISHED
+        self.advance()
+
+    def advance(self, *args, **kwargs):
+        """Advances by calling the method corresponding to the current state.
+
+        Args:
+            *args: Arguments to be passed to the specified method based on
+                the current state.
+            **kwargs: Keyword arguments to be passed to the specified method
+                based on the current state.
+
+        Raises:
+            GitRvException: If this method is called and the state is not one
+                of the valid states.
+        """
+        if self.state == self.LIST:
+            self.list_entries(*args, **kwargs)
+        elif self.state == self.ACQUIRE_LOCK:
+            self.acquire_lock(*args, **kwargs)
+        elif self.state == self.FLUSH:
+            self.flush(*args, **kwargs)
+        elif self.state == self.FINISHED:
+            return
+        else:
+            raise utils.GitRvException('Unexpected state %r in OutboxAction.' %
+                                       (self.state,))
@@ -0,0 +1,399 @@
+# Copyright 2013 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Patch command for git-rv command line tool.
+
+Downloads a patch set of a code review issue into a new local branch, so that
+a review created elsewhere can be tried out or continued locally.
+"""
+
+
+import os
+import shutil
+import subprocess
+import tempfile
+
+import utils
+
+
+BRANCH_TEMPLATE = 'issue-%d'
+CACHE_DIRECTORY = 'patches'
+# Number of connections used to download the patches of the files in a patch
+# set. Each connection requests its share of the files one after another.
+DOWNLOAD_CONNECTIONS = 8
+FILE_DOWNLOAD_PATH_TEMPLATE = '/download/issue%d_%d_%d.diff'
+FILES = 'files'
+IS_BINARY = 'is_binary'
+OWNER = 'owner'
+OWNER_EMAIL = 'owner_email'
+PATCH_ID = 'id'
+PATCHSET_URI_PATH_TEMPLATE = '/api/%d/%d'
+PATCHSETS = 'patchsets'
+
+
+def _patch_cache_path(issue, patchset, server):
+    """Gets the path of the local cache file for a patch set.
+
+    Args:
+        issue: Integer; the ID of the code review issue.
+        patchset: Integer; the ID of the patch set within the issue.
+        server: String; the address of the Rietveld server hosting the code
+            review.
+
+    Returns:
+        String containing the path of the cache file.
+    """
+    import urllib
+    return utils.get_rv_path(CACHE_DIRECTORY, urllib.quote_plus(server),
+                             '%d_%d.diff' % (issue, patchset))
+
+
+class PatchAction(object):
+    """A state machine which downloads a patch set into a new branch.
+
+    Attributes:
+        state: The current state of the PatchAction state machine.
+        __issue: Integer; the ID of the code review issue.
+        __patchset: Integer; the ID of the patch set to download, or None for
+            the latest patch set.
+        __branch: String; the name of the branch to create.
+        __server: String; the address of the Rietveld server hosting the code
+            review.
+        __base: String; the commit to apply the patch set onto, or None to
+            infer it.
+    """
+
+    CHECK_BRANCH = 0
+    GET_PATCHSET = 1
+    DOWNLOAD_PATCH = 2
+    APPLY_PATCH = 3
+    CREATE_BRANCH = 4
+    FINISHED = 5
+
+    def __init__(self, issue, patchset=None, branch=None,
+                 server=utils.CODE_REVIEW, base=None):
+        """Constructor for PatchAction.
+
+        Args:
+            issue: Integer; the ID of the code review issue.
+            patchset: Integer; the ID of the patch set to download. Defaults to
+                None, in which case the latest patch set is used.
+            branch: String; the name of the branch to create. Defaults to None,
+                in which case BRANCH_TEMPLATE is used.
+            server: String; the address of the Rietveld server hosting the code
+                review. Defaults to CODE_REVIEW.
+            base: String; the commit to apply the patch set onto. Defaults to
+                None, in which case the base archived for the patch set is
+                used, or if there is none, HEAD in the remote branch.
+        """
+        self.__issue = issue
+        self.__patchset = patchset
+        self.__branch = branch or BRANCH_TEMPLATE % (issue,)
+        self.__server = server
+        self.__base = base
+        self.state = self.CHECK_BRANCH
+        self.advance()
+
+    @classmethod
+    def callback(cls, args, unused_argv):
+        """A callback to begin a PatchAction after arguments are parsed.
+
+        Args:
+            args: An argparse.Namespace object to extract parameters from.
+            unused_argv: The original command line arguments that were parsed
+                to create args. These are unused.
+
+        Returns:
+            An instance of PatchAction. Just by instantiating the instance, the
+                state machine will begin working.
+        """
+        return cls(args.issue, patchset=args.patchset, branch=args.branch,
+                   server=args.server, base=args.base)
+
+    def check_branch(self):
+        """Checks that the branch to be created doesn't exist yet.
+
+        If it doesn't, sets state to GET_PATCHSET, otherwise notifies the user
+        and sets state to FINISHED. In either case, advances the state machine.
+        """
+        if utils.branch_exists(self.__branch):
+            print 'Branch %r already exists.' % (self.__branch,)
+            self.state = self.FINISHED
+        else:
+            self.state = self.GET_PATCHSET
+        self.advance()
+
+    def get_patchset(self):
+        """Gets the issue metadata and determines the patch set to download.
+
+        If the patch set is in the local cache, sets state to APPLY_PATCH. If
+        it isn't, sets state to DOWNLOAD_PATCH. If the issue has no such patch
+        set, notifies the user and sets state to FINISHED. In all cases,
+        advances the state machine.
+        """
+        next_state_kwargs = {}
+        self.state = self.FINISHED
+
+        issue_metadata = utils.get_issue_metadata(issue=self.__issue,
+                                                  server=self.__server)
+        patchsets = issue_metadata.get(PATCHSETS) or []
+        if self.__patchset is None and patchsets:
+            self.__patchset = patchsets[-1]
+
+        if self.__patchset not in patchsets:
+            if self.__patchset is None:
+                print 'Issue %d has no patch sets.' % (self.__issue,)
+            else:
+                print 'Issue %d has no patch set %d.' % (self.__issue,
+                                                         self.__patchset)
+        else:
+            next_state_kwargs['issue_metadata'] = issue_metadata
+            try:
+                with open(_patch_cache_path(self.__issue, self.__patchset,
+                                            self.__server), 'rb') as fh:
+                    next_state_kwargs['patch'] = fh.read()
+                self.state = self.APPLY_PATCH
+            except IOError:
+                self.state = self.DOWNLOAD_PATCH
+
+        self.advance(**next_state_kwargs)
+
+    def download_patch(self, issue_metadata):
+        """Downloads the patches of all files in the patch set.
+
+        The patches of the files are downloaded over DOWNLOAD_CONNECTIONS
+        connections at once and combined in path order. Binary files can't be
+        downloaded as patches, so they are skipped. The combined patch is
+        stored in the local cache, since a patch set never changes once it is
+        uploaded, but only if no files were skipped.
+
+        If there is anything to apply, sets state to APPLY_PATCH, otherwise
+        notifies the user and sets state to FINISHED. In either case, advances
+        the state machine.
+
+        Args:
+            issue_metadata: Parsed dictionary from the JSON payload for the
+                issue.
+
+        Raises:
+            Exception: If the request for any of the patches fails, such as a
+                RietveldRequestError if it does not return a 200 status code.
+        """
+        patchset_path = PATCHSET_URI_PATH_TEMPLATE % (self.__issue,
+                                                      self.__patchset)
+        patchset_files = utils.json.loads(utils.read_server_paths(
+                self.__server, [patchset_path])[0]).get(FILES, {})
+
+        download_paths = []
+        skipped_files = []
+        for filename in sorted(patchset_files):
+            file_info = patchset_files[filename]
+            if file_info.get(IS_BINARY):
+                print 'Skipping binary file %s.' % (filename,)
+                skipped_files.append(filename)
+            else:
+                download_paths.append(FILE_DOWNLOAD_PATH_TEMPLATE % (
+                        self.__issue, self.__patchset, file_info[PATCH_ID]))
+
+        if not download_paths:
+            print 'Patch set %d of issue %d has nothing to apply.' % (
+                    self.__patchset, self.__issue)
+            self.state = self.FINISHED
+            self.advance()
+            return
+
+        num_connections = min(DOWNLOAD_CONNECTIONS, len(download_paths))
+
+        def download_share(index):
+            """Downloads the patches for a share of the files."""
+            return utils.read_server_paths(
+                    self.__server, download_paths[index::num_connections])
+
+        results = utils.run_concurrently(download_share,
+                                         range(num_connections),
+                                         max_threads=num_connections)
+
+        patches = [None] * len(download_paths)
+        for index in xrange(num_connections):
+            if isinstance(results[index], Exception):
+                raise results[index]
+            patches[index::num_connections] = results[index]
+
+        patch = ''.join(patch if patch.endswith('\n') else patch + '\n'
+                        for patch in patches)
+        if not skipped_files:
+            utils.write_file_atomically(
+                    _patch_cache_path(self.__issue, self.__patchset,
+                                      self.__server), patch)
+
+        self.state = self.APPLY_PATCH
+        self.advance(issue_metadata=issue_metadata, patch=patch,
+                     skipped_files=skipped_files)
+
+    def apply_patch(self, issue_metadata, patch, skipped_files=()):
+        """Applies the patch set onto its base and commits the result.
+
+        The patch is applied in a temporary index with a single "git apply",
+        so neither the working tree nor the index of the current branch is
+        touched. The review owner is the author of the commit.
+
+        If the patch applies, sets state to CREATE_BRANCH, otherwise notifies
+        the user and sets state to FINISHED. In either case, advances the state
+        machine.
+
+        Args:
+            issue_metadata: Parsed dictionary from the JSON payload for the
+                issue.
+            patch: String; the combined patch of all files in the patch set.
+            skipped_files: List of strings; the paths of the binary files left
+                out of the patch. Defaults to the empty tuple.
+        """
+        next_state_kwargs = {}
+        self.state = self.FINISHED
+
+        remote_info = utils.get_remote_info()
+        base = self.__base
+        if base is None:
+            base = utils.get_patchsets(self.__issue).get(
+                    self.__patchset, {}).get(utils.PATCHSET_BASE)
+        if base is None:
+            base = remote_info.commit_hash
+        else:
+            base = utils.capture_command('git', 'rev-parse', '--verify',
+                                         base + '^{commit}')
+
+        env = os.environ.copy()
+        if issue_metadata.get(OWNER):
+            env['GIT_AUTHOR_NAME'] = issue_metadata[OWNER].encode('utf-8')
+        if issue_metadata.get(OWNER_EMAIL):
+            env['GIT_AUTHOR_EMAIL'] = issue_metadata[OWNER_EMAIL].encode(
+                    'utf-8')
+
+        index_dir = tempfile.mkdtemp()
+        env['GIT_INDEX_FILE'] = os.path.join(index_dir, 'index')
+        try:
+            subprocess.check_call(['git', 'read-tree', base], env=env)
+            proc = subprocess.Popen(['git', 'apply', '--cached'], env=env,
+                                    stdin=subprocess.PIPE,
+                                    stderr=subprocess.PIPE)
+            _, stderr = proc.communicate(patch)
+            if proc.returncode != 0:
+                print 'Patch set %d of issue %d does not apply onto %s:' % (
+                        self.__patchset, self.__issue, base)
+                print stderr.rstrip()
+                print 'Use --base to apply it onto a different commit.'
+            else:
+                tree = subprocess.Popen(
+                        ['git', 'write-tree'], env=env,
+                        stdout=subprocess.PIPE).communicate()[0].strip()
+                message = issue_metadata.get(utils.SUBJECT) or ''
+                description = issue_metadata.get(utils.ISSUE_DESCRIPTION)
+                if description and description != message:
+                    message = '%s\n\n%s' % (message, description)
+                proc = subprocess.Popen(
+                        ['git', 'commit-tree', tree, '-p', base], env=env,
+                        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+                commit = proc.communicate(message.encode('utf-8'))[0].strip()
+                if proc.returncode != 0:
+                    raise utils.GitRvException(
+                            'Could not commit patch set %d of issue %d.' % (
+                                    self.__patchset, self.__issue))
+
+                next_state_kwargs['issue_metadata'] = issue_metadata
+                next_state_kwargs['remote_info'] = utils.RemoteInfo(
+                        remote=remote_info.remote, branch=remote_info.branch,
+                        commit_hash=base, last_synced=base,
+                        url=remote_info.url)
+                next_state_kwargs['commit'] = commit
+                next_state_kwargs['skipped_files'] = skipped_files
+                self.state = self.CREATE_BRANCH
+        finally:
+            shutil.rmtree(index_dir)
+
+        self.advance(**next_state_kwargs)
+
+    def create_branch(self, issue_metadata, remote_info, commit,
+                      skipped_files=()):
+        """Creates the branch and stores the review metadata for it.
+
+        The patch set is also archived, so "git rv interdiff" can compare it
+        with patch sets exported from the new branch. If any binary files were
+        skipped, the branch doesn't contain the whole patch set, so it isn't
+        archived and the skipped files are listed.
+
+        Sets state to FINISHED and advances the state machine.
+
+        Args:
+            issue_metadata: Parsed dictionary from the JSON payload for the
+                issue.
+            remote_info: RemoteInfo object for the remote branch the review is
+                for.
+            commit: String; the hash of the commit containing the patch set.
+            skipped_files: List of strings; the paths of the binary files left
+                out of the patch. Defaults to the empty tuple.
+        """
+        utils.capture_command('git', 'branch', self.__branch, commit,
+                              single_line=False)
+
+        rietveld_info = utils.RietveldInfo(self.__branch, server=self.__server)
+        rietveld_info.remote_info = remote_info
+        rietveld_info.review_info = utils.ReviewInfo(
+                issue=self.__issue, last_commit=commit)
+        rietveld_info.save()
+        # Fills in the subject, description, reviewers and CC from the
+        # metadata cached when it was requested.
+        utils.update_rietveld_metadata_from_issue(rietveld_info=rietveld_info)
+        if not skipped_files:
+            utils.record_patchset(self.__issue, self.__patchset,
+                                  remote_info.last_synced, commit)
+
+        print 'Created branch %r from patch set %d of issue %d.' % (
+                self.__branch, self.__patchset, self.__issue)
+        if skipped_files:
+            print 'The branch is missing these binary files from the patch set:'
+            for filename in skipped_files:
+                print '\t%s' % (filename,)
+        print 'Run "git checkout %s" to switch to it.' % (self.__branch,)
+
+        self.state = self.FINISHED
+        self.advance()
+
+    def advance(self, *args, **kwargs):
+        """Advances by calling the method corresponding to the current state.
+
+        Args:
+            *args: Arguments to be passed to the specified method based on
+                the current state.
+            **kwargs: Keyword arguments to be passed to the specified method
+                based on the current state.
+
+        Raises:
+            GitRvException: If this method is called and the state is not one
+                of the valid states.
+        """
+        if self.state == self.CHECK_BRANCH:
+            self.check_branch(*args, **kwargs)
+        elif self.state == self.GET_PATCHSET:
+            self.get_patchset(*args, **kwargs)
+        elif self.state == self.DOWNLOAD_PATCH:
+            self.download_patch(*args, **kwargs)
+        elif self.state == self.APPLY_PATCH:
+            self.apply_patch(*args, **kwargs)
+        elif self.state == self.CREATE_BRANCH:
+            self.create_branch(*args, **kwargs)
+        elif self.state == self.FINISHED:
+            return
+        else:
+            raise utils.GitRvException('Unexpected state %r in '
+                                       'PatchAction.' % (self.state,))
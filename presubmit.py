@@ -0,0 +1,332 @@
+# Copyright 2013 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Presubmit checks for git-rv command line tool.
+
+Checks are commands configured in the git config, which are run on each file
+changed in a review before it is exported or submitted. A check is run once
+per file, with the path of the file as its last argument, and passes if it
+exits with status 0.
+
+Passing results are cached by the contents of the file, so files which haven't
+changed since the last export are not checked again.
+"""
+
+
+import fnmatch
+import hashlib
+import multiprocessing
+import os
+import pipes
+import Queue
+import shutil
+import subprocess
+import threading
+import time
+
+import utils
+
+
+CACHE_DIRECTORY = 'presubmit'
+# Passing results which haven't been used for this many seconds are removed by
+# "git rv gc".
+CACHE_MAX_AGE = 30 * 24 * 60 * 60
+# Checks, set via "git config rv-presubmit.{$NAME}.command" (run with the
+# path of each changed file appended) and optionally
+# "rv-presubmit.{$NAME}.files" (space separated glob patterns for the paths
+# the check applies to, defaulting to all).
+KEY_REGEX = '^rv-presubmit\\.'
+KEY_TEMPLATE = 'rv-presubmit.%s'
+OPTION_COMMAND = 'command'
+OPTION_FILES = 'files'
+
+
+class PresubmitCheck(object):
+    """A check configured in a rv-presubmit.{$NAME} section of the git config.
+
+    Attributes:
+        name: String; the name of the section.
+        command: String; the shell command run on each file.
+        patterns: List of strings; glob patterns for the paths the check
+            applies to, or None if it applies to all paths.
+    """
+
+    def __init__(self, name, command, patterns=None):
+        """Constructor for PresubmitCheck.
+
+        Args:
+            name: String; the name of the section.
+            command: String; the shell command run on each file.
+            patterns: List of strings; glob patterns for the paths the check
+                applies to. Defaults to None, in which case it applies to all
+                paths.
+        """
+        self.name = name
+        self.command = command
+        self.patterns = patterns
+
+    def applies_to(self, path):
+        """Determines if the check should be run on a file.
+
+        Args:
+            path: String; the path of the file relative to the git root.
+
+        Returns:
+            Boolean indicating whether any pattern matches the path or its file
+                name.
+        """
+        if self.patterns is None:
+            return True
+        filename = os.path.basename(path)
+        return any(fnmatch.fnmatch(path, pattern) or
+                   fnmatch.fnmatch(filename, pattern)
+                   for pattern in self.patterns)
+
+    def cache_key(self):
+        """Gets the name of the cache directory for the results of the check.
+
+        Since the command is part of the key, changing the command of a check
+        invalidates its results.
+
+        Returns:
+            String containing the hex digest of the name and command.
+        """
+        return hashlib.sha1('%s\0%s' % (self.name, self.command)).hexdigest()
+
+    def cache_path(self, blob):
+        """Gets the path of the file recording a passing result.
+
+        Args:
+            blob: String; the hash of the blob with the contents of the file.
+
+        Returns:
+            String containing the path of the cache file.
+        """
+        return utils.get_rv_path(CACHE_DIRECTORY, self.cache_key(), blob)
+
+    def run(self, path, worktree=None):
+        """Runs the check on a file in a working tree.
+
+        Args:
+            path: String; the path of the file relative to the git root.
+            worktree: String; the root of the working tree to run in. Defaults
+                to None, in which case the current working tree is used.
+
+        Returns:
+            Tuple of a boolean indicating whether the check passed and a string
+                with the combined output of the command.
+        """
+        proc = subprocess.Popen('%s %s' % (self.command, pipes.quote(path)),
+                                shell=True,
+                                cwd=worktree or utils.get_git_root(),
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+        output = proc.communicate()[0]
+        return proc.returncode == 0, output
+
+
+def get_checks():
+    """Gets the presubmit checks configured for the repository.
+
+    Reads every rv-presubmit.{$NAME} option with a single "git config" call.
+
+    Returns:
+        List of PresubmitCheck objects, in the order their sections first
+            appear in the config.
+
+    Raises:
+        GitRvException: If a section has no command.
+    """
+    proc_result, config_output, _ = utils.capture_command(
+            'git', 'config', '--get-regexp', KEY_REGEX, expect_success=False)
+    if proc_result != 0:
+        return []
+
+    sections = []
+    options = {}
+    prefix_length = len(KEY_TEMPLATE % ('',))
+    for line in config_output.splitlines():
+        key, _, value = line.partition(' ')
+        name, _, option = key[prefix_length:].rpartition('.')
+        if name not in options:
+            sections.append(name)
+            options[name] = {}
+        options[name][option] = value
+
+    checks = []
+    for name in sections:
+        command = options[name].get(OPTION_COMMAND)
+        if not command:
+            raise utils.GitRvException('%s must have a command.' %
+                                       (KEY_TEMPLATE % (name,),))
+        patterns = options[name].get(OPTION_FILES)
+        if patterns is not None:
+            patterns = patterns.split()
+        checks.append(PresubmitCheck(name, command, patterns=patterns))
+    return checks
+
+
+def run_checks(base_commit, head_commit, in_worktree=False):
+    """Runs the presubmit checks on the files changed in a review.
+
+    Checks run in the working tree, which must match head_commit, or in a
+    temporary worktree checked out at head_commit if the branch isn't checked
+    out. One check is run per CPU at a time. Files which passed a check with
+    the same contents before are skipped. A check which can't be run counts as
+    failed. Prints any failures and then a summary of each check, including
+    the time spent running it.
+
+    Args:
+        base_commit: String; the commit the review is diffed against.
+        head_commit: String; the commit being exported or submitted.
+        in_worktree: Boolean; whether to run the checks in a temporary
+            worktree. Defaults to False.
+
+    Returns:
+        Boolean indicating whether all checks passed.
+    """
+    checks = get_checks()
+    if not checks:
+        return True
+
+    changed_files = [
+            (path, head_blob)
+            for path, _, head_blob in utils.get_changed_files(
+                    base_commit, head_commit, skip_submodules=True)
+            if head_blob != utils.NULL_HASH]
+    tasks = Queue.Queue()
+    summaries = []
+    for check in checks:
+        summary = {'passed': 0, 'failed': [], 'cached': 0, 'time': 0.0}
+        for path, blob in changed_files:
+            if not check.applies_to(path):
+                continue
+            try:
+                # Marks the result as used, so "git rv gc" keeps it.
+                os.utime(check.cache_path(blob), None)
+                summary['cached'] += 1
+            except OSError:
+                tasks.put((check, path, blob, summary))
+        summaries.append((check, summary))
+
+    lock = threading.Lock()
+
+    def run_tasks(worktree):
+        """Runs checks from the queue until it is empty."""
+        while True:
+            try:
+                check, path, blob, summary = tasks.get_nowait()
+            except Queue.Empty:
+                return
+            start = time.time()
+            try:
+                passed, output = check.run(path, worktree=worktree)
+            except Exception, exc:  # Syntax for python<2.6
+                passed, output = False, 'Could not run the check: %s' % (exc,)
+            elapsed = time.time() - start
+            if passed:
+                open(check.cache_path(blob), 'wb').close()
+            with lock:
+                summary['time'] += elapsed
+                if passed:
+                    summary['passed'] += 1
+                else:
+                    summary['failed'].append((path, output))
+
+    def run_threads(worktree=None):
+        """Runs the queued checks, one thread per CPU."""
+        threads = [threading.Thread(target=run_tasks, args=(worktree,))
+                   for _ in xrange(min(multiprocessing.cpu_count(),
+                                       tasks.qsize()))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    if in_worktree and not tasks.empty():
+        # The worktree is only checked out if there is a file to check.
+        with utils.temporary_worktree(head_commit) as worktree:
+            run_threads(worktree=worktree)
+    else:
+        run_threads()
+
+    _print_results(summaries)
+    return all(not summary['failed'] for _, summary in summaries)
+
+
+def _print_results(summaries):
+    """Prints the failures and a summary of each check.
+
+    Args:
+        summaries: List of tuples of each PresubmitCheck and a dictionary with
+            the number of files which passed, failed or were cached, the
+            failures and the time spent.
+    """
+    for check, summary in summaries:
+        for path, output in sorted(summary['failed']):
+            print 'Presubmit check %r failed for %s:' % (check.name, path)
+            for line in output.rstrip().splitlines():
+                print '    %s' % (line,)
+    for check, summary in summaries:
+        if summary['passed'] or summary['failed'] or summary['cached']:
+            print ('Presubmit check %r: %d passed, %d failed, %d cached '
+                   '(%.1fs).' % (check.name, summary['passed'],
+                                 len(summary['failed']), summary['cached'],
+                                 summary['time']))
+
+
+def get_stale_cache_paths():
+    """Finds the cached results which are no longer useful.
+
+    The results of checks which are no longer configured, or whose command has
+    changed, are stale, as are results which haven't been used for
+    CACHE_MAX_AGE seconds.
+
+    Returns:
+        List of strings; the paths of the stale cache directories and files.
+            If the checks aren't configured correctly, nothing is stale.
+    """
+    cache_directory = utils.get_rv_path(CACHE_DIRECTORY)
+    if not os.path.isdir(cache_directory):
+        return []
+    try:
+        check_keys = set(check.cache_key() for check in get_checks())
+    except utils.GitRvException:
+        return []
+
+    stale_paths = []
+    oldest_time = time.time() - CACHE_MAX_AGE
+    for check_key in sorted(os.listdir(cache_directory)):
+        check_directory = os.path.join(cache_directory, check_key)
+        if check_key not in check_keys:
+            stale_paths.append(check_directory)
+            continue
+        for blob in sorted(os.listdir(check_directory)):
+            path = os.path.join(check_directory, blob)
+            if os.path.getmtime(path) < oldest_time:
+                stale_paths.append(path)
+    return stale_paths
+
+
+def remove_cache_paths(paths):
+    """Removes cached results found by get_stale_cache_paths.
+
+    Args:
+        paths: List of strings; the paths of cache directories and files.
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        elif os.path.exists(path):
+            os.remove(path)
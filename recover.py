@@ -0,0 +1,404 @@
+# Copyright 2013 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Recover command for git-rv command line tool.
+
+Finishes or undoes a submit or sync which was interrupted, using the journal
+entry the command left behind. Rolling forward resumes from the recorded state,
+so steps which already completed (such as verifying approval or building the
+squashed commit) are not redone.
+"""
+
+
+import time
+
+import journal
+from submit import SubmitAction
+from sync import SyncAction
+import utils
+
+
+SUBMIT_STATE_DESCRIPTIONS = {
+    SubmitAction.ENTER_DETACHED_STATE: 'checking out the reviewed contents',
+    SubmitAction.SET_HISTORY_FROM_REMOTE: 'resetting onto the remote history',
+    SubmitAction.CREATE_BRANCH: 'creating the review branch',
+    SubmitAction.COMMIT: 'committing the squashed change',
+    SubmitAction.PUSHING: 'pushing the squashed commit',
+    SubmitAction.RETRY_PUSH: 'retrying a failed push',
+    SubmitAction.NOTIFY_FAILURE: 'handling a failed push',
+    SubmitAction.CLEAN_UP_LOCAL: 'cleaning up local branches',
+    SubmitAction.CLEAN_UP_REVIEW: 'updating the code review issue',
+}
+SYNC_STATE_DESCRIPTIONS = {
+    SyncAction.MERGE_REMOTE_IN: 'merging the remote branch',
+    SyncAction.ALERT_CONFLICT: 'recording merge conflicts',
+    SyncAction.EXPORT: 'exporting the synced changes',
+    SyncAction.CLEAN_UP: 'cleaning up',
+}
+ALREADY_PUSHED_TEMPLATE = """\
+The squashed commit %(commit)s has already been pushed to %(remote_branch)s,
+so the submit can't be undone. Run "git rv recover --forward" to finish it."""
+NOT_IN_BRANCH_TEMPLATE = ('Check out branch %(branch)r before recovering the '
+                          'sync interrupted in it.')
+
+
+class RecoverAction(object):
+    """A state machine which finishes or undoes an interrupted submit or sync.
+
+    Attributes:
+        state: The current state of the RecoverAction state machine.
+        __branch: String; the branch to recover, or None if it should be
+            inferred from the interrupted commands.
+        __forward: Boolean; indicating whether the interrupted command should be
+            finished.
+        __abort: Boolean; indicating whether the interrupted command should be
+            undone.
+        __entry: Dictionary; the journal entry being recovered.
+    """
+
+    LIST = 0
+    ROLL_FORWARD = 1
+    ROLL_BACK = 2
+    FINISHED = 3
+
+    def __init__(self, branch=None, forward=False, abort=False):
+        """Constructor for RecoverAction.
+
+        Args:
+            branch: String; the branch to recover. Defaults to None, in which
+                case there must be a single interrupted command.
+            forward: Boolean; indicating whether the interrupted command should
+                be finished. Defaults to False.
+            abort: Boolean; indicating whether the interrupted command should
+                be undone. Defaults to False.
+        """
+        self.__branch = branch
+        self.__forward = forward
+        self.__abort = abort
+        self.__entry = None
+        self.state = self.LIST
+        self.advance()
+
+    @classmethod
+    def callback(cls, args, unused_argv):
+        """A callback to begin a RecoverAction after arguments are parsed.
+
+        Args:
+            args: An argparse.Namespace object to extract parameters from.
+            unused_argv: The original command line arguments that were parsed
+                to create args. These are unused.
+
+        Returns:
+            An instance of RecoverAction. Just by instantiating the instance,
+                the state machine will begin working.
+        """
+        return cls(branch=args.branch, forward=args.forward, abort=args.abort)
+
+    @staticmethod
+    def __describe(entry):
+        """Describes an interrupted command from its journal entry.
+
+        Args:
+            entry: Dictionary containing a journal entry.
+
+        Returns:
+            String describing the command and the state it was interrupted in.
+        """
+        state = entry[journal.STATE]
+        if entry[journal.COMMAND] == utils.SUBMIT:
+            description = 'submit of issue %d' % (entry[utils.ISSUE],)
+            state_description = SUBMIT_STATE_DESCRIPTIONS.get(state)
+        else:
+            description = 'sync with %s' % (entry[utils.LAST_SYNCED],)
+            state_description = SYNC_STATE_DESCRIPTIONS.get(state)
+
+        updated = time.strftime('%Y-%m-%d %H:%M:%S',
+                                time.localtime(entry[journal.UPDATED]))
+        return 'Branch %r: %s interrupted while %s (at %s).' % (
+                entry[utils.BRANCH], description,
+                state_description or 'in state %d' % (state,), updated)
+
+    def list_entries(self):
+        """Prints the interrupted commands and chooses the one to recover.
+
+        If rolling forward or back and a single interrupted command matches,
+        sets state to ROLL_FORWARD or ROLL_BACK, otherwise to FINISHED. In
+        either case, advances the state machine.
+        """
+        entries = journal.load_entries()
+        if self.__branch is not None:
+            entries = [entry for entry in entries
+                       if entry[utils.BRANCH] == self.__branch]
+
+        self.state = self.FINISHED
+        if not entries:
+            print 'No interrupted submit or sync to recover.'
+        for entry in entries:
+            print self.__describe(entry)
+
+        if len(entries) == 1:
+            self.__entry = entries[0]
+            if self.__forward:
+                self.state = self.ROLL_FORWARD
+            elif self.__abort:
+                self.state = self.ROLL_BACK
+            else:
+                print ('Run "git rv recover --forward" to finish it or '
+                       '"git rv recover --abort" to undo it.')
+        elif len(entries) > 1:
+            print 'Choose one by running "git rv recover BRANCH".'
+        self.advance()
+
+    def __check_sync_branch(self):
+        """Checks that the branch of an interrupted sync is checked out.
+
+        Returns:
+            Boolean indicating whether the sync can be recovered.
+        """
+        branch = self.__entry[utils.BRANCH]
+        if utils.get_current_branch() == branch:
+            return True
+
+        print NOT_IN_BRANCH_TEMPLATE % {'branch': branch}
+        return False
+
+    def __submit_pushed(self):
+        """Checks whether the squashed commit of a submit was pushed.
+
+        The remote branch is fetched, since others may have pushed on top of
+        the squashed commit since.
+
+        Returns:
+            Boolean indicating whether the squashed commit recorded in the
+                journal entry is in the history of the remote branch.
+        """
+        squashed_commit = self.__entry.get(journal.SQUASHED_COMMIT)
+        if squashed_commit is None:
+            return False
+        remote_head = utils.fetch_remote_branch(
+                self.__entry[utils.REMOTE], self.__entry[utils.REMOTE_BRANCH])
+        return utils.is_ancestor(squashed_commit, remote_head)
+
+    def __restore_submit_branch(self):
+        """Puts the repository back how it was before an interrupted submit.
+
+        Checks out the review branch, discarding any changes left in the
+        working tree, and deletes the dummy branch if it was created.
+        """
+        branch = self.__entry[utils.BRANCH]
+        print 'Checking out %s.' % (branch,)
+        utils.capture_command('git', 'checkout', '-f', branch,
+                              single_line=False)
+        utils.capture_command('git', 'reset', '--hard', 'HEAD',
+                              single_line=False)
+
+        review_branch = self.__entry.get(journal.REVIEW_BRANCH)
+        if review_branch is not None and utils.branch_exists(review_branch):
+            print 'Deleting %s.' % (review_branch,)
+            utils.capture_command('git', 'branch', '-D', review_branch,
+                                  single_line=False)
+
+    def __roll_forward_submit(self):
+        """Finishes an interrupted submit.
+
+        If the squashed commit was built, it is pushed again (unless the
+        earlier push already landed) and the clean up is done. If not, the
+        branch is restored and the submit is resumed after approval was
+        verified, so no requests are made to the code review server.
+        """
+        entry = self.__entry
+        state = entry[journal.STATE]
+        if (state == SubmitAction.NOTIFY_FAILURE or
+            (state == SubmitAction.CLEAN_UP_LOCAL and
+             not entry.get(journal.SUCCESS))):
+            print 'The push had failed, so the submit is being undone.'
+            entry[journal.STATE] = SubmitAction.CLEAN_UP_LOCAL
+        elif state in (SubmitAction.CLEAN_UP_LOCAL,
+                       SubmitAction.CLEAN_UP_REVIEW):
+            print 'Finishing the clean up after the push.'
+        elif state in (SubmitAction.PUSHING, SubmitAction.RETRY_PUSH):
+            entry[journal.STATE] = SubmitAction.PUSHING
+            squashed_commit = entry[journal.SQUASHED_COMMIT]
+            if self.__submit_pushed():
+                print 'The squashed commit %s was already pushed.' % (
+                        squashed_commit,)
+                entry[journal.STATE] = SubmitAction.CLEAN_UP_LOCAL
+                entry[journal.SUCCESS] = True
+            else:
+                print 'Pushing the squashed commit %s again.' % (
+                        squashed_commit,)
+                review_branch = entry[journal.REVIEW_BRANCH]
+                if not utils.branch_exists(review_branch):
+                    utils.capture_command('git', 'branch', review_branch,
+                                          squashed_commit, single_line=False)
+        else:
+            print 'The squashed commit was not built; building it again.'
+            self.__restore_submit_branch()
+            entry[journal.STATE] = SubmitAction.ENTER_DETACHED_STATE
+
+        if (entry[journal.STATE] == SubmitAction.PUSHING or
+            (entry[journal.STATE] == SubmitAction.CLEAN_UP_LOCAL and
+             entry.get(journal.SUCCESS))):
+            # The review branch is replaced after a successful push, so it
+            # can't be checked out.
+            utils.capture_command('git', 'checkout', '-f', '--detach',
+                                  entry[journal.SQUASHED_COMMIT],
+                                  single_line=False)
+        SubmitAction(entry[journal.RPC_SERVER_ARGS],
+                     do_close=entry[journal.DO_CLOSE], journal_entry=entry)
+
+    def __roll_forward_sync(self):
+        """Finishes an interrupted sync.
+
+        Resumes the sync without fetching from the remote again. If the merge
+        was interrupted before it was committed, it is started over.
+        """
+        if not self.__check_sync_branch():
+            return
+
+        entry = self.__entry
+        state = entry[journal.STATE]
+        if state == SyncAction.MERGE_REMOTE_IN:
+            commits = utils.get_commits(entry[journal.HEAD], 'HEAD')
+            if len(commits) == 1:
+                print 'The merge was committed; exporting it.'
+                state = SyncAction.EXPORT
+            elif len(commits) == 0:
+                print 'Merging %s again.' % (entry[utils.LAST_SYNCED],)
+                utils.capture_command('git', 'reset', '--hard', 'HEAD',
+                                      single_line=False)
+            else:
+                print ('Unexpected commits after %s; run "git rv recover '
+                       '--abort" instead.' % (entry[journal.HEAD],))
+                return
+        elif state == SyncAction.EXPORT:
+            rietveld_info = utils.RietveldInfo.from_branch(
+                    branch_name=entry[utils.BRANCH])
+            head_commit = utils.get_head_commit(
+                    current_branch=entry[utils.BRANCH])
+            if rietveld_info.review_info.last_commit == head_commit:
+                print 'The synced changes were already exported.'
+                state = SyncAction.CLEAN_UP
+        entry[journal.STATE] = state
+
+        # git_rv imports this module, so the parser can't be imported first.
+        from git_rv import get_parser
+        argv = [utils.SYNC] + entry[journal.ARGV][1:]
+        args = get_parser().parse_args(argv)
+        SyncAction.callback(args, argv, journal_entry=entry)
+
+    def roll_forward(self):
+        """Finishes the interrupted command.
+
+        If successful, sets state to FINISHED and advances the state machine.
+        """
+        if self.__entry[journal.COMMAND] == utils.SUBMIT:
+            self.__roll_forward_submit()
+        else:
+            self.__roll_forward_sync()
+
+        self.state = self.FINISHED
+        self.advance()
+
+    def __roll_back_submit(self):
+        """Undoes an interrupted submit, unless the commit was pushed."""
+        entry = self.__entry
+        state = entry[journal.STATE]
+        already_pushed = (
+                state == SubmitAction.CLEAN_UP_REVIEW or
+                (state == SubmitAction.CLEAN_UP_LOCAL and
+                 entry.get(journal.SUCCESS)) or
+                self.__submit_pushed())
+        if already_pushed:
+            print ALREADY_PUSHED_TEMPLATE % {
+                'commit': entry[journal.SQUASHED_COMMIT],
+                'remote_branch': '%s/%s' % (entry[utils.REMOTE],
+                                            entry[utils.REMOTE_BRANCH]),
+            }
+            return
+
+        self.__restore_submit_branch()
+        journal.clear(entry[utils.BRANCH])
+        print 'Submit of issue %d undone.' % (entry[utils.ISSUE],)
+
+    def __roll_back_sync(self):
+        """Undoes an interrupted sync.
+
+        Resets the branch to the last exported commit and restores the sync
+        metadata. Changes which were already uploaded to the code review server
+        are replaced by the next export.
+        """
+        if not self.__check_sync_branch():
+            return
+
+        entry = self.__entry
+        branch = entry[utils.BRANCH]
+        head = entry[journal.HEAD]
+        head_commit = utils.get_head_commit(current_branch=branch)
+        if head_commit != head:
+            print 'Resetting %s to %s. To restore it, run:' % (branch, head)
+            print '\tgit reset --hard %s' % (head_commit,)
+        utils.capture_command('git', 'reset', '--hard', head,
+                              single_line=False)
+
+        rietveld_info = utils.RietveldInfo.from_branch(branch_name=branch)
+        rietveld_info.last_synced = entry[journal.PREVIOUS_LAST_SYNCED]
+        if rietveld_info.review_info.last_commit != head:
+            print ('The synced changes were already exported to issue %d; '
+                   'they will be replaced by the next export.' % (
+                           rietveld_info.review_info.issue,))
+            rietveld_info.review_info.last_commit = head
+        rietveld_info.save()
+        rietveld_info.remove_key(utils.SYNC_HALTED)
+
+        journal.clear(branch)
+        print 'Sync of branch %r undone.' % (branch,)
+
+    def roll_back(self):
+        """Undoes the interrupted command.
+
+        If successful, sets state to FINISHED and advances the state machine.
+        """
+        if self.__entry[journal.COMMAND] == utils.SUBMIT:
+            self.__roll_back_submit()
+        else:
+            self.__roll_back_sync()
+
+        self.state = self.FINISHED
+        self.advance()
+
+    def advance(self, *args, **kwargs):
+        """Advances by calling the method corresponding to the current state.
+
+        Args:
+            *args: Arguments to be passed to the specified method based on
+                the current state.
+            **kwargs: Keyword arguments to be passed to the specified method
+                based on the current state.
+
+        Raises:
+            GitRvException: If this method is called and the state is not one
+                of the valid states.
+        """
+        if self.state == self.LIST:
+            self.list_entries(*args, **kwargs)
+        elif self.state == self.ROLL_FORWARD:
+            self.roll_forward(*args, **kwargs)
+        elif self.state == self.ROLL_BACK:
+            self.roll_back(*args, **kwargs)
+        elif self.state == self.FINISHED:
+            return
+        else:
+            raise utils.GitRvException('Unexpected state %r in RecoverAction.' %
+                                       (self.state,))
@@ -0,0 +1,180 @@
+# Copyright 2013 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Status command for git-rv command line tool.
+
+Reports whether the current branch needs to be exported or synced, or is ready
+to be submitted. Only local state is used (at most two git processes and no
+requests to the code review server), so the command is fast enough to be run
+from a shell prompt.
+"""
+
+
+import utils
+
+
+class StatusAction(object):
+    """A state machine which reports the review status of the current branch.
+
+    Attributes:
+        state: The current state of the StatusAction state machine.
+        __branch: String; the current branch.
+        __head_commit: String; the commit hash of HEAD in the current branch.
+        __git_dir: String; the common git directory of the repository.
+        __rietveld_info: RietveldInfo object for the current branch, or None.
+    """
+
+    READ_STATE = 0
+    PRINT_STATUS = 1
+    FINISHED = 2
+
+    def __init__(self):
+        """Constructor for StatusAction."""
+        self.__branch = None
+        self.__head_commit = None
+        self.__git_dir = None
+        self.__rietveld_info = None
+        self.state = self.READ_STATE
+        self.advance()
+
+    @classmethod
+    def callback(cls, unused_args, unused_argv):
+        """A callback to begin a StatusAction after arguments are parsed.
+
+        Args:
+            unused_args: An argparse.Namespace object parsed from the command
+                line. These are unused.
+            unused_argv: The original command line arguments that were parsed
+                to create args. These are unused.
+
+        Returns:
+            An instance of StatusAction. Just by instantiating the instance,
+                the state machine will begin working.
+        """
+        return cls()
+
+    def read_state(self):
+        """Reads the current branch, its HEAD and its Rietveld info.
+
+        A single "git rev-parse" reports the git directory, HEAD and the branch
+        name, and a single "git config" reads the Rietveld info.
+
+        If successful, sets state to PRINT_STATUS and advances the state
+        machine.
+        """
+        rev_parse_output = utils.capture_command(
+                'git', 'rev-parse', '--git-common-dir', 'HEAD',
+                '--abbrev-ref', 'HEAD', single_line=False)
+        self.__git_dir, self.__head_commit, self.__branch = (
+                rev_parse_output.split('\n'))
+        self.__rietveld_info = utils.RietveldInfo.from_branch(
+                branch_name=self.__branch)
+
+        self.state = self.PRINT_STATUS
+        self.advance()
+
+    def print_status(self):
+        """Prints the review status of the current branch.
+
+        The remote branch is read directly from the git directory rather than
+        via a git process.
+
+        If successful, sets state to FINISHED and advances the state machine.
+        """
+        rietveld_info = self.__rietveld_info
+        if rietveld_info is None or rietveld_info.review_info is None:
+            print 'No review data found in branch %r.' % (self.__branch,)
+            self.state = self.FINISHED
+            self.advance()
+            return
+
+        review_info = rietveld_info.review_info
+        print 'Branch %r is in review as issue %d on %s.' % (
+                self.__branch, review_info.issue, rietveld_info.server)
+
+        ready = True
+        if review_info.last_commit != self.__head_commit:
+            print 'Needs export: HEAD has changed since the last export.'
+            ready = False
+
+        remote_info = rietveld_info.remote_info
+        if rietveld_info.parent_branch is not None:
+            parent_info = utils.RietveldInfo.from_branch(
+                    branch_name=rietveld_info.parent_branch)
+            if parent_info is None or parent_info.review_info is None:
+                print ('Needs sync: parent branch %r is no longer in review.' %
+                       (rietveld_info.parent_branch,))
+                ready = False
+            elif (parent_info.review_info.last_commit !=
+                  rietveld_info.last_synced):
+                print ('Needs sync: parent branch %r has been exported since '
+                       'the last sync.' % (rietveld_info.parent_branch,))
+                ready = False
+        elif remote_info is not None:
+            remote_ref = utils.REMOTE_BRANCH_REF_TEMPLATE % (
+                    remote_info.remote, remote_info.branch)
+            remote_commit = utils.read_ref_file(remote_ref,
+                                                git_dir=self.__git_dir)
+            if remote_commit != remote_info.last_synced:
+                print 'Needs sync: %s has changed since the last sync.' % (
+                        remote_info.remote_branch_ref,)
+                ready = False
+
+        if rietveld_info.sync_halted:
+            print ('Sync halted: resolve the conflicts and run '
+                   '"git rv sync --continue".')
+            ready = False
+
+        approved = rietveld_info.approved
+        if approved is None:
+            print ('Approval: unknown, run "git rv getinfo --pull-metadata" '
+                   'to check with the code review server.')
+            ready = False
+        elif approved:
+            print 'Approval: approved.'
+        else:
+            print 'Approval: not yet approved.'
+            ready = False
+
+        if ready and rietveld_info.parent_branch is not None:
+            print 'Ready to submit after branch %r.' % (
+                    rietveld_info.parent_branch,)
+        elif ready:
+            print 'Ready to submit.'
+
+        self.state = self.FINISHED
+        self.advance()
+
+    def advance(self, *args, **kwargs):
+        """Advances by calling the method corresponding to the current state.
+
+        Args:
+            *args: Arguments to be passed to the specified method based on
+                the current state.
+            **kwargs: Keyword arguments to be passed to the specified method
+                based on the current state.
+
+        Raises:
+            GitRvException: If this method is called and the state is not one
+                of the valid states.
+        """
+        if self.state == self.READ_STATE:
+            self.read_state(*args, **kwargs)
+        elif self.state == self.PRINT_STATUS:
+            self.print_status(*args, **kwargs)
+        elif self.state == self.FINISHED:
+            return
+        else:
+            raise utils.GitRvException('Unexpected state %r in StatusAction.' %
+                                       (self.state,))
@@ -18,15 +18,240 @@ Allows current issue under review to be submitted.
 """
 
 
-import urllib
-import urllib2
-
-from upload import GetRpcServer
+import time
 
+import journal
+import outbox
+import presubmit
 import utils
 
 
 BRANCH_NAME_TEMPLATE = 'review-%d'
+# Seconds to wait before the first retry of a failed push, doubled after each
+# attempt.
+PUSH_RETRY_DELAY = 1
+# Parts of "git push" errors which mean the remote branch has moved. Newer
+# versions of git no longer print TIP_BEHIND_HINT in this case.
+REJECTED_PUSH_MARKERS = (utils.TIP_BEHIND_HINT, '(fetch first)',
+                         '(non-fast-forward)')
+# A stacked review is diffed against its parent review, so its squashed commit
+# would contain the parent's changes too.
+STACKED_REVIEW_TEMPLATE = ('Branch %(branch)r is stacked on the review in '
+                           'branch %(parent)r. Submit that first, then run '
+                           '"git rv sync" in branch %(branch)r.')
+
+
+def get_rpc_server_args(args):
+    """Gets the arguments for signing in to the code review server.
+
+    Args:
+        args: An argparse.Namespace object with the review server options
+            copied from upload.py.
+
+    Returns:
+        A dictionary of arguments to be passed to GetRpcServer.
+    """
+    return {
+        'host_override': args.host,
+        'save_cookies': False,
+        'account_type': args.account_type,
+        'use_oauth2': True,
+        'oauth2_port': args.oauth2_port,
+        'open_oauth2_local_webbrowser': args.open_oauth2_local_webbrowser,
+    }
+
+
+def _push_rejected(error_message):
+    """Determines if a push was rejected because the remote branch moved.
+
+    Args:
+        error_message: String; a captured error from the "git push" command.
+
+    Returns:
+        Boolean indicating whether the remote branch has commits which are not
+            in the pushed commit.
+    """
+    return any(marker in error_message for marker in REJECTED_PUSH_MARKERS)
+
+
+def _squash_commit_message(subject, description, issue, server):
+    """Creates the commit message of a squashed commit for a review.
+
+    Args:
+        subject: String; subject of the reviewed issue.
+        description: String; description of the reviewed issue.
+        issue: Integer; containing the ID of the code review issue.
+        server: String; the server used for review of the issue.
+
+    Returns:
+        String containing the commit message.
+    """
+    description_newline = ''
+    if description:
+        description_newline = '\n\n'
+    return utils.SQUASH_COMMIT_TEMPLATE % {
+        utils.SUBJECT: subject,
+        utils.DESCRIPTION_NEWLINE: description_newline,
+        utils.ISSUE_DESCRIPTION: description,
+        utils.ISSUE: issue,
+        utils.SERVER: server,
+    }
+
+
+def _merge_onto(new_parent, commit, commit_message):
+    """Builds a commit with the changes in a commit on top of another commit.
+
+    The changes are those made in commit since its merge base with
+    new_parent. The commit is built with utils.merge_trees and "git
+    commit-tree", so no branch, index or working tree is changed.
+
+    Args:
+        new_parent: String; the hash of the parent for the new commit.
+        commit: String; the hash of the commit with the changes.
+        commit_message: String; the message of the new commit.
+
+    Returns:
+        String containing the hash of the new commit, or None if the changes
+            conflict with new_parent.
+    """
+    if utils.is_ancestor(new_parent, commit):
+        # No merge needed, commit already has everything in new_parent.
+        tree = '%s^{tree}' % (commit,)
+    else:
+        tree = utils.merge_trees(new_parent, commit)
+        if tree is None:
+            return None
+
+    return utils.capture_command('git', 'commit-tree', tree, '-p', new_parent,
+                                 '-m', commit_message)
+
+
+def _journal_entry(branch, rietveld_info, subject, description, last_synced,
+                   rpc_server_args, do_close):
+    """Creates the journal entry for a submit, before its first state.
+
+    Args:
+        branch: String; the submitted branch.
+        rietveld_info: RietveldInfo object for the submitted branch.
+        subject: String; subject of the submitted issue.
+        description: String; description of the submitted issue.
+        last_synced: String; the hash of the commit in the remote branch which
+            the squashed commit is built on.
+        rpc_server_args: A dictionary of arguments to be passed to
+            GetRpcServer.
+        do_close: Boolean; represents whether the issue should be closed.
+
+    Returns:
+        Dictionary containing the values needed to resume the submit.
+    """
+    return {
+        journal.COMMAND: utils.SUBMIT,
+        utils.BRANCH: branch,
+        utils.ISSUE: rietveld_info.review_info.issue,
+        utils.SERVER: rietveld_info.server,
+        utils.REMOTE: rietveld_info.remote_info.remote,
+        utils.REMOTE_BRANCH: rietveld_info.remote_info.branch,
+        utils.LAST_SYNCED: last_synced,
+        utils.SUBJECT: subject,
+        utils.ISSUE_DESCRIPTION: description,
+        utils.METADATA: utils.encode_metadata(rietveld_info.to_dict()),
+        journal.DO_CLOSE: do_close,
+        journal.RPC_SERVER_ARGS: rpc_server_args,
+    }
+
+
+def _commit_link_operation(rietveld_info, subject, commit_hash):
+    """Creates an outbox operation adding a link to the reviewed commit.
+
+    Args:
+        rietveld_info: RietveldInfo object for the submitted branch.
+        subject: String; subject of the submitted issue.
+        commit_hash: String; the hash of the commit which we are trying
+            to publish a link to.
+
+    Returns:
+        Dictionary describing the "publish" request for the outbox, or None
+            if no repository can be parsed from the remote URL.
+    """
+    repository_info = rietveld_info.remote_info.repository_info
+    if repository_info is None:
+        print ('No commit link template matches remote URL %r, so no '
+               'link to the commit will be added to the review. See '
+               '"rv-commitlink" in the git-rv README.' %
+               (rietveld_info.remote_info.url,))
+        return None
+
+    issue = rietveld_info.review_info.issue
+    commit_link = repository_info.commit_link(commit_hash)
+    message = 'Added in\n%s' % (commit_link,)
+    publish_request_values = {
+        utils.MESSAGE: message,
+        utils.CC: rietveld_info.cc,
+        utils.REVIEWERS: rietveld_info.reviewers,
+        utils.SUBJECT: subject,
+    }
+    publish_request_values.update(utils.PUBLISH_ISSUE_BASE)
+    return {
+        outbox.URI: utils.PUBLISH_ISSUE_MESSAGE_TEMPLATE % {
+            utils.ISSUE: issue},
+        outbox.VALUES: publish_request_values,
+        outbox.DESCRIPTION: ('Message:\n%s\nposted to code review '
+                             'issue.' % (message,)),
+        outbox.FAILURE_MESSAGE: utils.FAILED_PUBLISH_TEMPLATE % {
+            utils.ISSUE: issue,
+            utils.SERVER: rietveld_info.server,
+            utils.MESSAGE: message,
+        },
+    }
+
+
+def _close_issue_operation(issue, server):
+    """Creates an outbox operation closing the issue.
+
+    Args:
+        issue: Integer; containing an ID of a code review issue.
+        server: String; the server used for review of the issue.
+
+    Returns:
+        Dictionary describing the "close" request for the outbox.
+    """
+    return {
+        outbox.URI: utils.CLOSE_ISSUE_TEMPLATE % {
+            utils.ISSUE: issue},
+        outbox.VALUES: {},
+        outbox.DESCRIPTION: 'Issue %d has been closed.' % (issue,),
+        outbox.FAILURE_MESSAGE: utils.FAILED_CLOSE_TEMPLATE % {
+            utils.ISSUE: issue,
+            utils.SERVER: server,
+        },
+    }
+
+
+def _review_operations(rietveld_info, subject, commit_hash, do_close):
+    """Creates the outbox operations updating an issue after it is submitted.
+
+    Args:
+        rietveld_info: RietveldInfo object for the submitted branch.
+        subject: String; subject of the submitted issue.
+        commit_hash: String; the hash of the submitted commit.
+        do_close: Boolean; represents whether the issue should be closed.
+
+    Returns:
+        List of dictionaries, each describing a request for the outbox.
+    """
+    operations = []
+    try:
+        commit_link_operation = _commit_link_operation(rietveld_info, subject,
+                                                       commit_hash)
+    except utils.GitRvException, exc:  # Syntax for python<2.6
+        print 'Could not create a link to commit %s:\n%s' % (commit_hash, exc)
+    else:
+        if commit_link_operation is not None:
+            operations.append(commit_link_operation)
+    if do_close:
+        operations.append(_close_issue_operation(
+                rietveld_info.review_info.issue, rietveld_info.server))
+    return operations
 
 
 class SubmitAction(object):
@@ -48,6 +273,13 @@ class SubmitAction(object):
             user to close and comment on an issue.
         __do_close: Boolean; Represents whether the issue should be closed
             after pushing the commit.
+        __push_retries: Integer; the number of times a failed push may still
+            be retried.
+        __full_diff: Boolean; whether to show the full diff rather than a
+            summary if the branch is not in a clean state.
+        __skip_presubmit: Boolean; whether to skip the presubmit checks.
+        __push_retry_delay: Number of seconds to wait before the next retry of
+            a failed push.
         __rietveld_info: RietveldInfo object associated with the current branch.
         __remote: String containing the remote the current review is being
             diffed against.
@@ -58,6 +290,12 @@ class SubmitAction(object):
         __review_branch: String; the name of the dummy branch created to push
             changes. This value is set as None in the constructor and will only
             be set if a review branch is successfully created.
+        __journal_entry: Dictionary; the journal entry recording the progress
+            of this action, or None until the first state which changes the
+            repository is entered.
+        __metadata_stored: Boolean; indicating whether the Rietveld metadata
+            for the branch is still stored in the git config. It is only False
+            when resuming after the metadata was removed.
     """
 
     CHECK_ENVIRONMENT = 0
@@ -68,12 +306,14 @@ class SubmitAction(object):
     CREATE_BRANCH = 5
     COMMIT = 6
     PUSHING = 7
-    NOTIFY_FAILURE = 8
-    CLEAN_UP_LOCAL = 9
-    CLEAN_UP_REVIEW = 10
-    FINISHED = 11
-
-    def __init__(self, rpc_server_args, do_close=True):
+    RETRY_PUSH = 8
+    NOTIFY_FAILURE = 9
+    CLEAN_UP_LOCAL = 10
+    CLEAN_UP_REVIEW = 11
+    FINISHED = 12
+
+    def __init__(self, rpc_server_args, do_close=True, push_retries=0,
+                 full_diff=False, skip_presubmit=False, journal_entry=None):
         """Constructor for SubmitAction.
 
         Args:
@@ -81,13 +321,35 @@ class SubmitAction(object):
                 account_type from the parsed command line arguments.
             do_close: Boolean; defaults to True. Represents whether the issue
                 should be closed after pushing the commit.
+            push_retries: Integer; the number of times a failed push is
+                retried. If the push was rejected because the remote branch
+                moved, the squashed commit is rebuilt on the new remote HEAD
+                before retrying. Defaults to 0.
+            full_diff: Boolean; whether to show the full diff rather than a
+                summary if the branch is not in a clean state. Defaults to
+                False.
+            skip_presubmit: Boolean; whether to skip the presubmit checks.
+                Defaults to False.
+            journal_entry: Dictionary; the journal entry of an interrupted
+                SubmitAction to resume. Defaults to None, in which case a new
+                submit is begun.
 
         Saves some environment data on the object such as the current branch,
         and the issue, server and issue description associated with the current
         branch.
         """
+        self.__push_retries = push_retries
+        self.__push_retry_delay = PUSH_RETRY_DELAY
+        self.__full_diff = full_diff
+        self.__skip_presubmit = skip_presubmit
+        if journal_entry is not None:
+            self.__resume(rpc_server_args, do_close, journal_entry)
+            return
+
         self.__branch = utils.get_current_branch()
         self.__review_branch = None
+        self.__journal_entry = None
+        self.__metadata_stored = True
 
         self.__rietveld_info = utils.RietveldInfo.from_branch(
                 branch_name=self.__branch)
@@ -124,29 +386,115 @@ class SubmitAction(object):
             An instance of SubmitAction. Just by instantiating the instance, the
                 state machine will begin working.
         """
-        rpc_server_args = {
-            'host_override': args.host,
-            'save_cookies': False,
-            'account_type': args.account_type,
-            'use_oauth2': True,
-            'oauth2_port': args.oauth2_port,
-            'open_oauth2_local_webbrowser': args.open_oauth2_local_webbrowser,
-        }
-        return cls(rpc_server_args=rpc_server_args, do_close=args.do_close)
+        rpc_server_args = get_rpc_server_args(args)
+        if args.dry_run and args.queue:
+            raise utils.GitRvException('--dry_run can\'t be combined with '
+                                       '--queue.')
+        if args.dry_run:
+            return SubmitPlanAction(do_close=args.do_close,
+                                    push_retries=args.push_retries)
+        if args.queue:
+            return SubmitQueueAction(args.queue,
+                                     rpc_server_args=rpc_server_args,
+                                     do_close=args.do_close,
+                                     full_diff=args.full_diff,
+                                     skip_presubmit=args.skip_presubmit)
+        return cls(rpc_server_args=rpc_server_args, do_close=args.do_close,
+                   push_retries=args.push_retries, full_diff=args.full_diff,
+                   skip_presubmit=args.skip_presubmit)
+
+    def __resume(self, rpc_server_args, do_close, journal_entry):
+        """Resumes an interrupted SubmitAction from its journal entry.
+
+        Restores the values recorded in the journal entry and advances the
+        state machine from the state stored in the entry. The caller is
+        responsible for choosing a state the repository can be resumed from.
+
+        Args:
+            rpc_server_args: A dictionary of arguments to be passed to
+                GetRpcServer.
+            do_close: Boolean; represents whether the issue should be closed
+                after pushing the commit.
+            journal_entry: Dictionary; the journal entry of the interrupted
+                SubmitAction.
+        """
+        self.__branch = journal_entry[utils.BRANCH]
+        # The metadata is removed from the git config during clean up, so the
+        # copy in the journal entry is used if it is gone.
+        self.__rietveld_info = utils.RietveldInfo.from_branch(
+                branch_name=self.__branch)
+        self.__metadata_stored = self.__rietveld_info is not None
+        if not self.__metadata_stored:
+            self.__rietveld_info = utils.RietveldInfo.from_config_value(
+                    self.__branch, journal_entry[utils.METADATA])
+        self.__issue = journal_entry[utils.ISSUE]
+        self.__server = journal_entry[utils.SERVER]
+        self.__rpc_server_args = rpc_server_args
+        self.__do_close = do_close
+        self.__remote = journal_entry[utils.REMOTE]
+        self.__remote_branch = journal_entry[utils.REMOTE_BRANCH]
+        self.__last_synced = journal_entry[utils.LAST_SYNCED]
+        self.__subject = journal_entry[utils.SUBJECT]
+        self.__description = journal_entry[utils.ISSUE_DESCRIPTION]
+
+        # The name is recorded before the branch is created, so it may not
+        # exist.
+        review_branch = journal_entry.get(journal.REVIEW_BRANCH)
+        if review_branch is not None and utils.branch_exists(review_branch):
+            self.__review_branch = review_branch
+        else:
+            self.__review_branch = None
+        self.__journal_entry = journal_entry
+
+        self.state = journal_entry[journal.STATE]
+        if self.state == self.CLEAN_UP_LOCAL:
+            self.advance(success=journal_entry.get(journal.SUCCESS, False))
+        else:
+            self.advance()
+
+    def __record(self, **values):
+        """Records the current state in the journal before it is entered.
+
+        Args:
+            **values: Keyword arguments; values needed to resume from the
+                current state, which are added to the journal entry.
+        """
+        if self.__journal_entry is None:
+            self.__journal_entry = _journal_entry(
+                    self.__branch, self.__rietveld_info, self.__subject,
+                    self.__description, self.__last_synced,
+                    self.__rpc_server_args, self.__do_close)
+        self.__journal_entry[journal.STATE] = self.state
+        self.__journal_entry.update(values)
+        journal.record(self.__journal_entry)
 
     # TODO(dhermes): There is a very similar method in sync. Be sure to
     #                consolidate these when improving the state machine.
     def check_environment(self):
         """Checks that the current review branch is in a clean state.
 
+        Also checks that no earlier submit or sync was interrupted in the
+        branch, since it must be recovered first.
+
         If not, we can't submit, so sets state to FINISHED after notifying the
         user of the issue. If it can be, sets state to VERIFY_APPROVAL. In
         either case, advances the state machine.
         """
-        # Make sure branch is clean
-        if not utils.in_clean_state():
-            print 'Branch %r not in clean state:' % (self.__branch,)
-            print utils.capture_command('git', 'diff', single_line=False)
+        # Make sure branch is clean. The working tree is always checked, even
+        # if the index is trusted, since submitting checks out the branch with
+        # "git checkout -f" and "git reset --hard", which would throw away
+        # unstaged changes.
+        if not utils.in_clean_state(trust_index=False):
+            utils.print_unclean_state(self.__branch,
+                                      full_diff=self.__full_diff)
+            self.state = self.FINISHED
+        elif not journal.check_not_interrupted(self.__branch):
+            self.state = self.FINISHED
+        elif self.__rietveld_info.parent_branch is not None:
+            print STACKED_REVIEW_TEMPLATE % {
+                'branch': self.__branch,
+                'parent': self.__rietveld_info.parent_branch,
+            }
             self.state = self.FINISHED
         else:
             self.state = self.VERIFY_APPROVAL
@@ -156,18 +504,26 @@ class SubmitAction(object):
     def verify_approval(self):
         """Verifies that the current issue has been approved in review.
 
+        Once it has, also runs the presubmit checks on the changes in the
+        review, unless they are skipped.
+
         If successful, sets state to UPDATE_FROM_METADATA, otherwise sets to
         FINISHED. In either case, advances the state machine.
         """
         approved = utils.is_current_issue_approved(issue=self.__issue,
                                                    current_branch=self.__branch,
                                                    server=self.__server)
-        if approved:
-            self.state = self.UPDATE_FROM_METADATA
-        else:
+        if not approved:
             # TODO(dhermes): Make this a constant.
             print 'This review has not been approved.'
             self.state = self.FINISHED
+        elif not self.__skip_presubmit and not presubmit.run_checks(
+                self.__last_synced,
+                utils.get_head_commit(current_branch=self.__branch)):
+            print utils.PRESUBMIT_FAILED
+            self.state = self.FINISHED
+        else:
+            self.state = self.UPDATE_FROM_METADATA
         self.advance()
 
     def update_from_metadata(self):
@@ -203,6 +559,8 @@ class SubmitAction(object):
         error message and sets state to NOTIFY_FAILURE. In either case, advances
         the state machine.
         """
+        self.__record()
+
         # Dictionary to pass along state to advance()
         next_state_kwargs = {}
 
@@ -235,6 +593,8 @@ class SubmitAction(object):
         message and sets state to NOTIFY_FAILURE. In either case, advances the
         state machine.
         """
+        self.__record()
+
         # Dictionary to pass along state to advance()
         next_state_kwargs = {}
 
@@ -271,6 +631,7 @@ class SubmitAction(object):
         review_branch = BRANCH_NAME_TEMPLATE % self.__issue
         while utils.branch_exists(review_branch):
             review_branch += '_0'
+        self.__record(**{journal.REVIEW_BRANCH: review_branch})
 
         # Dictionary to pass along state to advance()
         next_state_kwargs = {}
@@ -301,20 +662,14 @@ class SubmitAction(object):
         If successful, sets state to PUSHING; if not, saves the error message
         and state to NOTIFY_FAILURE. In either case, advances the state machine.
         """
+        self.__record()
+
         # Dictionary to pass along state to advance()
         next_state_kwargs = {}
 
         # Commit the current content
-        description_newline = ''
-        if self.__description:
-            description_newline = '\n\n'
-        final_commit_message = utils.SQUASH_COMMIT_TEMPLATE % {
-            utils.SUBJECT: self.__subject,
-            utils.DESCRIPTION_NEWLINE: description_newline,
-            utils.ISSUE_DESCRIPTION: self.__description,
-            utils.ISSUE: self.__issue,
-            utils.SERVER: self.__server,
-        }
+        final_commit_message = _squash_commit_message(
+                self.__subject, self.__description, self.__issue, self.__server)
         print 'Adding commit:'
         print final_commit_message
         result, _, stderr = utils.capture_command(
@@ -333,11 +688,18 @@ class SubmitAction(object):
         """Pushes the squashed commit to the remote repository.
 
         If the push fails, saves the error message so it can be used to
-        notify the user.
+        notify the user or to decide how to retry the push.
 
-        If successful, sets state to CLEAN_UP_LOCAL, otherwise to
-        NOTIFY_FAILURE. In either case, advances the state machine.
+        If successful, sets state to CLEAN_UP_LOCAL. If not, sets state to
+        RETRY_PUSH if there are retries left, otherwise to NOTIFY_FAILURE. In
+        either case, advances the state machine.
         """
+        # Recorded so an interrupted push can be retried without rebuilding the
+        # commit.
+        squashed_commit = utils.get_head_commit(
+                current_branch=self.__review_branch)
+        self.__record(**{journal.SQUASHED_COMMIT: squashed_commit})
+
         # Dictionary to pass along state to advance()
         next_state_kwargs = {}
 
@@ -346,15 +708,124 @@ class SubmitAction(object):
                 'git', 'push', self.__remote, branch_mapping,
                 expect_success=False)
         if result != 0:
-            # TODO(dhermes): Should we try a sync and proceed if no failure?
             next_state_kwargs['error_message'] = stderr
-            self.state = self.NOTIFY_FAILURE
+            if self.__push_retries > 0:
+                next_state_kwargs['squashed_commit'] = squashed_commit
+                self.state = self.RETRY_PUSH
+            else:
+                self.state = self.NOTIFY_FAILURE
         else:
             next_state_kwargs['success'] = True
             self.state = self.CLEAN_UP_LOCAL
 
         self.advance(**next_state_kwargs)
 
+    def __fetch_remote_branch(self):
+        """Fetches only the remote branch the review is submitted to.
+
+        Returns:
+            String containing the commit hash of the fetched HEAD of the remote
+                branch.
+        """
+        return utils.fetch_remote_branch(self.__remote, self.__remote_branch)
+
+    def __rebuild_squashed_commit(self, squashed_commit, new_head):
+        """Rebuilds the squashed commit on a new HEAD of the remote branch.
+
+        The commit is built by _merge_onto, so the working tree is only
+        updated once.
+
+        Args:
+            squashed_commit: String; the hash of the squashed commit which was
+                rejected.
+            new_head: String; the hash of the new HEAD of the remote branch.
+
+        Returns:
+            String containing the hash of the rebuilt commit, now the HEAD of
+                the review branch, or None if the reviewed changes conflict with
+                the new commits in the remote branch.
+        """
+        rebuilt_commit = _merge_onto(
+                new_head, squashed_commit,
+                utils.get_commit_message(squashed_commit))
+        if rebuilt_commit is not None:
+            utils.capture_command('git', 'reset', '--hard', rebuilt_commit,
+                                  single_line=False)
+        return rebuilt_commit
+
+    def retry_push(self, error_message, squashed_commit):
+        """Prepares to retry a failed push.
+
+        Waits before each retry, doubling the wait every time. Only the remote
+        branch is fetched, to check whether the failed push actually landed,
+        even if others have pushed on top of it since. If it didn't and the
+        push was rejected because the remote branch moved, the approval is
+        verified again (cached issue metadata is used if it is fresh) and the
+        squashed commit is rebuilt on the new remote HEAD. Otherwise, the same
+        commit is pushed again.
+
+        If the commit is ready to be pushed, sets state to PUSHING. If the push
+        already landed, sets state to CLEAN_UP_LOCAL with success. If the commit
+        can't be rebuilt cleanly or the review is no longer approved, sets
+        state to CLEAN_UP_LOCAL without success. In any case, advances the
+        state machine.
+
+        Args:
+            error_message: String; a captured error from the "git push" command.
+            squashed_commit: String; the hash of the squashed commit which was
+                not pushed.
+        """
+        self.__record()
+
+        print 'Push to %s failed; retrying in %d second(s).' % (
+                self.__remote_branch, self.__push_retry_delay)
+        time.sleep(self.__push_retry_delay)
+        self.__push_retries -= 1
+        self.__push_retry_delay *= 2
+
+        # Dictionary to pass along state to advance()
+        next_state_kwargs = {}
+
+        try:
+            new_head = self.__fetch_remote_branch()
+        except utils.GitRvException:
+            new_head = None
+        if new_head is not None and utils.is_ancestor(squashed_commit,
+                                                      new_head):
+            print 'The failed push landed in %s.' % (self.__remote_branch,)
+            next_state_kwargs['success'] = True
+            self.state = self.CLEAN_UP_LOCAL
+            self.advance(**next_state_kwargs)
+            return
+        elif new_head is None or not _push_rejected(error_message):
+            self.state = self.PUSHING
+            self.advance()
+            return
+
+        approved = utils.is_current_issue_approved(issue=self.__issue,
+                                                   current_branch=self.__branch,
+                                                   server=self.__server)
+        if not approved:
+            print 'This review is no longer approved.'
+            next_state_kwargs['success'] = False
+            self.state = self.CLEAN_UP_LOCAL
+        else:
+            print 'Rebuilding the squashed commit on %s.' % (new_head,)
+            rebuilt_commit = self.__rebuild_squashed_commit(squashed_commit,
+                                                            new_head)
+            if rebuilt_commit is None:
+                print ('The reviewed changes conflict with new commits in %s. '
+                       'Run "git rv sync".' % (self.__remote_branch,))
+                next_state_kwargs['success'] = False
+                self.state = self.CLEAN_UP_LOCAL
+            else:
+                self.__last_synced = new_head
+                self.__record(**{utils.LAST_SYNCED: new_head,
+                                 journal.SQUASHED_COMMIT: rebuilt_commit})
+                self.state = self.PUSHING
+
+        self.advance(**next_state_kwargs)
+
     def notify_failure(self, error_message):
         """Notifies the user of the script failure.
 
@@ -364,8 +835,10 @@ class SubmitAction(object):
             error_message: String; a captured error from the "git push" command.
                 This is only set if a non-0 status code occurs in push_commit.
         """
+        self.__record()
+
         # TODO(dhermes): Should we just always suggest 'git rv sync'?
-        if utils.TIP_BEHIND_HINT in error_message:
+        if _push_rejected(error_message):
             print utils.TIP_BEHIND_HINT
             print
             print 'Run "git rv sync".'
@@ -394,23 +867,26 @@ class SubmitAction(object):
         Args:
             success: Boolean indicating whether or not the submit succeeded.
         """
+        self.__record(**{journal.SUCCESS: success})
+
         if success:
             print ('Replacing review branch %r with newly '
                    'committed content.' % (self.__branch,))
-            # Remove the review branch
-            utils.capture_command('git', 'branch', '-D', self.__branch,
-                                  single_line=False)
             # TODO(dhermes): The git push will update the locally stored
             #                version of the remote. Is this enough to guarantee
             #                we are doing the right thing here?
-            # Add back the review branch with HEAD at the new commit
+            # Move the review branch to the new commit. The branch is not
+            # checked out, so it can be forced, which also makes this safe to
+            # repeat when an interrupted submit is recovered.
             utils.capture_command(
-                    'git', 'branch', '--track', self.__branch,
+                    'git', 'branch', '--force', '--track', self.__branch,
                     self.__rietveld_info.remote_info.remote_branch_ref,
                     single_line=False)
 
             # Remove Rietveld metadata associated with the review branch
-            utils.RietveldInfo.remove(branch_name=self.__branch)
+            if self.__metadata_stored:
+                utils.RietveldInfo.remove(branch_name=self.__branch)
+            utils.delete_patchset_refs(self.__issue)
 
         # Check out the review branch. We use -f in case we failed in a detached
         # HEAD or dirty state and want to get back to our clean branch.
@@ -435,92 +911,6 @@ class SubmitAction(object):
             self.state = self.FINISHED
         self.advance()
 
-    def __get_xsrf_server(self):
-        """Gets an authenticated RPC server and XSRF token for API calls.
-
-        If the XSRF token exchange fails, simply notifies the user of the
-        failure and moves on.
-
-        Returns:
-            Tuple rpc_server, xsrf_token where rpc_server is an authenticated
-                upload.HttpRpcServer instance and xsrf_token is a string used to
-                make API requests to the Rietveld server.
-        """
-        rpc_server = GetRpcServer(**self.__rpc_server_args)
-        if not rpc_server.authenticated:
-            rpc_server._Authenticate()
-        try:
-            xsrf_token = rpc_server.Send('/' + utils.XSRF_TOKEN,
-                                         extra_headers=utils.XSRF_HEADERS)
-        except urllib2.HTTPError:
-            xsrf_token = None
-        return rpc_server, xsrf_token
-
-    def __add_commit_link(self, rpc_server, xsrf_token, commit_hash):
-        """Adds a link to the reviewed commit on the code review issue.
-
-        If no repository can be parsed from the remote URL, does nothing.
-
-        If the "publish" action fails, simply notifies the user of the failure
-        and moves on.
-
-        Args:
-            rpc_server: An authenticated instance of upload.HttpRpcServer.
-            xsrf_token: String containing XSRF token to make API requests.
-            commit_hash: String; the hash of the commit which we are trying
-                to publish a link to.
-        """
-        repository_info = self.__rietveld_info.remote_info.repository_info
-        if repository_info is None:
-            return
-
-        try:
-            commit_link = repository_info.commit_link(commit_hash)
-            message = 'Added in\n%s' % (commit_link,)
-            publish_request_values = {
-                utils.XSRF_TOKEN: xsrf_token,
-                utils.MESSAGE: message,
-                utils.CC: self.__rietveld_info.cc,
-                utils.REVIEWERS: self.__rietveld_info.reviewers,
-                utils.SUBJECT: self.__subject,
-            }
-            publish_request_values.update(utils.PUBLISH_ISSUE_BASE)
-            publish_request_body = urllib.urlencode(publish_request_values)
-            publish_issue_uri = utils.PUBLISH_ISSUE_MESSAGE_TEMPLATE % {
-                  utils.ISSUE: self.__issue}
-            rpc_server.Send(publish_issue_uri, payload=publish_request_body)
-        except urllib2.HTTPError:
-            print utils.FAILED_PUBLISH_TEMPLATE % {
-                utils.ISSUE: self.__issue,
-                utils.SERVER: self.__server,
-                utils.MESSAGE: message,
-            }
-        else:
-            print 'Message:\n%s\nposted to code review issue.' % (message,)
-
-    def __close_issue(self, rpc_server, xsrf_token):
-        """Closes the issue associated with the current SubmitAction.
-
-        If the "close" action fails, simply notifies the user of the failure and
-        moves on.
-
-        Args:
-            rpc_server: An authenticated instance of upload.HttpRpcServer.
-            xsrf_token: String containing XSRF token to make API requests.
-        """
-        try:
-            xsrf_request_body = urllib.urlencode({utils.XSRF_TOKEN: xsrf_token})
-            close_issue_uri = utils.CLOSE_ISSUE_TEMPLATE % {
-                  utils.ISSUE: self.__issue}
-            rpc_server.Send(close_issue_uri, payload=xsrf_request_body)
-        except urllib2.HTTPError:
-            print utils.FAILED_CLOSE_TEMPLATE % {
-                utils.ISSUE: self.__issue,
-                utils.SERVER: self.__server
-            }
-        else:
-            print 'Issue %d has been closed.' % (self.__issue,)
-
     def clean_up_review(self):
         """Cleans up the issue on the review server after successful commit.
 
@@ -528,16 +918,27 @@ class SubmitAction(object):
         changes were committed. If not explicitly asked to be left open by the
         user (via --leave_open), the issue will be closed as well.
 
+        Since the commit has already landed, these requests are stored in the
+        local outbox and sent by a background process rather than making the
+        user wait on them.
+
         If successful, sets state to FINISHED and advances the state machine.
         """
-        rpc_server, xsrf_token = self.__get_xsrf_server()
+        self.__record()
+
         # We know this will be the commit just pushed since clean_up_local has
         # just succeeded.
         commit_hash = utils.get_head_commit(current_branch=self.__branch)
 
-        self.__add_commit_link(rpc_server, xsrf_token, commit_hash)
-        if self.__do_close:
-            self.__close_issue(rpc_server, xsrf_token)
+        operations = _review_operations(self.__rietveld_info, self.__subject,
+                                        commit_hash, self.__do_close)
+        if operations:
+            outbox.enqueue(self.__issue, self.__server,
+                           self.__rpc_server_args, operations)
+            outbox.flush_in_background()
+            print ('Updating issue %d on the code review server in the '
+                   'background.' % (self.__issue,))
+            print 'Run "git rv outbox" to check on pending updates.'
 
         self.state = self.FINISHED
         self.advance()
@@ -571,6 +972,8 @@ class SubmitAction(object):
             self.commit(*args, **kwargs)
         elif self.state == self.PUSHING:
             self.push_commit(*args, **kwargs)
+        elif self.state == self.RETRY_PUSH:
+            self.retry_push(*args, **kwargs)
         elif self.state == self.NOTIFY_FAILURE:
             self.notify_failure(*args, **kwargs)
         elif self.state == self.CLEAN_UP_LOCAL:
@@ -578,7 +981,603 @@ class SubmitAction(object):
         elif self.state == self.CLEAN_UP_REVIEW:
             self.clean_up_review(*args, **kwargs)
         elif self.state == self.FINISHED:
+            # Only clear the journal if this action wrote it.
+            if self.__journal_entry is not None:
+                journal.clear(self.__branch)
             return
         else:
             raise utils.GitRvException('Unexpected state %r in SubmitAction.' %
                                        (self.state,))
+
+
+class SubmitQueueAction(object):
+    """A state machine which submits several reviewed branches in order.
+
+    All the branches must be reviewed against the same remote branch.
+    Approvals are checked concurrently and the remote branch is fetched once.
+    Each squashed commit is then built from git objects on top of the one
+    before it and pushed, so nothing is checked out between submits.
+
+    Attributes:
+        state: The current state of the SubmitQueueAction state machine.
+        __branches: List of strings; the branches to submit, in order.
+        __rpc_server_args: A dictionary of arguments parsed from the command
+            line that will be passed to GetRpcServer when using it to sign in a
+            user to close and comment on the issues.
+        __do_close: Boolean; Represents whether the issues should be closed
+            after pushing the commits.
+        __full_diff: Boolean; whether to show the full diff rather than a
+            summary if the current branch is not in a clean state.
+        __skip_presubmit: Boolean; whether to skip the presubmit checks.
+        __current_branch: String; the current branch when the action begins.
+        __rietveld_infos: Dictionary mapping each branch to its RietveldInfo.
+        __remote: String; the remote the branches are submitted to.
+        __remote_branch: String; the remote branch the branches are submitted
+            to.
+        __head: String; the hash of the commit the next squashed commit is
+            built on.
+        __submitted: List of tuples, containing the RietveldInfo object,
+            subject and squashed commit hash of each submitted branch.
+    """
+
+    CHECK_BRANCHES = 0
+    VERIFY_APPROVALS = 1
+    FETCH_REMOTE = 2
+    SUBMIT_BRANCHES = 3
+    UPDATE_REVIEWS = 4
+    FINISHED = 5
+
+    def __init__(self, branches, rpc_server_args, do_close=True,
+                 full_diff=False, skip_presubmit=False):
+        """Constructor for SubmitQueueAction.
+
+        Args:
+            branches: List of strings; the branches to submit, in order.
+            rpc_server_args: A dictionary of arguments to be passed to
+                GetRpcServer.
+            do_close: Boolean; Represents whether the issues should be closed
+                after pushing the commits. Defaults to True.
+            full_diff: Boolean; whether to show the full diff rather than a
+                summary if the current branch is not in a clean state.
+                Defaults to False.
+            skip_presubmit: Boolean; whether to skip the presubmit checks.
+                Defaults to False.
+        """
+        self.__branches = []
+        for branch in branches:
+            if branch not in self.__branches:
+                self.__branches.append(branch)
+        self.__rpc_server_args = rpc_server_args
+        self.__do_close = do_close
+        self.__full_diff = full_diff
+        self.__skip_presubmit = skip_presubmit
+        self.__current_branch = utils.get_current_branch()
+        self.__rietveld_infos = {}
+        self.__remote = None
+        self.__remote_branch = None
+        self.__head = None
+        self.__submitted = []
+
+        self.state = self.CHECK_BRANCHES
+        self.advance()
+
+    def check_branches(self):
+        """Checks that every branch in the queue can be submitted.
+
+        Each branch must be in review against the same remote branch and have
+        no interrupted command. If the current branch is in the queue, it must
+        be in a clean state since it will be moved.
+
+        If all branches can be submitted, sets state to VERIFY_APPROVALS,
+        otherwise notifies the user and sets state to FINISHED. In either case,
+        advances the state machine.
+        """
+        self.state = self.FINISHED
+
+        targets = set()
+        for branch in self.__branches:
+            rietveld_info = utils.RietveldInfo.from_branch(branch_name=branch)
+            if (rietveld_info is None or rietveld_info.review_info is None or
+                rietveld_info.remote_info is None):
+                print 'No review data found in branch %r.' % (branch,)
+                self.advance()
+                return
+            if not journal.check_not_interrupted(branch):
+                self.advance()
+                return
+            if rietveld_info.parent_branch is not None:
+                print STACKED_REVIEW_TEMPLATE % {
+                    'branch': branch,
+                    'parent': rietveld_info.parent_branch,
+                }
+                self.advance()
+                return
+            self.__rietveld_infos[branch] = rietveld_info
+            targets.add((rietveld_info.remote_info.remote,
+                         rietveld_info.remote_info.branch))
+
+        if len(targets) != 1:
+            print ('All branches in the queue must be reviewed against the '
+                   'same remote branch.')
+        elif (self.__current_branch in self.__branches and
+              not utils.in_clean_state(trust_index=False)):
+            utils.print_unclean_state(self.__current_branch,
+                                      full_diff=self.__full_diff)
+        else:
+            self.__remote, self.__remote_branch = targets.pop()
+            self.state = self.VERIFY_APPROVALS
+
+        self.advance()
+
+    def verify_approvals(self):
+        """Verifies that the issue for each branch has been approved.
+
+        The issue metadata is requested from the code review server
+        concurrently, by a bounded pool of threads. Then the presubmit checks
+        are run on each approved branch, unless they are skipped. A branch
+        other than the current one is checked in a temporary worktree. Branches
+        which are not approved, whose metadata can't be retrieved or which fail
+        the checks are removed from the queue.
+
+        If any branches are left, sets state to FETCH_REMOTE, otherwise sets
+        state to FINISHED. In either case, advances the state machine.
+        """
+        def get_issue_metadata(branch):
+            """Gets the issue metadata for a branch."""
+            rietveld_info = self.__rietveld_infos[branch]
+            return utils.get_issue_metadata(
+                    issue=rietveld_info.review_info.issue,
+                    server=rietveld_info.server)
+
+        issue_metadata = utils.run_concurrently(get_issue_metadata,
+                                                self.__branches)
+
+        approved_branches = []
+        for branch in self.__branches:
+            metadata = issue_metadata[branch]
+            if isinstance(metadata, Exception):
+                print 'Could not check approval of branch %r:\n%s' % (
+                        branch, metadata)
+            elif not utils.issue_approved(metadata):
+                print 'The review for branch %r has not been approved.' % (
+                        branch,)
+            else:
+                # The metadata was just cached, so this makes no request.
+                success, _ = utils.update_rietveld_metadata_from_issue(
+                        rietveld_info=self.__rietveld_infos[branch])
+                if not success:
+                    print 'Metadata update from code server failed for %r.' % (
+                            branch,)
+                elif not self.__skip_presubmit and not presubmit.run_checks(
+                        self.__rietveld_infos[branch].last_synced,
+                        utils.get_head_commit(current_branch=branch),
+                        in_worktree=branch != self.__current_branch):
+                    print 'Presubmit checks failed for branch %r.' % (branch,)
+                else:
+                    approved_branches.append(branch)
+
+        if approved_branches:
+            self.__branches = approved_branches
+            self.state = self.FETCH_REMOTE
+        else:
+            print 'No branches left to submit.'
+            self.state = self.FINISHED
+        self.advance()
+
+    def fetch_remote(self):
+        """Fetches only the remote branch the queue is submitted to.
+
+        If the current branch is in the queue, HEAD is also detached so the
+        branch can be moved once it is submitted.
+
+        If successful, sets state to SUBMIT_BRANCHES and advances the state
+        machine.
+        """
+        self.__head = utils.fetch_remote_branch(self.__remote,
+                                                self.__remote_branch)
+
+        if self.__current_branch in self.__branches:
+            utils.capture_command('git', 'checkout', '--detach',
+                                  single_line=False)
+
+        self.state = self.SUBMIT_BRANCHES
+        self.advance()
+
+    def __submit_branch(self, branch):
+        """Builds and pushes the squashed commit for a branch.
+
+        The commit is built on __head. Before it is pushed, a journal entry
+        is written in the same form a SubmitAction uses, so an interrupted push
+        can be finished with "git rv recover". A push can land even if git
+        reports a failure, so after a failure the remote branch is fetched to
+        check. The journal entry is only cleared if the push didn't land, and
+        kept if the remote branch can't be fetched.
+
+        Args:
+            branch: String; containing the name of a branch in the queue.
+
+        Returns:
+            Boolean indicating whether the queue can continue with the next
+                branch.
+        """
+        rietveld_info = self.__rietveld_infos[branch]
+        review_info = rietveld_info.review_info
+        remote_info = rietveld_info.remote_info
+
+        commit_message = _squash_commit_message(
+                review_info.subject, review_info.description, review_info.issue,
+                rietveld_info.server)
+        branch_head = utils.get_head_commit(current_branch=branch)
+        try:
+            squashed_commit = _merge_onto(self.__head, branch_head,
+                                          commit_message)
+        except utils.GitRvException, exc:  # Syntax for python<2.6
+            print exc
+            return False
+        if squashed_commit is None:
+            print ('Branch %r conflicts with %s, so it was not submitted. Run '
+                   '"git rv sync" in it and submit it again.' %
+                   (branch, remote_info.remote_branch_ref))
+            return True
+
+        journal_entry = _journal_entry(
+                branch, rietveld_info, review_info.subject,
+                review_info.description, self.__head, self.__rpc_server_args,
+                self.__do_close)
+        journal_entry[journal.REVIEW_BRANCH] = (
+                BRANCH_NAME_TEMPLATE % review_info.issue)
+        journal_entry[journal.SQUASHED_COMMIT] = squashed_commit
+        journal_entry[journal.STATE] = SubmitAction.PUSHING
+        journal.record(journal_entry)
+
+        branch_mapping = '%s:%s' % (
+                squashed_commit,
+                utils.BRANCH_REF_TEMPLATE % (self.__remote_branch,))
+        result, _, stderr = utils.capture_command(
+                'git', 'push', self.__remote, branch_mapping,
+                expect_success=False)
+        if result != 0:
+            print 'Pushing branch %r failed:\n%s' % (branch, stderr)
+            try:
+                remote_head = utils.fetch_remote_branch(self.__remote,
+                                                        self.__remote_branch)
+            except utils.GitRvException, exc:  # Syntax for python<2.6
+                print exc
+                print ('Could not check whether the push landed. Run "git rv '
+                       'recover %s" to finish or undo the submit.' % (branch,))
+                return False
+            if not utils.is_ancestor(squashed_commit, remote_head):
+                journal.clear(branch)
+                return False
+            print 'The failed push landed in %s.' % (self.__remote_branch,)
+        else:
+            # Update the remote branch without fetching.
+            utils.capture_command('git', 'update-ref',
+                                  utils.REMOTE_BRANCH_REF_TEMPLATE % (
+                                          self.__remote, self.__remote_branch),
+                                  squashed_commit, single_line=False)
+
+        print 'Submitted branch %r as %s.' % (branch, squashed_commit)
+        utils.capture_command('git', 'branch', '--force', '--track', branch,
+                              remote_info.remote_branch_ref, single_line=False)
+        utils.RietveldInfo.remove(branch_name=branch)
+        utils.delete_patchset_refs(review_info.issue)
+        journal.clear(branch)
+
+        self.__head = squashed_commit
+        self.__submitted.append(
+                (rietveld_info, review_info.subject, squashed_commit))
+        return True
+
+    def submit_branches(self):
+        """Submits the branches in the queue, in order.
+
+        Stops at the first branch which can't be pushed, since the remote
+        branch has most likely moved.
+
+        If the current branch was detached, checks it back out. Sets state to
+        UPDATE_REVIEWS and advances the state machine.
+        """
+        for index, branch in enumerate(self.__branches):
+            if not self.__submit_branch(branch):
+                remaining = self.__branches[index:]
+                print 'Branches not submitted: %s' % (', '.join(remaining),)
+                break
+
+        if self.__current_branch in self.__branches:
+            utils.capture_command('git', 'checkout', self.__current_branch,
+                                  single_line=False)
+
+        self.state = self.UPDATE_REVIEWS
+        self.advance()
+
+    def update_reviews(self):
+        """Queues the review server updates for the submitted branches.
+
+        As in SubmitAction, the requests are stored in the local outbox and
+        sent by a single background process.
+
+        Sets state to FINISHED and advances the state machine.
+        """
+        queued = False
+        for rietveld_info, subject, commit_hash in self.__submitted:
+            operations = _review_operations(rietveld_info, subject,
+                                            commit_hash, self.__do_close)
+            if operations:
+                rpc_server_args = dict(self.__rpc_server_args,
+                                       server=rietveld_info.server)
+                outbox.enqueue(rietveld_info.review_info.issue,
+                               rietveld_info.server, rpc_server_args,
+                               operations)
+                queued = True
+
+        if queued:
+            outbox.flush_in_background()
+            print ('Updating submitted issues on the code review server in '
+                   'the background.')
+            print 'Run "git rv outbox" to check on pending updates.'
+
+        print 'Submitted %d of %d branches.' % (len(self.__submitted),
+                                                len(self.__branches))
+        self.state = self.FINISHED
+        self.advance()
+
+    def advance(self, *args, **kwargs):
+        """Advances by calling the method corresponding to the current state.
+
+        Args:
+            *args: Arguments to be passed to the specified method based on
+                the current state.
+            **kwargs: Keyword arguments to be passed to the specified method
+                based on the current state.
+
+        Raises:
+            GitRvException: If this method is called and the state is not one
+                of the valid states.
+        """
+        if self.state == self.CHECK_BRANCHES:
+            self.check_branches(*args, **kwargs)
+        elif self.state == self.VERIFY_APPROVALS:
+            self.verify_approvals(*args, **kwargs)
+        elif self.state == self.FETCH_REMOTE:
+            self.fetch_remote(*args, **kwargs)
+        elif self.state == self.SUBMIT_BRANCHES:
+            self.submit_branches(*args, **kwargs)
+        elif self.state == self.UPDATE_REVIEWS:
+            self.update_reviews(*args, **kwargs)
+        elif self.state == self.FINISHED:
+            return
+        else:
+            raise utils.GitRvException(
+                    'Unexpected state %r in SubmitQueueAction.' % (self.state,))
+
+
+class SubmitPlanAction(object):
+    """A state machine which reports what a SubmitAction would do.
+
+    Walks the steps of a SubmitAction using only local state, the issue cache
+    and "git ls-remote", so nothing is changed locally, in the remote or on
+    the code review server.
+
+    Attributes:
+        state: The current state of the SubmitPlanAction state machine.
+        __branch: String; the current branch.
+        __rietveld_info: RietveldInfo object for the current branch, or None.
+        __do_close: Boolean; Represents whether the issue would be closed
+            after pushing the commit.
+        __push_retries: Integer; the number of times a rejected push would be
+            retried.
+        __head_commit: String; the commit hash of HEAD in the current branch.
+        __requests: List of strings, each describing a request the submit
+            would make to the code review server.
+    """
+
+    CHECK_ENVIRONMENT = 0
+    PLAN_COMMIT = 1
+    PLAN_PUSH = 2
+    PLAN_REVIEW_UPDATES = 3
+    REPORT_REQUESTS = 4
+    FINISHED = 5
+
+    def __init__(self, do_close=True, push_retries=0):
+        """Constructor for SubmitPlanAction.
+
+        Args:
+            do_close: Boolean; Represents whether the issue would be closed
+                after pushing the commit. Defaults to True.
+            push_retries: Integer; the number of times a rejected push would
+                be retried. Defaults to 0.
+        """
+        self.__branch = utils.get_current_branch()
+        self.__rietveld_info = utils.RietveldInfo.from_branch(
+                branch_name=self.__branch)
+        self.__do_close = do_close
+        self.__push_retries = push_retries
+        self.__head_commit = utils.get_head_commit(current_branch=self.__branch)
+        self.__requests = []
+
+        print 'Dry run of "git rv submit" in branch %r; nothing will change.' % (
+                self.__branch,)
+        self.state = self.CHECK_ENVIRONMENT
+        self.advance()
+
+    def check_environment(self):
+        """Reports the checks SubmitAction makes before changing anything.
+
+        Approval is read from the issue cache if it is fresh, otherwise the
+        last known approval is reported along with the request which would be
+        made to check it.
+
+        If the submit would go ahead, sets state to PLAN_COMMIT, otherwise sets
+        state to REPORT_REQUESTS or FINISHED. In either case, advances the
+        state machine.
+        """
+        rietveld_info = self.__rietveld_info
+        if (rietveld_info is None or rietveld_info.review_info is None or
+            rietveld_info.remote_info is None):
+            print 'No review data found in branch %r.' % (self.__branch,)
+            self.state = self.FINISHED
+            self.advance()
+            return
+
+        self.state = self.REPORT_REQUESTS
+        issue = rietveld_info.review_info.issue
+        journal_entry = journal.load(self.__branch)
+        if not utils.in_clean_state(trust_index=False):
+            print 'Would stop: branch %r not in clean state.' % (self.__branch,)
+        elif journal_entry is not None:
+            print ('Would stop: a "git rv %s" was interrupted in branch %r. '
+                   'Run "git rv recover".' % (journal_entry[journal.COMMAND],
+                                              self.__branch))
+        elif rietveld_info.parent_branch is not None:
+            print 'Would stop: ' + STACKED_REVIEW_TEMPLATE % {
+                'branch': self.__branch,
+                'parent': rietveld_info.parent_branch,
+            }
+        else:
+            cache_entry = utils.read_cached_issue_metadata(
+                    issue, rietveld_info.server,
+                    max_age=utils.ISSUE_METADATA_MAX_AGE)
+            if cache_entry is None:
+                self.__requests.append('GET %s' % (
+                        utils.ISSUE_URI_PATH_TEMPLATE % {utils.ISSUE: issue},))
+                approved = rietveld_info.approved
+                source = 'last known'
+            else:
+                approved = utils.issue_approved(cache_entry[utils.METADATA])
+                source = 'cached'
+
+            if approved is None:
+                print 'Approval: unknown until checked with the server.'
+                self.state = self.PLAN_COMMIT
+            elif approved:
+                print 'Approval (%s): approved.' % (source,)
+                self.state = self.PLAN_COMMIT
+            else:
+                print 'Would stop: this review has not been approved (%s).' % (
+                        source,)
+
+        self.advance()
+
+    def plan_commit(self):
+        """Reports the message of the squashed commit.
+
+        The subject and description are those last pulled from the code review
+        server; a submit updates them first.
+
+        Sets state to PLAN_PUSH and advances the state machine.
+        """
+        review_info = self.__rietveld_info.review_info
+        commit_message = _squash_commit_message(
+                review_info.subject, review_info.description, review_info.issue,
+                self.__rietveld_info.server)
+        print 'Squashed commit message:'
+        for line in commit_message.split('\n'):
+            print ('    %s' % (line,)).rstrip()
+
+        self.state = self.PLAN_PUSH
+        self.advance()
+
+    def plan_push(self):
+        """Reports the size of the push and whether it would fast-forward.
+
+        The squashed commit has the same tree as HEAD, so the objects to push
+        are the new blobs in HEAD since the last sync, plus trees and the
+        commit itself.
+
+        If the push would succeed (possibly after a retry), sets state to
+        PLAN_REVIEW_UPDATES, otherwise sets state to REPORT_REQUESTS. In
+        either case, advances the state machine.
+        """
+        remote_info = self.__rietveld_info.remote_info
+        last_synced = remote_info.last_synced
+        changed_files = utils.get_changed_files(last_synced, self.__head_commit)
+        new_blobs = set(head_hash for _, _, head_hash in changed_files
+                        if head_hash != utils.NULL_HASH)
+        blob_sizes = utils.get_object_sizes(list(new_blobs))
+        print ('Push: %d files changed since the last sync, about %d bytes in '
+               '%d new blobs plus trees and the commit.' %
+               (len(changed_files), sum(blob_sizes.values()), len(new_blobs)))
+
+        remote_head = utils.peek_remote_head(remote_info)
+        if remote_head == last_synced:
+            print 'The push would fast-forward %s.' % (
+                    remote_info.remote_branch_ref,)
+            print ('Working tree: no files rewritten, since the squashed '
+                   'commit has the same tree as HEAD.')
+            self.state = self.PLAN_REVIEW_UPDATES
+        else:
+            print ('The push would not fast-forward %s, which has moved since '
+                   'the last sync.' % (remote_info.remote_branch_ref,))
+            if self.__push_retries <= 0:
+                print 'Would stop: run "git rv sync" first.'
+                self.state = self.REPORT_REQUESTS
+            else:
+                if remote_head is not None and utils.commit_exists(remote_head):
+                    rewritten = len(utils.get_changed_files(last_synced,
+                                                            remote_head))
+                    print ('A retry would fetch it and rebuild the squashed '
+                           'commit on it, rewriting %d files in the working '
+                           'tree.' % (rewritten,))
+                else:
+                    print ('A retry would fetch it and rebuild the squashed '
+                           'commit on it, if it applies cleanly.')
+                self.state = self.PLAN_REVIEW_UPDATES
+
+        self.advance()
+
+    def plan_review_updates(self):
+        """Reports the requests the outbox would send after the push.
+
+        Sets state to REPORT_REQUESTS and advances the state machine.
+        """
+        # The link is to the squashed commit, which doesn't exist yet, but only
+        # the request URI is reported.
+        operations = _review_operations(
+                self.__rietveld_info, self.__rietveld_info.review_info.subject,
+                self.__head_commit, self.__do_close)
+        for operation in operations:
+            self.__requests.append('POST %s (in the background)' % (
+                    operation[outbox.URI],))
+
+        self.state = self.REPORT_REQUESTS
+        self.advance()
+
+    def report_requests(self):
+        """Reports the requests the submit would make to the server.
+
+        Sets state to FINISHED and advances the state machine.
+        """
+        utils.print_planned_requests(self.__rietveld_info.server,
+                                     self.__requests)
+        self.state = self.FINISHED
+        self.advance()
+
+    def advance(self, *args, **kwargs):
+        """Advances by calling the method corresponding to the current state.
+
+        Args:
+            *args: Arguments to be passed to the specified method based on
+                the current state.
+            **kwargs: Keyword arguments to be passed to the specified method
+                based on the current state.
+
+        Raises:
+            GitRvException: If this method is called and the state is not one
+                of the valid states.
+        """
+        if self.state == self.CHECK_ENVIRONMENT:
+            self.check_environment(*args, **kwargs)
+        elif self.state == self.PLAN_COMMIT:
+            self.plan_commit(*args, **kwargs)
+        elif self.state == self.PLAN_PUSH:
+            self.plan_push(*args, **kwargs)
+        elif self.state == self.PLAN_REVIEW_UPDATES:
+            self.plan_review_updates(*args, **kwargs)
+        elif self.state == self.REPORT_REQUESTS:
+            self.report_requests(*args, **kwargs)
+        elif self.state == self.FINISHED:
+            return
+        else:
+            raise utils.GitRvException(
+                    'Unexpected state %r in SubmitPlanAction.' % (self.state,))
@@ -22,6 +22,8 @@ remote repository.
 import argparse
 
 from export import ExportAction
+from export import upload_patch
+import journal
 import utils
 
 
@@ -35,6 +37,72 @@ To revert back, you could execute
 UNEXPORTED_CHANGES_BLOCK_SYNC = """\
 You have changes which have not been exported.
 Please export them before syncing."""
+PARENT_NOT_IN_REVIEW_TEMPLATE = """\
+Branch %(parent)r is no longer in review, so branch %(branch)r is no
+longer stacked on it and is synced with %(remote_branch)s instead."""
+
+
+def _get_parent_head(rietveld_info):
+    """Gets the last commit exported in the parent of a stacked review.
+
+    Args:
+        rietveld_info: RietveldInfo object for a review branch.
+
+    Returns:
+        String containing the hash of the last commit exported in the parent
+            review, or None if the review is not stacked or if its parent is
+            no longer in review (e.g. because it was submitted).
+    """
+    if rietveld_info.parent_branch is None:
+        return None
+    parent_info = utils.RietveldInfo.from_branch(
+            branch_name=rietveld_info.parent_branch)
+    if parent_info is None or parent_info.review_info is None:
+        return None
+    return parent_info.review_info.last_commit
+
+
+def _unstack(branch, rietveld_info):
+    """Stops diffing a review against a parent which is no longer in review.
+
+    The review is diffed against its remote branch from then on. Since the
+    parent was most likely submitted, syncing with the remote branch brings
+    in the parent's changes.
+
+    Args:
+        branch: String; the name of the stacked review branch.
+        rietveld_info: RietveldInfo object for the branch.
+    """
+    print PARENT_NOT_IN_REVIEW_TEMPLATE % {
+        'parent': rietveld_info.parent_branch,
+        'branch': branch,
+        'remote_branch': rietveld_info.remote_info.remote_branch_ref,
+    }
+    rietveld_info.remove_key(utils.PARENT_LAST_SYNCED)
+    rietveld_info.remove_key(utils.PARENT_BRANCH)
+
+
+def _merge_into(head, commit, commit_message):
+    """Builds a commit merging another commit into a branch head.
+
+    Like "git merge --squash" followed by "git commit", the new commit has
+    head as its only parent. It is built with utils.merge_trees and "git
+    commit-tree", so the branch doesn't need to be checked out.
+
+    Args:
+        head: String; the hash of the head commit of the branch.
+        commit: String; the hash of the commit to merge in.
+        commit_message: String; the message of the new commit.
+
+    Returns:
+        String containing the hash of the new commit, or None if the merge has
+            conflicts.
+    """
+    tree = utils.merge_trees(head, commit)
+    if tree is None:
+        return None
+    return utils.capture_command('git', 'commit-tree', tree, '-p', head,
+                                 '-m', commit_message)
 
 
 class SyncAction(object):
@@ -56,6 +124,9 @@ class SyncAction(object):
         __last_synced: String containing the hash of the last remote commit
             that was synced with this review. Added by fetch_remote method when
             doing a new sync and by check_continue method when resuming a sync.
+        __journal_entry: Dictionary; the journal entry recording the progress
+            of this action, or None until the first state which changes the
+            branch is entered.
     """
 
     STARTING = 0
@@ -68,7 +139,8 @@ class SyncAction(object):
     CLEAN_UP = 7
     FINISHED = 8
 
-    def __init__(self, in_continue, export_action_args, export_action_argv):
+    def __init__(self, in_continue, export_action_args, export_action_argv,
+                 journal_entry=None):
         """Constructor for SyncAction.
 
         Args:
@@ -78,8 +150,12 @@ class SyncAction(object):
                 in to ExportAction.callback.
             export_action_argv: Command line arguments modified to be passed in
                 to ExportAction.callback.
+            journal_entry: Dictionary; the journal entry of an interrupted
+                SyncAction to resume from the state stored in the entry.
+                Defaults to None, in which case a new sync is begun.
         """
         self.__continue = in_continue
+        self.__journal_entry = journal_entry
         self.__branch = utils.get_current_branch()
         self.__rietveld_info = utils.RietveldInfo.from_branch(
                 branch_name=self.__branch)
@@ -91,24 +167,40 @@ class SyncAction(object):
         if self.__rietveld_info is None:
             print 'There is no review data for branch %r.' % (self.__branch,)
             self.state = self.FINISHED
+        elif journal_entry is not None:
+            self.__last_commit = journal_entry[journal.HEAD]
+            self.__last_synced = journal_entry[utils.LAST_SYNCED]
+            self.__sync_halted = bool(self.__rietveld_info.sync_halted)
+            self.state = journal_entry[journal.STATE]
         else:
             self.state = self.STARTING
         self.advance()
 
     @classmethod
-    def callback(cls, args, argv):
+    def callback(cls, args, argv, journal_entry=None):
         """A callback to begin a SyncAction after arguments are parsed.
 
         Args:
             args: An argparse.Namespace object parsed from the command line.
             argv: The original command line arguments that were parsed to create
                 args.
+            journal_entry: Dictionary; the journal entry of an interrupted
+                SyncAction to resume. Defaults to None.
 
         Returns:
             An instance of SyncAction. Just by creating a new instance,
                 the state machine will begin working.
         """
         in_continue = args.in_continue
+        if args.stack and (in_continue or args.dry_run):
+            raise utils.GitRvException('--stack can\'t be combined with '
+                                       '--continue or --dry_run.')
+        if args.dry_run:
+            return SyncPlanAction(in_continue=in_continue,
+                                  send_mail=not args.no_mail)
+        if args.stack:
+            return SyncStackAction(argv[1:], send_mail=not args.no_mail,
+                                   full_diff=args.full_diff)
 
         # Prepare args to be passed to ExportAction.callback
         args = cls.__clean_args_for_export(args)
@@ -132,7 +224,21 @@ class SyncAction(object):
             argv = [value for value in argv if not value.startswith('--c')]
 
         return cls(in_continue=in_continue, export_action_args=args,
-                   export_action_argv=argv)
+                   export_action_argv=argv, journal_entry=journal_entry)
+
+    def __record(self):
+        """Records the current state in the journal before it is entered."""
+        if self.__journal_entry is None:
+            self.__journal_entry = {
+                journal.COMMAND: utils.SYNC,
+                utils.BRANCH: self.__branch,
+                journal.HEAD: self.__last_commit,
+                utils.LAST_SYNCED: self.__last_synced,
+                journal.PREVIOUS_LAST_SYNCED: self.__rietveld_info.last_synced,
+                journal.ARGV: self.__export_action_argv,
+            }
+        self.__journal_entry[journal.STATE] = self.state
+        journal.record(self.__journal_entry)
 
     @staticmethod
     def __clean_args_for_export(args):
@@ -152,7 +258,10 @@ class SyncAction(object):
         """
         del args.in_continue
         args.message = args.title = args.cc = args.reviewers = None
+        args.parent_branch = None
         args.send_patch = False
+        # The sync only merges in changes which have already been submitted.
+        args.skip_presubmit = True
         # server and private will be set in __init__ after RietveldInfo
         # is retrieved.
         return args
@@ -160,23 +269,25 @@ class SyncAction(object):
     def check_environment(self):
         """Checks that a sync can be performed.
 
+        A sync can't be performed if the branch isn't clean or if an earlier
+        submit or sync was interrupted in the branch.
+
         If a sync can't be performed, sets state to FINISHED. If it can be,
         sets state to CHECK_CONTINUE or CHECK_NEW, depending on whether the sync
         is a continue sync or a new sync.
         """
         # Make sure branch is clean
         if not utils.in_clean_state():
-            print 'Branch %r not in clean state:' % (self.__branch,)
-            print utils.capture_command('git', 'diff', single_line=False)
+            utils.print_unclean_state(
+                    self.__branch,
+                    full_diff=self.__export_action_args.full_diff)
+            self.state = self.FINISHED
+        elif not journal.check_not_interrupted(self.__branch):
             self.state = self.FINISHED
         else:
             # TODO(dhermes): This assumes review_info is not None. Fix this.
             self.__last_commit = self.__rietveld_info.review_info.last_commit
-            # Using getattr since SYNC_HALTED is not an explicit attribute in
-            # RietveldInfo, hence accessing rietveld_info.sync_halted may result
-            # in an AttributeError.
-            self.__sync_halted = getattr(self.__rietveld_info,
-                                         utils.SYNC_HALTED, False)
+            self.__sync_halted = bool(self.__rietveld_info.sync_halted)
             if self.__continue:
                 self.state = self.CHECK_CONTINUE
             else:
@@ -201,9 +312,11 @@ class SyncAction(object):
                 print 'Please make a commit after resolving the merge conflict.'
                 self.state = self.FINISHED
             elif len(commits) == 1:
-                remote_info = self.__rietveld_info.remote_info
                 # This must be set for export_to_review to work.
-                self.__last_synced = remote_info.head_in_remote_branch
+                self.__last_synced = _get_parent_head(self.__rietveld_info)
+                if self.__last_synced is None:
+                    remote_info = self.__rietveld_info.remote_info
+                    self.__last_synced = remote_info.head_in_remote_branch
                 self.state = self.EXPORT
             else:
                 template_args = {'commit': commits[-1]}
@@ -236,13 +349,35 @@ class SyncAction(object):
     def fetch_remote(self):
         """Fetchs the remote associated with the current review.
 
-        If the fetched remote has no new commits, sets state to FINISHED,
+        A stacked review is synced with the last commit exported in its parent
+        review instead, so nothing is fetched. If the parent is no longer in
+        review, the review is unstacked and synced with the remote.
+
+        If there are no new commits to merge, sets state to FINISHED,
         otherwise sets state to MERGE_REMOTE_IN.
         """
+        rietveld_info = self.__rietveld_info
+        if rietveld_info.parent_branch is not None:
+            parent_head = _get_parent_head(rietveld_info)
+            if parent_head is None:
+                _unstack(self.__branch, rietveld_info)
+            else:
+                if parent_head == rietveld_info.last_synced:
+                    print 'No new changes exported in branch %r.' % (
+                            rietveld_info.parent_branch,)
+                    self.state = self.FINISHED
+                else:
+                    self.state = self.MERGE_REMOTE_IN
+                self.__last_synced = parent_head
+                self.advance()
+                return
+
         # TODO(dhermes): This assumes remote_info is not None. Fix this.
-        remote_info = self.__rietveld_info.remote_info
+        remote_info = rietveld_info.remote_info
         print utils.capture_command('git', 'fetch', remote_info.remote,
                                     single_line=False)
+        # Keep ancestry checks against the newly fetched history cheap.
+        utils.write_commit_graph()
 
         new_head_in_remote = remote_info.head_in_remote_branch
         if new_head_in_remote == self.__rietveld_info.remote_info.last_synced:
@@ -259,6 +394,8 @@ class SyncAction(object):
         If there is a merge conflict, sets state to ALERT_CONFLICT, otherwise
         sets state to EXPORT.
         """
+        self.__record()
+
         result, stdout, _ = utils.capture_command(
                 'git', 'merge', '--squash',
                 self.__last_synced, expect_success=False)
@@ -281,6 +418,8 @@ class SyncAction(object):
 
         If successful, sets state to CLEAN_UP.
         """
+        self.__record()
+
         print 'There are merge conflicts with the remote repository.'
         print 'Please resolve these conflicts, make a commit and run:'
         print '\tgit rv sync --continue'
@@ -298,8 +437,10 @@ class SyncAction(object):
 
         If successful, sets state to CLEAN_UP.
         """
+        self.__record()
+
         # Need to update this before the ExportAction for --rev={LAST_SYNCED}
-        self.__rietveld_info.remote_info.last_synced = self.__last_synced
+        self.__rietveld_info.last_synced = self.__last_synced
         self.__rietveld_info.save()
 
         print 'Exporting synced changes.'
@@ -330,6 +471,8 @@ class SyncAction(object):
             last_synced: String containing commit hash of last commit synced to
                 from the remote. Defaults to None.
         """
+        self.__record()
+
         if remove_halted:
             self.__rietveld_info.remove_key(utils.SYNC_HALTED)
 
@@ -366,7 +509,543 @@ class SyncAction(object):
         elif self.state == self.CLEAN_UP:
             self.clean_up(*args, **kwargs)
         elif self.state == self.FINISHED:
+            # Only clear the journal if this action wrote or resumed it.
+            if self.__journal_entry is not None:
+                journal.clear(self.__branch)
             return
         else:
             raise utils.GitRvException('Unexpected state %r in SyncAction.' %
                                        (self.state,))
+
+
+class SyncStackAction(object):
+    """A state machine that syncs a stack of reviews, one layer at a time.
+
+    The stack is the current branch and the reviews it is stacked on, down to
+    the review stacked on the remote branch. The remote branch is fetched
+    once, then each layer from the bottom up merges in the remote branch or
+    the new head of the layer below it. Merges are built from git objects, so
+    no branch but the current one is checked out or changed in the working
+    tree. Only the layers which merged something are uploaded, each diffed
+    against the layer below it. Each layer which merged something has a
+    journal entry, like a SyncAction, until it has been exported.
+
+    Attributes:
+        state: The current state of the SyncStackAction state machine.
+        __upload_args: List of strings; command line arguments to be passed
+            along to upload.py.
+        __export_argv: List of strings; the command line arguments recorded in
+            the journal, to resume the sync of a layer as a SyncAction.
+        __send_mail: Boolean indicating whether the uploads send mail.
+        __full_diff: Boolean; whether to show the full diff rather than a
+            summary if the current branch is not in a clean state.
+        __branch: String; containing the name of the current branch.
+        __layers: List of tuples, containing the branch name and RietveldInfo
+            object of each review in the stack, from the bottom up.
+        __remote_head: String; the hash of the HEAD commit in the remote
+            branch after fetching.
+        __merged: List of tuples, containing the branch name, RietveldInfo
+            object, base commit and new head commit of each layer which
+            merged new changes.
+    """
+
+    CHECK_STACK = 0
+    FETCH_REMOTE = 1
+    MERGE_LAYERS = 2
+    EXPORT_LAYERS = 3
+    FINISHED = 4
+
+    def __init__(self, upload_args, send_mail=True, full_diff=False):
+        """Constructor for SyncStackAction.
+
+        Args:
+            upload_args: List of strings; command line arguments to be passed
+                along to upload.py.
+            send_mail: Boolean indicating whether the uploads send mail.
+                Defaults to True.
+            full_diff: Boolean; whether to show the full diff rather than a
+                summary if the current branch is not in a clean state.
+                Defaults to False.
+        """
+        self.__upload_args = upload_args
+        self.__export_argv = [utils.EXPORT] + [arg for arg in upload_args
+                                               if arg != utils.STACK_ARG]
+        self.__send_mail = send_mail
+        self.__full_diff = full_diff
+        self.__branch = utils.get_current_branch()
+        self.__layers = []
+        self.__remote_head = None
+        self.__merged = []
+
+        self.state = self.CHECK_STACK
+        self.advance()
+
+    def __load_layers(self):
+        """Loads the reviews in the stack, from the current branch down.
+
+        The bottom layer is the first review which isn't stacked, or whose
+        parent is no longer in review.
+
+        Returns:
+            Boolean indicating whether the stack could be loaded.
+        """
+        branch = self.__branch
+        while branch is not None:
+            if branch in [layer_branch for layer_branch, _ in self.__layers]:
+                print 'Branch %r is stacked on itself.' % (branch,)
+                return False
+
+            rietveld_info = utils.RietveldInfo.from_branch(branch_name=branch)
+            if rietveld_info is None or rietveld_info.review_info is None:
+                if not self.__layers:
+                    print 'There is no review data for branch %r.' % (branch,)
+                    return False
+                # The parent is no longer in review.
+                break
+
+            self.__layers.append((branch, rietveld_info))
+            branch = rietveld_info.parent_branch
+
+        self.__layers.reverse()
+        return True
+
+    def check_stack(self):
+        """Checks that every review in the stack can be synced.
+
+        The current branch must be in a clean state, and no layer can have
+        changes which were not exported, a halted sync or an interrupted
+        command.
+
+        If the stack can be synced, sets state to FETCH_REMOTE, otherwise sets
+        state to FINISHED. In either case, advances the state machine.
+        """
+        self.state = self.FINISHED
+        if not utils.in_clean_state():
+            utils.print_unclean_state(self.__branch,
+                                      full_diff=self.__full_diff)
+            self.advance()
+            return
+        elif not self.__load_layers():
+            self.advance()
+            return
+
+        for branch, rietveld_info in self.__layers:
+            if not journal.check_not_interrupted(branch):
+                break
+            elif rietveld_info.sync_halted:
+                print ('A "git rv sync" was halted in branch %r. Check it out '
+                       'and run "git rv sync --continue" first.' % (branch,))
+                break
+            elif (utils.get_head_commit(current_branch=branch) !=
+                  rietveld_info.review_info.last_commit):
+                print 'Branch %r has changes which have not been exported.' % (
+                        branch,)
+                break
+        else:
+            print 'Syncing stack: %s.' % (
+                    ' <- '.join(branch for branch, _ in self.__layers),)
+            self.state = self.FETCH_REMOTE
+        self.advance()
+
+    def fetch_remote(self):
+        """Fetches the remote branch the bottom layer is reviewed against.
+
+        Sets state to MERGE_LAYERS and advances the state machine.
+        """
+        remote_info = self.__layers[0][1].remote_info
+        print utils.capture_command('git', 'fetch', remote_info.remote,
+                                    single_line=False)
+        # Keep ancestry checks against the newly fetched history cheap.
+        utils.write_commit_graph()
+        self.__remote_head = remote_info.head_in_remote_branch
+
+        self.state = self.MERGE_LAYERS
+        self.advance()
+
+    def merge_layers(self):
+        """Merges each layer with the remote branch or the layer below it.
+
+        A layer whose base hasn't moved is left as is. Each layer which merged
+        changes is recorded in the journal before its branch is moved, and its
+        new base is only saved once the branch has moved, so an interrupted
+        sync can be finished or undone with "git rv recover". If a merge has
+        conflicts, the layers above it are not synced.
+
+        Sets state to EXPORT_LAYERS and advances the state machine.
+        """
+        new_base = self.__remote_head
+        for branch, rietveld_info in self.__layers:
+            if (rietveld_info.parent_branch is not None and
+                _get_parent_head(rietveld_info) is None):
+                _unstack(branch, rietveld_info)
+
+            head = rietveld_info.review_info.last_commit
+            if new_base == rietveld_info.last_synced:
+                new_base = head
+                continue
+
+            sync_commit_message = 'Syncing review %s at %s.' % (branch,
+                                                                new_base)
+            if utils.is_ancestor(new_base, head):
+                # Nothing to merge, but the layer has a new base.
+                new_head = head
+            else:
+                new_head = _merge_into(head, new_base, sync_commit_message)
+            if new_head is None:
+                print ('Merging %s into branch %r has conflicts. Check it out '
+                       'and run "git rv sync" to resolve them, then run "git '
+                       'rv sync --stack" again.' % (new_base, branch))
+                break
+
+            # The entry is resumed by SyncAction, so it has the same shape.
+            journal_entry = {
+                journal.COMMAND: utils.SYNC,
+                utils.BRANCH: branch,
+                journal.HEAD: head,
+                utils.LAST_SYNCED: new_base,
+                journal.PREVIOUS_LAST_SYNCED: rietveld_info.last_synced,
+                journal.ARGV: self.__export_argv,
+            }
+            if new_head != head:
+                journal_entry[journal.STATE] = SyncAction.MERGE_REMOTE_IN
+                journal.record(journal_entry)
+                if branch == self.__branch:
+                    utils.capture_command('git', 'merge', '--ff-only',
+                                          '--quiet', new_head,
+                                          single_line=False)
+                else:
+                    utils.capture_command('git', 'update-ref', '-m',
+                                          sync_commit_message,
+                                          'refs/heads/%s' % (branch,),
+                                          new_head, head, single_line=False)
+            journal_entry[journal.STATE] = SyncAction.EXPORT
+            journal.record(journal_entry)
+            rietveld_info.last_synced = new_base
+            rietveld_info.save()
+            print 'Merged %s into branch %r.' % (new_base, branch)
+            self.__merged.append((branch, rietveld_info, new_base, new_head))
+            new_base = new_head
+        else:
+            if not self.__merged:
+                print 'No new changes to sync in the stack.'
+
+        self.state = self.EXPORT_LAYERS
+        self.advance()
+
+    def export_layers(self):
+        """Uploads the layers which merged new changes.
+
+        Each layer is diffed against its new base. The layers are uploaded one
+        at a time, since upload.py isn't thread safe; after the first upload
+        the others reuse its cached access token. The journal entry of a layer
+        is cleared once it has been exported. A layer which fails to upload
+        keeps its entry, so the sync can be finished with "git rv recover".
+
+        Sets state to FINISHED and advances the state machine.
+        """
+        for branch, rietveld_info, base_commit, head_commit in self.__merged:
+            try:
+                upload_patch(self.__upload_args, base_commit, head_commit,
+                             issue=rietveld_info.review_info.issue,
+                             send_mail=self.__send_mail,
+                             commit_subject='Syncing review %s at %s.' % (
+                                     branch, base_commit),
+                             commit_description='')
+            # upload.py exits on errors.
+            except (utils.GitRvException, IOError, SystemExit), exc:
+                print ('Could not export branch %r (%s). Check it out and run '
+                       '"git rv recover --forward".' % (branch, exc))
+                continue
+
+            rietveld_info.review_info = utils.ReviewInfo(
+                    last_commit=head_commit)
+            rietveld_info.save()
+            journal.clear(branch)
+            success, _ = utils.update_rietveld_metadata_from_issue(
+                    rietveld_info=rietveld_info, max_age=0)
+            if not success:
+                print ('Metadata update from code server failed for branch '
+                       '%r.' % (branch,))
+            print 'Exported branch %r to issue %d.' % (
+                    branch, rietveld_info.review_info.issue)
+
+        self.state = self.FINISHED
+        self.advance()
+
+    def advance(self, *args, **kwargs):
+        """Advances by calling the method corresponding to the current state.
+
+        Args:
+            *args: Arguments to be passed to the specified method based on
+                the current state.
+            **kwargs: Keyword arguments to be passed to the specified method
+                based on the current state.
+
+        Raises:
+            GitRvException: If this method is called and the state is not one
+                of the valid states.
+        """
+        if self.state == self.CHECK_STACK:
+            self.check_stack(*args, **kwargs)
+        elif self.state == self.FETCH_REMOTE:
+            self.fetch_remote(*args, **kwargs)
+        elif self.state == self.MERGE_LAYERS:
+            self.merge_layers(*args, **kwargs)
+        elif self.state == self.EXPORT_LAYERS:
+            self.export_layers(*args, **kwargs)
+        elif self.state == self.FINISHED:
+            return
+        else:
+            raise utils.GitRvException('Unexpected state %r in '
+                                       'SyncStackAction.' % (self.state,))
+
+
+class SyncPlanAction(object):
+    """A state machine which reports what a SyncAction would do.
+
+    Walks the steps of a SyncAction using only local state and "git
+    ls-remote", so nothing is fetched, merged or uploaded.
+
+    Attributes:
+        state: The current state of the SyncPlanAction state machine.
+        __continue: Boolean indicating whether the planned sync is continuing
+            a halted sync or starting fresh.
+        __send_mail: Boolean indicating whether the export would send mail.
+        __branch: String; containing the name of the current branch.
+        __rietveld_info: RietveldInfo object associated with current branch.
+        __requests: List of strings, each describing a request the sync would
+            make to the code review server.
+    """
+
+    CHECK_ENVIRONMENT = 0
+    PLAN_MERGE = 1
+    PLAN_EXPORT = 2
+    REPORT_REQUESTS = 3
+    FINISHED = 4
+
+    def __init__(self, in_continue, send_mail=True):
+        """Constructor for SyncPlanAction.
+
+        Args:
+            in_continue: Boolean indicating whether the planned sync is
+                continuing a halted sync or starting fresh.
+            send_mail: Boolean indicating whether the export would send mail.
+                Defaults to True.
+        """
+        self.__continue = in_continue
+        self.__send_mail = send_mail
+        self.__branch = utils.get_current_branch()
+        self.__rietveld_info = utils.RietveldInfo.from_branch(
+                branch_name=self.__branch)
+        self.__requests = []
+
+        print 'Dry run of "git rv sync" in branch %r; nothing will change.' % (
+                self.__branch,)
+        self.state = self.CHECK_ENVIRONMENT
+        self.advance()
+
+    def check_environment(self):
+        """Reports the checks SyncAction makes before changing anything.
+
+        If the sync would go ahead, sets state to PLAN_MERGE (or to PLAN_EXPORT
+        for a continued sync), otherwise sets state to FINISHED. In either
+        case, advances the state machine.
+        """
+        next_state_kwargs = {}
+        self.state = self.FINISHED
+
+        rietveld_info = self.__rietveld_info
+        journal_entry = journal.load(self.__branch)
+        if (rietveld_info is None or rietveld_info.review_info is None or
+            rietveld_info.remote_info is None):
+            print 'There is no review data for branch %r.' % (self.__branch,)
+        elif not utils.in_clean_state():
+            print 'Would stop: branch %r not in clean state.' % (self.__branch,)
+        elif journal_entry is not None:
+            print ('Would stop: a "git rv %s" was interrupted in branch %r. '
+                   'Run "git rv recover".' % (journal_entry[journal.COMMAND],
+                                              self.__branch))
+        elif self.__continue:
+            last_commit = rietveld_info.review_info.last_commit
+            commits = utils.get_commits(last_commit, 'HEAD')
+            if not rietveld_info.sync_halted:
+                print 'Would stop: no halted sync in branch %r.' % (
+                        self.__branch,)
+            elif len(commits) != 1:
+                print ('Would stop: exactly one commit resolving the merge '
+                       'conflict is needed, found %d.' % (len(commits),))
+            else:
+                next_state_kwargs['base_commit'] = (
+                        _get_parent_head(rietveld_info) or
+                        rietveld_info.remote_info.head_in_remote_branch)
+                self.state = self.PLAN_EXPORT
+        elif rietveld_info.sync_halted:
+            print ('Would stop: a sync was halted in branch %r; use '
+                   '"git rv sync --continue".' % (self.__branch,))
+        elif (utils.get_head_commit(current_branch=self.__branch) !=
+              rietveld_info.review_info.last_commit):
+            print 'Would stop: HEAD has changes which have not been exported.'
+        else:
+            self.state = self.PLAN_MERGE
+
+        self.advance(**next_state_kwargs)
+
+    @staticmethod
+    def __report_merge(new_head):
+        """Reports the files a merge of a commit into HEAD would rewrite.
+
+        Args:
+            new_head: String; the hash of the commit which would be merged.
+        """
+        merge_base = utils.capture_command('git', 'merge-base', 'HEAD',
+                                           new_head)
+        new_paths = set(path for path, _, _ in
+                        utils.get_changed_files(merge_base, new_head))
+        review_paths = set(path for path, _, _ in
+                           utils.get_changed_files(merge_base, 'HEAD'))
+        print ('Merge: %d files would be rewritten in the working tree.' %
+               (len(new_paths),))
+        conflicting_paths = sorted(new_paths & review_paths)
+        if conflicting_paths:
+            print 'Files changed on both sides, which may conflict:'
+            for path in conflicting_paths:
+                print '    %s' % (path,)
+
+    def plan_merge(self):
+        """Reports the files the merge of the remote branch would rewrite.
+
+        Files changed both in the remote branch and in the review may
+        conflict. If the new remote commits have not been fetched yet, they
+        can't be compared, but the export can still be planned. A stacked
+        review would merge the last commit exported in its parent review
+        instead.
+
+        If there are new commits to merge, sets state to PLAN_EXPORT,
+        otherwise sets state to REPORT_REQUESTS. In either case, advances the
+        state machine.
+        """
+        next_state_kwargs = {}
+
+        rietveld_info = self.__rietveld_info
+        parent_head = _get_parent_head(rietveld_info)
+        if parent_head is not None:
+            if parent_head == rietveld_info.last_synced:
+                print ('No new changes exported in branch %r; the sync would '
+                       'stop.' % (rietveld_info.parent_branch,))
+                self.state = self.REPORT_REQUESTS
+                self.advance()
+                return
+            print 'Branch %r has been exported at %s.' % (
+                    rietveld_info.parent_branch, parent_head)
+            self.__report_merge(parent_head)
+            self.state = self.PLAN_EXPORT
+            self.advance(base_commit=parent_head)
+            return
+        elif rietveld_info.parent_branch is not None:
+            print ('Branch %r is no longer in review, so the review would be '
+                   'unstacked.' % (rietveld_info.parent_branch,))
+
+        remote_info = rietveld_info.remote_info
+        remote_head = utils.peek_remote_head(remote_info)
+        if remote_head == remote_info.last_synced:
+            print 'No new changes in %s; the sync would stop after fetching.' % (
+                    remote_info.remote_branch_ref,)
+            self.state = self.REPORT_REQUESTS
+            self.advance()
+            return
+
+        print 'Fetch: %s has moved to %s.' % (remote_info.remote_branch_ref,
+                                               remote_head)
+        if remote_head is not None and utils.commit_exists(remote_head):
+            self.__report_merge(remote_head)
+            next_state_kwargs['base_commit'] = remote_head
+        else:
+            print ('Merge: its new commits have not been fetched, so the '
+                   'files it would rewrite are not known.')
+            next_state_kwargs['base_commit'] = remote_info.last_synced
+
+        self.state = self.PLAN_EXPORT
+        self.advance(**next_state_kwargs)
+
+    def plan_export(self, base_commit):
+        """Reports the size of the export of the synced review.
+
+        upload.py sends the patch, the base content of each changed file and,
+        unless --no_mail is set, a mail request. The metadata is then pulled
+        from the server.
+
+        Sets state to REPORT_REQUESTS and advances the state machine.
+
+        Args:
+            base_commit: String; the hash of the commit the review would be
+                exported against.
+        """
+        issue = self.__rietveld_info.review_info.issue
+        # Once merged, the review has the same changes relative to the new
+        # remote commit as it has now relative to its merge base.
+        merge_base = utils.capture_command('git', 'merge-base', 'HEAD',
+                                           base_commit)
+        changed_files = utils.get_changed_files(merge_base, 'HEAD')
+        patch_size = utils.get_diff_size(merge_base, 'HEAD')
+        base_blobs = [base_hash for _, base_hash, _ in changed_files
+                      if base_hash != utils.NULL_HASH]
+        base_size = sum(utils.get_object_sizes(base_blobs).values())
+        print ('Export: %d files, a patch of about %d bytes and %d bytes of '
+               'base files to upload.' % (len(changed_files), patch_size,
+                                          base_size))
+
+        template_args = {utils.ISSUE: issue}
+        self.__requests.append('POST %s' % (utils.UPLOAD_URI,))
+        if patch_size > utils.UPLOAD_MAX_SIZE:
+            self.__requests.append('POST %s (%d requests)' % (
+                    utils.UPLOAD_PATCH_TEMPLATE % template_args,
+                    len(changed_files)))
+        if changed_files:
+            self.__requests.append('POST %s (up to %d requests)' % (
+                    utils.UPLOAD_CONTENT_TEMPLATE % template_args,
+                    2 * len(changed_files)))
+        if self.__send_mail:
+            self.__requests.append('POST %s' % (
+                    utils.MAIL_ISSUE_TEMPLATE % template_args,))
+        self.__requests.append('GET %s' % (
+                utils.ISSUE_URI_PATH_TEMPLATE % template_args,))
+
+        self.state = self.REPORT_REQUESTS
+        self.advance()
+
+    def report_requests(self):
+        """Reports the requests the sync would make to the server.
+
+        Sets state to FINISHED and advances the state machine.
+        """
+        utils.print_planned_requests(self.__rietveld_info.server,
+                                     self.__requests)
+        self.state = self.FINISHED
+        self.advance()
+
+    def advance(self, *args, **kwargs):
+        """Advances by calling the method corresponding to the current state.
+
+        Args:
+            *args: Arguments to be passed to the specified method based on
+                the current state.
+            **kwargs: Keyword arguments to be passed to the specified method
+                based on the current state.
+
+        Raises:
+            GitRvException: If this method is called and the state is not one
+                of the valid states.
+        """
+        if self.state == self.CHECK_ENVIRONMENT:
+            self.check_environment(*args, **kwargs)
+        elif self.state == self.PLAN_MERGE:
+            self.plan_merge(*args, **kwargs)
+        elif self.state == self.PLAN_EXPORT:
+            self.plan_export(*args, **kwargs)
+        elif self.state == self.REPORT_REQUESTS:
+            self.report_requests(*args, **kwargs)
+        elif self.state == self.FINISHED:
+            return
+        else:
+            raise utils.GitRvException('Unexpected state %r in SyncPlanAction.' %
+                                       (self.state,))
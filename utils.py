@@ -28,41 +28,82 @@ from __future__ import with_statement
 
 import base64
 import contextlib
-import httplib
 try:
     import json
 except ImportError:
     import simplejson as json
+import mmap
 import os
+import Queue
 import re
+import shutil
 import subprocess
-import urllib
+import sys
+import tempfile
+import threading
+import time
+
+import gitdir
+# NOTE: httplib and urllib are imported in the functions which use them, since
+#       loading them noticeably slows down commands which are meant to be run
+#       from a shell prompt, such as "git rv status".
 
 
 # Command names
+COMMENTS = 'comments'
+DAEMON = 'daemon'
 EXPORT = 'export'
+GC = 'gc'
 GETINFO = 'getinfo'
+INTERDIFF = 'interdiff'
 MV_BRANCH = 'mv-branch'
+OUTBOX = 'outbox'
+PATCH = 'patch'
+RECOVER = 'recover'
 RM_BRANCH = 'rm-branch'
+STATUS_COMMAND = 'status'
 SUBMIT = 'submit'
 SYNC = 'sync'
+WAIT = 'wait'
 
 # Constants uses in upload.py
 CODE_REVIEW = 'codereview.appspot.com'
 OAUTH2_ARGS = ('--oauth2', '--no_cookies')
-REVISION_TEMPLATE = '--rev=%s'
+# The base and head commits of the diff to upload.
+REVISION_TEMPLATE = '--rev=%s:%s'
 SEND_MAIL_ARG = '--send_mail'
 VCS_ARG = '--vcs=git'
+# Flags of git-rv commands which are not passed along to upload.py, and those
+# among them which take a value.
+FULL_DIFF_ARG = '--full_diff'
+NO_MAIL_ARG = '--no_mail'
+PARENT_ARG = '--parent'
+SKIP_PRESUBMIT_ARG = '--skip_presubmit'
+STACK_ARG = '--stack'
+GIT_RV_ONLY_ARGS = (FULL_DIFF_ARG, NO_MAIL_ARG, PARENT_ARG, SKIP_PRESUBMIT_ARG,
+                    STACK_ARG)
+GIT_RV_ONLY_VALUE_ARGS = (PARENT_ARG,)
+# Requests made by upload.py, listed by "git rv sync --dry_run".
+MAIL_ISSUE_TEMPLATE = '/%(issue)d/mail'
+# upload.py sends each file's patch in a separate request above this size.
+UPLOAD_MAX_SIZE = 900 * 1024
+UPLOAD_CONTENT_TEMPLATE = '/%(issue)d/upload_content/{$PATCHSET}/{$FILE_ID}'
+UPLOAD_PATCH_TEMPLATE = '/%(issue)d/upload_patch/{$PATCHSET}'
+UPLOAD_URI = '/upload'
 
 # Metadata Keys and Constants
+APPROVED = 'approved'
 BRANCH = 'branch'
 CC = 'cc'
 COMMIT_HASH = 'commit_hash'
 HOST = 'host'
 ISSUE = 'issue'
 ISSUE_DESCRIPTION = 'description'
+KEY = 'key'
 LAST_COMMIT = 'last_commit'
 LAST_SYNCED = 'last_synced'
+PARENT_BRANCH = 'parent_branch'
+PARENT_LAST_SYNCED = 'parent_last_synced'
 PRIVATE = 'private'
 REMOTE = 'remote'
 REMOTE_INFO = 'remote_info'
@@ -76,21 +117,42 @@ SERVER = 'server'
 STATUS = 'status'
 SUBJECT = 'subject'
 SYNC_HALTED = 'sync_halted'
+VERSION = 'version'
 
 # Issue Constants
 CLOSE_ISSUE_TEMPLATE = '/%(issue)d/close'
+CLOSED = 'closed'
+FETCHED = 'fetched'
+ISSUE_CACHE_DIRECTORY = 'issues'
 ISSUE_ARG_TEMPLATE = '--issue=%d'
-ISSUE_URI_PATH_TEMPLATE = '/api/%(issue)d?messages=true'
+ISSUE_SUMMARY_URI_PATH_TEMPLATE = '/api/%(issue)d'
+ISSUE_URI_PATH_TEMPLATE = ISSUE_SUMMARY_URI_PATH_TEMPLATE + '?messages=true'
 # TODO(dhermes): Move error messages up as templates.
 ISSUE_INFO_ERROR_TEMPLATE = ('Issue %(issue)d requested from %(server)r '
-                             'returned $(status)d %(reason)s.')
+                             'returned %(status)d %(reason)s.')
 MESSAGE = 'message'
+MODIFIED = 'modified'
+PATH = 'path'
 PUBLISH_ISSUE_MESSAGE_TEMPLATE = '/%(issue)d/publish'
 PUBLISH_ISSUE_BASE = {
     'message_only': 'true',
     'no_redirect': 'true',
     'send_mail': 'on',
 }
+SERVER_REQUEST_ERROR_TEMPLATE = ('Request for %(path)r from %(server)r '
+                                 'returned %(status)d %(reason)s.')
+# Cached issue metadata is used without contacting the server if it is at
+# most this many seconds old.
+ISSUE_METADATA_MAX_AGE = 120
+LOCALHOST_REGEX = re.compile('^localhost([:/]|$)')
+METADATA = 'metadata'
+
+# Version of the metadata stored for each branch. Version 1 (never stored
+# explicitly) was base64 encoded JSON; since version 2 it is plain JSON.
+METADATA_VERSION = 2
+CORRUPT_METADATA_TEMPLATE = (
+        'Review metadata for branch %(branch)r is invalid: %(error)s\nTo '
+        'discard it, run "git config --unset %(key)s".')
 
 # Miscellaneous constants.
 APPROVAL = 'approval'
@@ -100,7 +162,9 @@ BAD_REMOTE_ERROR_TEMPLATE = (
         'the current branch %(branch)r.')
 BRANCH_REF_TEMPLATE = 'refs/heads/%s'
 COMMIT_HASH_REGEX = re.compile('^[0-9a-f]{40}$')
+COMMIT_LINK_TEMPLATE = 'commit_link_template'
 DESCRIPTION_NEWLINE = 'description_newline'
+ERROR = 'error'
 FAILED_CLOSE_TEMPLATE = ('Closing issue %(issue)d failed.\nTo close the issue '
                          'manually, visit https://%(server)s/%(issue)d/ and '
                          'click the X in the top left corner.')
@@ -118,6 +182,11 @@ GOOGLE_CODEHOSTING_HG_NO_MAPPING_TEMPLATE = ('git commit hash %s not in commit '
 INVALID_BRANCH_CHOICE = 'Branch choice %r is invalid.'
 INVALID_MESSAGE_CHOICE = 'Message choice %r is invalid.'
 INVALID_REMOTE_CHOICE = 'Remote choice %r is invalid.'
+# Matches the scheme and host of a URL (e.g. https://github.com/) or the user
+# and host of an scp-like address (e.g. git@github.com:).
+HOST_PREFIX_REGEX = re.compile('^((hg::)?[a-z+]+://[^/]*/|[^/:@]+@[^/:]+:)')
+IS_ANCESTOR_ERROR_TEMPLATE = ('Could not determine if %(commit_hash)r is an '
+                              'ancestor of %(branch)r:\n%(error)s')
 LS_REMOTE_ERROR_TEMPLATE = ('Unexpected output from "git ls-remote" '
                             'encountered:\n%s')
 MESSAGES = 'messages'
@@ -137,7 +206,15 @@ NO_BRANCHES_ERROR_TEMPLATE = 'No branches found found for remote %r.'
 NO_COMMIT_TEMPLATE = ('No commits have been made since %s, can\'t '
                       'get commit message.')
 NO_REMOTES_ERROR = 'No remotes found in the current repository.'
+NULL_HASH = '0' * 40
+# Each exported patch set of an issue is archived under refs/rv/{issue}/, with
+# refs to the exported commit and the commit it was diffed against.
+PATCHSET_BASE = 'base'
+PATCHSET_HEAD = 'head'
+PATCHSET_REF_PREFIX_TEMPLATE = 'refs/rv/%d/'
+PATCHSET_REF_TEMPLATE = PATCHSET_REF_PREFIX_TEMPLATE + '%d/%s'
 REMOTE_BRANCH = 'remote_branch'
+REMOTE_BRANCH_REF_TEMPLATE = 'refs/remotes/%s/%s'
 REMOTE_URL_KEY_TEMPLATE = 'remote.%s.url'
 REMOTE_PROMPT = ('You have more than one remote associated with this '
                  'repository.\nPlease choose one of the following:')
@@ -154,6 +231,56 @@ TIP_BEHIND_HINT = ('Updates were rejected because the tip of your current '
 XSRF_TOKEN = 'xsrf_token'
 XSRF_HEADERS = {'X-Requesting-XSRF-Token': 'true'}
 
+# git-rv specific config options, set via "git config rv.{$OPTION} {$VALUE}".
+RV_COMMIT_GRAPH_KEY = 'rv.commitGraph'
+RV_TRUST_INDEX_KEY = 'rv.trustIndex'
+# Commit link templates, set via "git config rv-commitlink.{$NAME}.pattern"
+# (a regular expression for remote URLs), "rv-commitlink.{$NAME}.template"
+# (filled in with the named groups of the pattern and commit_hash) and
+# optionally "rv-commitlink.{$NAME}.hostPrefix".
+RV_COMMIT_LINK_HOST_PREFIX = 'hostprefix'
+RV_COMMIT_LINK_KEY_REGEX = '^rv-commitlink\\.'
+RV_COMMIT_LINK_KEY_TEMPLATE = 'rv-commitlink.%s'
+RV_COMMIT_LINK_PATTERN = 'pattern'
+RV_COMMIT_LINK_TEMPLATE = 'template'
+INVALID_COMMIT_LINK_CONFIG_TEMPLATE = ('Ignoring commit link template in git '
+                                       'config. %s\n')
+
+PRESUBMIT_FAILED = ('Presubmit checks failed. Fix them, or run with %s to '
+                    'skip them.' % (SKIP_PRESUBMIT_ARG,))
+
+# Local state for git-rv, stored in {$GIT_COMMON_DIR}/rv.
+PROMPT_DIRECTORY = 'prompt'
+# Fields are issue, approved, sync_halted and last_commit, with '-' used for
+# unknown values. Read by git-rv-prompt.sh, so changes must be made there too.
+PROMPT_RECORD_TEMPLATE = ('%(issue)s %(approved)s %(sync_halted)s '
+                          '%(last_commit)s\n')
+RV_DIRECTORY = 'rv'
+
+# If set in the environment, the time taken by each git process and by other
+# slow steps is printed to stderr.
+PROFILE_ENVIRONMENT_VARIABLE = 'GIT_RV_PROFILE'
+# Entry types in "git status --porcelain=v2" output which are changes to
+# tracked files, rather than headers.
+STATUS_CHANGE_PREFIXES = ('1 ', '2 ', 'u ')
+# Number of changed files listed when refusing to run on an unclean branch.
+UNCLEAN_SUMMARY_MAX_FILES = 20
+# Mode of the tree entries for submodules, which point to commits rather than
+# blobs.
+SUBMODULE_MODE = '160000'
+# Number of bytes read at a time when measuring a diff.
+DIFF_CHUNK_SIZE = 64 * 1024
+# First version of git with "git merge-tree --write-tree".
+MERGE_TREE_WRITE_TREE_VERSION = (2, 38)
+# Maximum number of threads making concurrent requests to the code review
+# server.
+MAX_CONCURRENT_REQUESTS = 8
+
+_GIT_COMMON_DIR_CACHE = []
+_GIT_ROOT_CACHE = []
+_GIT_VERSION_CACHE = []
+_COMMIT_LINK_TEMPLATES_LOADED = []
+
 
 class GitRvException(Exception):
     """Base exception for git-rv."""
@@ -186,6 +313,28 @@ def _check_single_line(value):
         raise GitRvException('Subject %r is incorrectly formatted.' % (value,))
 
 
+@contextlib.contextmanager
+def profile(label):
+    """Times a block of code if profiling is turned on.
+
+    Profiling is turned on by setting PROFILE_ENVIRONMENT_VARIABLE, in which
+    case the time taken is printed to stderr when the block exits.
+
+    Args:
+        label: String; describes the timed block in the output.
+    """
+    if PROFILE_ENVIRONMENT_VARIABLE not in os.environ:
+        yield
+        return
+
+    start = time.time()
+    try:
+        yield
+    finally:
+        sys.stderr.write('git-rv profile: %8.1f ms  %s\n' % (
+                (time.time() - start) * 1000, label))
+
+
 # TODO(dhermes): Consider making single_line default to False instead.
 def capture_command(*args, **kwargs):
     """Captures the system status, stdout and stderr of a command.
@@ -210,11 +359,12 @@ def capture_command(*args, **kwargs):
         GitRvException: If the command does not exit with status code 0 and
             expect success is True.
     """
-    proc = subprocess.Popen(args, stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE)
-    result = proc.wait()
-    stdout = proc.stdout.read()
-    stderr = proc.stderr.read()
+    with profile(' '.join(args)):
+        proc = subprocess.Popen(args, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        result = proc.wait()
+        stdout = proc.stdout.read()
+        stderr = proc.stderr.read()
 
     # TODO(dhermes): Should this be a constant?
     if not kwargs.get('expect_success', True):
@@ -236,16 +386,131 @@ def get_current_branch():
     Returns:
         String containing the current branch name, if in a branch.
     """
-    return capture_command('git', 'rev-parse', '--abbrev-ref', 'HEAD')
+    try:
+        return gitdir.get_current_branch()
+    except gitdir.UnsupportedLayout:
+        return capture_command('git', 'rev-parse', '--abbrev-ref', 'HEAD')
 
 
 def get_git_root():
     """Retrieves the current root of the git repository.
 
+    The value is cached since it can't change during a single git-rv command.
+
     Returns:
         String containing the current git root, if in a repository.
     """
-    return capture_command('git', 'rev-parse', '--show-toplevel')
+    if not _GIT_ROOT_CACHE:
+        try:
+            git_root, _, _ = gitdir.get_repository()
+        except gitdir.UnsupportedLayout:
+            git_root = capture_command('git', 'rev-parse', '--show-toplevel')
+        _GIT_ROOT_CACHE.append(git_root)
+    return _GIT_ROOT_CACHE[0]
+
+
+def get_git_common_dir():
+    """Retrieves the git directory shared by all worktrees of the repository.
+
+    The value is cached since it can't change during a single git-rv command.
+
+    Returns:
+        String containing the absolute path of the common git directory.
+    """
+    if _GIT_COMMON_DIR_CACHE:
+        return _GIT_COMMON_DIR_CACHE[0]
+
+    try:
+        _, _, git_dir = gitdir.get_repository()
+    except gitdir.UnsupportedLayout:
+        git_dir = capture_command('git', 'rev-parse', '--git-common-dir')
+        git_dir = os.path.abspath(git_dir)
+    _GIT_COMMON_DIR_CACHE.append(git_dir)
+    return git_dir
+
+
+def read_ref_file(ref, git_dir=None):
+    """Reads the commit hash of a reference directly from the git directory.
+
+    Avoids starting a git process, which matters for commands run from a shell
+    prompt. Loose references are checked before packed-refs, as git does.
+
+    Args:
+        ref: String; the full name of a reference, e.g. refs/heads/master.
+        git_dir: String; the common git directory of the repository. Defaults
+            to None and in this case is replaced by a call to
+            get_git_common_dir.
+
+    Returns:
+        String containing the commit hash of the reference, or None if the
+            reference does not exist or is symbolic.
+    """
+    git_dir = git_dir or get_git_common_dir()
+    try:
+        with open(os.path.join(git_dir, ref), 'rb') as fh:
+            value = fh.read().strip()
+        if COMMIT_HASH_REGEX.match(value) is not None:
+            return value
+        return None
+    except IOError:
+        pass
+
+    return gitdir.read_packed_ref(git_dir, ref)
+
+
+def get_rv_path(*parts):
+    """Gets a path in the directory git-rv uses for local state.
+
+    The directory lives in the common git directory, so it is shared between
+    worktrees and removed along with the repository. Parent directories of the
+    path are created as needed.
+
+    Args:
+        *parts: Strings; path components relative to the git-rv directory.
+
+    Returns:
+        String containing the absolute path.
+    """
+    path = os.path.join(get_git_common_dir(), RV_DIRECTORY, *parts)
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # Another process may have created it concurrently.
+            if not os.path.isdir(directory):
+                raise
+    return path
+
+
+def write_file_atomically(path, content, mode=None):
+    """Writes a file so that readers never see partial contents.
+
+    The content is written to a temporary file in the same directory and
+    then renamed over the target, which is atomic on POSIX file systems.
+
+    Args:
+        path: String; the path of the file to write.
+        content: String; the full contents of the file.
+        mode: Integer; permission bits used when creating the file. Defaults
+            to None, in which case the default permissions are used.
+    """
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+    if mode is None:
+        fd = os.open(tmp_path, flags)
+    else:
+        fd = os.open(tmp_path, flags, mode)
+    try:
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(content)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.rename(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
 
 
 def get_head_commit(current_branch=None):
@@ -260,7 +525,13 @@ def get_head_commit(current_branch=None):
             given branch.
     """
     current_branch = current_branch or get_current_branch()
-    result = capture_command('git', 'rev-parse', current_branch)
+    try:
+        result = gitdir.resolve_revision(current_branch)
+    except gitdir.UnsupportedLayout:
+        result = None
+    # Not a plain ref name, such as a hash or branch@{0}, so git is needed.
+    if result is None:
+        result = capture_command('git', 'rev-parse', current_branch)
     _check_hash(result)
     return result
 
@@ -424,6 +695,105 @@ def get_commits(base_commit, head_commit):
     return commits
 
 
+def commit_exists(commit_hash):
+    """Checks if a commit is present in the local repository.
+
+    Args:
+        commit_hash: String containing the hash of a commit.
+
+    Returns:
+        Boolean indicating whether the commit can be read locally.
+    """
+    result, _, _ = capture_command('git', 'cat-file', '-e',
+                                   '%s^{commit}' % (commit_hash,),
+                                   expect_success=False)
+    return result == 0
+
+
+def get_changed_files(base_commit, head_commit, skip_submodules=False):
+    """Gets the files changed between two commits, without rename detection.
+
+    Args:
+        base_commit: String containing the hash of the base commit.
+        head_commit: String containing the hash of the head commit.
+        skip_submodules: Boolean; whether to leave out submodules which are
+            in head_commit. Defaults to False.
+
+    Returns:
+        List of tuples, each containing the path of a changed file and the
+            blob hashes of the file in base_commit and head_commit. A hash is
+            NULL_HASH if the file does not exist in that commit.
+    """
+    diff_output = capture_command('git', 'diff-tree', '-r', '-z',
+                                  '--no-renames', base_commit, head_commit,
+                                  single_line=False)
+    # Each change is ":<mode> <mode> <hash> <hash> <status>\0<path>\0".
+    fields = diff_output.split('\0')
+    changed_files = []
+    for index in xrange(0, len(fields) - 1, 2):
+        _, head_mode, base_hash, head_hash, _ = fields[index].split(' ')
+        if skip_submodules and head_mode == SUBMODULE_MODE:
+            continue
+        changed_files.append((fields[index + 1], base_hash, head_hash))
+    return changed_files
+
+
+def get_object_sizes(object_hashes):
+    """Gets the sizes of git objects using a single "git cat-file" process.
+
+    Args:
+        object_hashes: List of strings, each the hash of a git object.
+
+    Returns:
+        Dictionary mapping each object hash to its size in bytes. Objects
+            which are not present locally are left out.
+    """
+    if not object_hashes:
+        return {}
+
+    proc = subprocess.Popen(['git', 'cat-file', '--batch-check'],
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+    stdout, stderr = proc.communicate('\n'.join(object_hashes) + '\n')
+    if proc.returncode != 0:
+        raise GitRvException('Command %r failed with:\n%s' % (
+                'git cat-file --batch-check', stderr))
+
+    sizes = {}
+    for line in stdout.splitlines():
+        # "<hash> <type> <size>", or "<hash> missing".
+        parts = line.split(' ')
+        if len(parts) == 3:
+            sizes[parts[0]] = int(parts[2])
+    return sizes
+
+
+def get_diff_size(base_commit, head_commit):
+    """Gets the size of the full index diff between two commits.
+
+    The diff is read from "git diff" in chunks and only counted, so that a
+    large diff is never held in memory.
+
+    Args:
+        base_commit: String containing the hash of the base commit.
+        head_commit: String containing the hash of the head commit.
+
+    Returns:
+        Integer; the size of the diff in bytes.
+    """
+    with open(os.devnull, 'wb') as null_fh:
+        proc = subprocess.Popen(
+                ['git', 'diff', '--no-color', '--full-index', base_commit,
+                 head_commit], stdout=subprocess.PIPE, stderr=null_fh)
+    size = 0
+    for chunk in iter(lambda: proc.stdout.read(DIFF_CHUNK_SIZE), ''):
+        size += len(chunk)
+    if proc.wait() != 0:
+        raise GitRvException('Could not diff %s against %s.' % (
+                head_commit, base_commit))
+    return size
+
+
 def get_user_commit_message_parts(base_commit, head_commit, remote_branch=None):
     """Allows a user to choose a commit message for a patch set.
 
@@ -535,6 +905,80 @@ def get_remote_branches_list(remote):
     return branches
 
 
+def get_remote_head(remote, branch):
+    """Gets the commit hash of HEAD in a branch of a remote repository.
+
+    Uses "git ls-remote" so that nothing is fetched.
+
+    Args:
+        remote: String containing the specific remote.
+        branch: String containing the branch in the remote.
+
+    Returns:
+        String containing the commit hash, or None if the branch does not
+            exist in the remote.
+    """
+    output = capture_command('git', 'ls-remote', remote,
+                             BRANCH_REF_TEMPLATE % (branch,), single_line=False)
+    if not output:
+        return None
+    return output.split('\t', 1)[0]
+
+
+def fetch_remote_branch(remote, branch):
+    """Fetches only one branch of a remote repository.
+
+    Args:
+        remote: String containing the specific remote.
+        branch: String containing the branch in the remote.
+
+    Returns:
+        String containing the commit hash of the fetched HEAD of the remote
+            branch.
+    """
+    remote_branch_ref = REMOTE_BRANCH_REF_TEMPLATE % (remote, branch)
+    refspec = '+%s:%s' % (BRANCH_REF_TEMPLATE % (branch,), remote_branch_ref)
+    capture_command('git', 'fetch', remote, refspec, single_line=False)
+    return capture_command('git', 'rev-parse', remote_branch_ref)
+
+
+def peek_remote_head(remote_info):
+    """Gets HEAD in the remote branch of a review without fetching anything.
+
+    Used to plan commands without running them. If the remote can't be
+    reached, the local copy of the remote branch is used instead.
+
+    Args:
+        remote_info: RemoteInfo object for the review.
+
+    Returns:
+        String containing the commit hash, or None if the remote branch does
+            not exist.
+    """
+    try:
+        return get_remote_head(remote_info.remote, remote_info.branch)
+    except GitRvException:
+        print 'Could not reach remote %r; using the local copy of %s.' % (
+                remote_info.remote, remote_info.remote_branch_ref)
+        return remote_info.head_in_remote_branch
+
+
+def print_planned_requests(server, requests):
+    """Prints the requests a command would make to the code review server.
+
+    Args:
+        server: String; the address of the Rietveld server hosting the code
+            review.
+        requests: List of strings, each describing a request.
+    """
+    if not requests:
+        print 'HTTP requests to %s: none.' % (server,)
+        return
+    print 'HTTP requests to %s:' % (server,)
+    for request in requests:
+        print '    %s' % (request,)
+
+
 def get_remote_branch(remote):
     """Gets the remote for a review.
 
@@ -567,7 +1011,14 @@ def get_remote_url(remote):
         String containing the URL of remote.
     """
     url_config_key = REMOTE_URL_KEY_TEMPLATE % (remote,)
-    return capture_command('git', 'config', url_config_key)
+    try:
+        url = gitdir.get_config_value(url_config_key)
+    except gitdir.UnsupportedLayout:
+        url = None
+    # The URL may also be set in the global or system config.
+    if url is None:
+        url = capture_command('git', 'config', url_config_key)
+    return url
 
 
 def get_remote_info(current_branch=None):
@@ -588,11 +1039,7 @@ def get_remote_info(current_branch=None):
     remote_branch, commit_hash = get_remote_branch(remote)
     url = get_remote_url(remote)
     if current_branch is not None:
-        containing_output = capture_command('git', 'branch', '--contains',
-                                            commit_hash, single_line=False)
-        branches_containing = [branch[2:]
-                               for branch in containing_output.split('\n')]
-        if current_branch not in branches_containing:
+        if not is_ancestor(commit_hash, BRANCH_REF_TEMPLATE % current_branch):
             error_message = BAD_REMOTE_ERROR_TEMPLATE % {
                 REMOTE: remote,
                 REMOTE_BRANCH: remote_branch,
@@ -605,6 +1052,289 @@ def get_remote_info(current_branch=None):
                       commit_hash=commit_hash, last_synced=commit_hash, url=url)
 
 
+def run_concurrently(function, items, max_threads=MAX_CONCURRENT_REQUESTS):
+    """Calls a function on each item from a bounded pool of threads.
+
+    Args:
+        function: Callable taking a single item.
+        items: List of distinct, hashable items.
+        max_threads: Integer; the maximum number of threads to start. Defaults
+            to MAX_CONCURRENT_REQUESTS.
+
+    Returns:
+        Dictionary mapping each item to the value returned for it, or to the
+            exception raised if the call failed.
+    """
+    tasks = Queue.Queue()
+    for item in items:
+        tasks.put(item)
+    results = {}
+
+    def run_tasks():
+        """Calls the function on items from the queue until it is empty."""
+        while True:
+            try:
+                item = tasks.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[item] = function(item)
+            except Exception, exc:  # Syntax for python<2.6
+                results[item] = exc
+
+    threads = [threading.Thread(target=run_tasks)
+               for _ in xrange(min(max_threads, len(items)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def get_git_version():
+    """Gets the version of git.
+
+    The value is cached since it can't change during a single git-rv command.
+
+    Returns:
+        Tuple of the major and minor version numbers, or (0, 0) if the version
+            can't be parsed.
+    """
+    if not _GIT_VERSION_CACHE:
+        # For example "git version 2.39.5" or "git version 2.37.1 (Apple
+        # Git-137.1)".
+        match = re.search(r'(\d+)\.(\d+)', capture_command('git', 'version'))
+        if match is None:
+            _GIT_VERSION_CACHE.append((0, 0))
+        else:
+            _GIT_VERSION_CACHE.append((int(match.group(1)),
+                                       int(match.group(2))))
+    return _GIT_VERSION_CACHE[0]
+
+
+@contextlib.contextmanager
+def temporary_worktree(commit):
+    """Checks out a commit in a temporary worktree.
+
+    The worktree is detached, so no branch is changed, and it is removed when
+    the block exits.
+
+    Args:
+        commit: String; the hash of the commit to check out.
+
+    Yields:
+        String containing the path of the worktree.
+    """
+    worktree = tempfile.mkdtemp(prefix='git-rv-')
+    try:
+        capture_command('git', 'worktree', 'add', '--detach', worktree,
+                        commit, single_line=False)
+        yield worktree
+    finally:
+        shutil.rmtree(worktree, ignore_errors=True)
+        capture_command('git', 'worktree', 'prune', expect_success=False)
+
+
+def merge_trees(head, commit, keep_conflicts=False):
+    """Merges a commit into another without changing the working tree.
+
+    Uses "git merge-tree --write-tree" if git is new enough. Otherwise the
+    merge is done in a temporary worktree checked out at head, which is
+    removed afterwards.
+
+    Args:
+        head: String; the hash of the commit to merge into.
+        commit: String; the hash of the commit to merge in.
+        keep_conflicts: Boolean; whether a merge with conflicts should still
+            produce a tree, with conflict markers in the conflicted files.
+            Defaults to False.
+
+    Returns:
+        String containing the hash of the merged tree, or None if the merge
+            has conflicts and keep_conflicts is False.
+
+    Raises:
+        GitRvException: If the merge fails for a reason other than conflicts.
+    """
+    if get_git_version() >= MERGE_TREE_WRITE_TREE_VERSION:
+        result, stdout, stderr = capture_command(
+                'git', 'merge-tree', '--write-tree', head, commit,
+                expect_success=False)
+        if result == 1 and not keep_conflicts:
+            return None
+        elif result not in (0, 1):
+            raise GitRvException('Could not merge %s into %s:\n%s' % (
+                    commit, head, stderr))
+        return stdout.split('\n', 1)[0]
+
+    with temporary_worktree(head) as worktree:
+        result, _, stderr = capture_command(
+                'git', '-C', worktree, 'merge', '--no-commit', '--no-ff',
+                '--quiet', commit, expect_success=False)
+        if result == 1:
+            if not keep_conflicts:
+                return None
+            # Staging the conflicted files resolves them as they are in the
+            # worktree, conflict markers included.
+            capture_command('git', '-C', worktree, 'add', '--all',
+                            single_line=False)
+        elif result != 0:
+            raise GitRvException('Could not merge %s into %s:\n%s' % (
+                    commit, head, stderr))
+        return capture_command('git', '-C', worktree, 'write-tree')
+
+
+def is_ancestor(commit_hash, descendant):
+    """Checks if a commit is an ancestor of another commit or branch.
+
+    Uses "git merge-base --is-ancestor" so that only the history of the one
+    descendant is walked, rather than that of every local branch. If a commit
+    graph file has been written, the walk is bounded by generation numbers.
+
+    Args:
+        commit_hash: String; the hash of the candidate ancestor commit.
+        descendant: String; a commit hash or branch name which may contain
+            commit_hash in its history.
+
+    Returns:
+        Boolean indicating whether or not commit_hash is an ancestor of (or
+            equal to) descendant.
+
+    Raises:
+        GitRvException: If "git merge-base" fails for a reason other than the
+            commit not being an ancestor, e.g. if one of the commits does not
+            exist locally.
+    """
+    result, _, stderr = capture_command('git', 'merge-base', '--is-ancestor',
+                                        commit_hash, descendant,
+                                        expect_success=False)
+    if result == 0:
+        return True
+    elif result == 1:
+        return False
+    raise GitRvException(IS_ANCESTOR_ERROR_TEMPLATE % {
+        COMMIT_HASH: commit_hash,
+        BRANCH: descendant,
+        ERROR: stderr,
+    })
+
+
+def get_config_bool(key, default=False):
+    """Gets a boolean value from the git config.
+
+    Args:
+        key: String; the name of the git config key.
+        default: Boolean; the value returned if the key is not set. Defaults
+            to False.
+
+    Returns:
+        Boolean value stored for the key, or default if the key is not set.
+    """
+    result, stdout, _ = capture_command('git', 'config', '--bool', key,
+                                        expect_success=False)
+    if result != 0:
+        return default
+    return stdout.strip() == 'true'
+
+
+def write_commit_graph():
+    """Writes a commit graph file for the current repository.
+
+    Only does so if the RV_COMMIT_GRAPH_KEY config option is set. The commit
+    graph stores generation numbers for every reachable commit, which allows
+    ancestry checks such as is_ancestor to stop walking history early. Since
+    "--split" is used, only commits added since the last write are processed.
+
+    Failures are ignored since the commit graph is only an optimization.
+
+    Returns:
+        Boolean indicating whether or not a commit graph was written.
+    """
+    if not get_config_bool(RV_COMMIT_GRAPH_KEY):
+        return False
+
+    result, _, _ = capture_command('git', 'commit-graph', 'write',
+                                   '--reachable', '--split',
+                                   expect_success=False)
+    return result == 0
+
+
+def _update_refs(commands):
+    """Updates several refs using a single "git update-ref" process.
+
+    Args:
+        commands: List of strings, each a command for "git update-ref --stdin"
+            such as "update {ref} {new_value}" or "delete {ref}".
+
+    Raises:
+        GitRvException: If any of the refs can't be updated, in which case none
+            of them are.
+    """
+    proc = subprocess.Popen(['git', 'update-ref', '--stdin'],
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+    _, stderr = proc.communicate(''.join('%s\n' % (command,)
+                                         for command in commands))
+    if proc.returncode != 0:
+        raise GitRvException('Command %r failed with:\n%s' % (
+                'git update-ref --stdin', stderr))
+
+
+def record_patchset(issue, patchset, base_commit, head_commit):
+    """Archives the commits of an exported patch set in local refs.
+
+    Args:
+        issue: Integer; the ID of the code review issue.
+        patchset: Integer; the ID of the patch set within the issue.
+        base_commit: String; the hash of the commit the patch set was diffed
+            against.
+        head_commit: String; the hash of the exported commit.
+    """
+    _update_refs([
+        'update %s %s' % (PATCHSET_REF_TEMPLATE % (issue, patchset,
+                                                   PATCHSET_BASE), base_commit),
+        'update %s %s' % (PATCHSET_REF_TEMPLATE % (issue, patchset,
+                                                   PATCHSET_HEAD), head_commit),
+    ])
+
+
+def get_patchsets(issue):
+    """Gets the archived patch sets of an issue.
+
+    Args:
+        issue: Integer; the ID of the code review issue.
+
+    Returns:
+        Dictionary mapping each archived patch set ID to a dictionary with the
+            PATCHSET_BASE and PATCHSET_HEAD commit hashes of the patch set.
+    """
+    prefix = PATCHSET_REF_PREFIX_TEMPLATE % (issue,)
+    refs_output = capture_command(
+            'git', 'for-each-ref', '--format=%(objectname) %(refname)', prefix,
+            single_line=False)
+
+    patchsets = {}
+    for line in refs_output.splitlines():
+        commit_hash, ref = line.split(' ', 1)
+        patchset, kind = ref[len(prefix):].split('/', 1)
+        if patchset.isdigit():
+            patchsets.setdefault(int(patchset), {})[kind] = commit_hash
+    return patchsets
+
+
+def delete_patchset_refs(issue):
+    """Deletes the archived patch sets of an issue.
+
+    Args:
+        issue: Integer; the ID of the code review issue.
+    """
+    prefix = PATCHSET_REF_PREFIX_TEMPLATE % (issue,)
+    refs = capture_command('git', 'for-each-ref', '--format=%(refname)',
+                           prefix, single_line=False).split()
+    if refs:
+        _update_refs(['delete %s' % (ref,) for ref in refs])
+
+
 def branch_exists(branch):
     """Gets the commit hash of HEAD in the given branch.
 
@@ -614,8 +1344,13 @@ def branch_exists(branch):
     Returns:
         Boolean indicating whether or not the branch exists.
     """
-    # http://stackoverflow.com/questions/5167957
     ref = BRANCH_REF_TEMPLATE % branch
+    try:
+        return gitdir.read_ref(ref) is not None
+    except gitdir.UnsupportedLayout:
+        pass
+
+    # http://stackoverflow.com/questions/5167957
     status_code, _, _ = capture_command('git', 'show-ref', '--verify',
                                         '--quiet', ref, expect_success=False)
     return status_code == 0
@@ -639,6 +1374,25 @@ def _string_type_cast(value):
     return value
 
 
+def _branch_type_cast(value):
+    """Makes sure a value is a branch name.
+
+    Args:
+        value: String; value to be type-cast.
+
+    Returns:
+        The original value, encoded as UTF-8 if it was a unicode string (as
+            loaded from JSON), to match branch names read from git.
+
+    Raises:
+        GitRvException: If the value is not a string.
+    """
+    _string_type_cast(value)
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return value
+
+
 def _int_type_cast(value):
     """Makes sure a value is an integer.
 
@@ -680,6 +1434,36 @@ def _hash_type_cast(value):
     return value
 
 
+def _bool_type_cast(value):
+    """Makes sure a value is a boolean.
+
+    Args:
+        value: Boolean; value to be type-cast.
+
+    Returns:
+        The original value, if it's a boolean.
+
+    Raises:
+        GitRvException: If the value is not a boolean.
+    """
+    if not isinstance(value, bool):
+        raise GitRvException('Property must be boolean. Received %r.'
+                             % (value,))
+    return value
+
+
+def _json_type_cast(value):
+    """Accepts any value which can be serialized as JSON, unchanged.
+
+    Args:
+        value: Value to be type-cast.
+
+    Returns:
+        The original value.
+    """
+    return value
+
+
 def simple_update_property(attr_name, can_change=False,
                            type_cast_method=_string_type_cast):
     """Creates a simple @property corresponding to an attribute.
@@ -728,35 +1512,173 @@ def simple_update_property(attr_name, can_change=False,
     return property(getter, setter)
 
 
-class _MetaBaseRepository(type):
-    """Metaclass for base repository.
+class RecordField(object):
+    """Declaration of a field in a metadata record class.
 
-    Allows arbitrary subtypes to be registered.
+    Attributes:
+        name: String; the name of the field, used for the attribute and as
+            the key when serialized.
+        slot_name: String; the name of the slot holding the value.
+        can_change: Boolean; indicating whether or not the value can change
+            once set.
+        type_cast_method: Callable which validates and casts values for the
+            field.
     """
 
-    def __init__(cls, name, bases, classdict):
-        """Constructor for metaclass.
+    __slots__ = ('name', 'slot_name', 'can_change', 'type_cast_method')
 
-        Does simple type construction and then registers the current class in
-        the repository type registry.
+    def __init__(self, name, can_change=False,
+                 type_cast_method=_string_type_cast):
+        """Constructor for RecordField.
+
+        Args:
+            name: String; the name of the field.
+            can_change: Boolean; indicating whether or not the value can
+                change once set. Defaults to False.
+            type_cast_method: Callable which casts the value to a specific
+                type, such as integer or string. Defaults to
+                _string_type_cast.
         """
-        super(_MetaBaseRepository, cls).__init__(name, bases, classdict)
-        cls.REPOSITORY_TYPE_REGISTRY.add(cls)
+        self.name = name
+        self.slot_name = '_' + name
+        self.can_change = can_change
+        self.type_cast_method = type_cast_method
 
 
-class RepositoryInfo(object):
-    """Base class for specific repository info objects.
+class _MetaRecord(type):
+    """Metaclass for metadata records.
 
-    Holds a registry of subclasses that it can use in the from_remote class
-    method for doing classification.
+    Compiles the RecordField declarations in _fields once per class: each
+    value is stored in a slot (so instances have no __dict__) behind a
+    property from simple_update_property which enforces its type and
+    can_change rules. Also precomputes the tables used by _Record to load and
+    serialize instances without going through the properties.
     """
 
-    __metaclass__ = _MetaBaseRepository
+    def __new__(mcs, name, bases, classdict):
+        """Creates a record class from its declaration.
 
-    REPOSITORY_TYPE_REGISTRY = set()
+        Args:
+            name: String; the name of the class.
+            bases: Tuple of base classes.
+            classdict: Dictionary of class attributes, with the RecordField
+                declarations in _fields and any other slots needed by the
+                class in _extra_slots.
 
-    def __init__(self, remote_url, match):
-        """Constructor for RepositoryInfo.
+        Returns:
+            The new record class.
+        """
+        fields = classdict.get('_fields', ())
+        classdict['__slots__'] = (
+                tuple(field.slot_name for field in fields) +
+                classdict.get('_extra_slots', ()))
+        for field in fields:
+            classdict[field.name] = simple_update_property(
+                    field.slot_name, can_change=field.can_change,
+                    type_cast_method=field.type_cast_method)
+
+        klass = super(_MetaRecord, mcs).__new__(mcs, name, bases, classdict)
+        all_fields = ()
+        for base in reversed(klass.__mro__):
+            all_fields += base.__dict__.get('_fields', ())
+        klass._properties = tuple(field.name for field in all_fields)
+        klass._field_table = dict((field.name, field) for field in all_fields)
+        klass._serialized_slots = tuple((field.name, field.slot_name)
+                                        for field in all_fields)
+        return klass
+
+
+class _Record(object):
+    """Base class for metadata records made of declared fields."""
+
+    __metaclass__ = _MetaRecord
+
+    _fields = ()
+
+    def __init__(self, **kwargs):
+        """Constructor for a record.
+
+        Values are validated with the type cast for their field and stored
+        directly, since nothing is set yet to protect. Keys which are not
+        fields are passed to _unknown_key. Slots for fields are left unset
+        when there is no value, and read as None.
+        """
+        field_table = self._field_table
+        for key, value in kwargs.iteritems():
+            field = field_table.get(key)
+            if field is None:
+                self._unknown_key(key, value)
+            elif value is not None:
+                setattr(self, field.slot_name, field.type_cast_method(value))
+
+    def _unknown_key(self, key, unused_value):
+        """Handles a key passed to the constructor which is not a field.
+
+        Args:
+            key: String; the key which is not a field.
+            unused_value: The value for the key.
+
+        Raises:
+            GitRvException: Always.
+        """
+        raise GitRvException('Property %r not supported for %r object.'
+                             % (key, self.__class__.__name__))
+
+    def to_dict(self):
+        """Converts the current object into dictionary for serialization.
+
+        Returns:
+            Dictionary containing all fields that have non-null values.
+        """
+        result = {}
+        for name, slot_name in self._serialized_slots:
+            value = getattr(self, slot_name, None)
+            if value is not None:
+                result[name] = value
+        return result
+
+
+class _MetaBaseRepository(type):
+    """Metaclass for base repository.
+
+    Allows arbitrary subtypes to be registered.
+    """
+
+    def __init__(cls, name, bases, classdict):
+        """Constructor for metaclass.
+
+        Does simple type construction and then registers the current class in
+        the repository type registry, along with its HOST_PREFIXES.
+        """
+        super(_MetaBaseRepository, cls).__init__(name, bases, classdict)
+        cls.REPOSITORY_TYPE_REGISTRY.append(cls)
+        # Only prefixes declared on this class, not inherited ones.
+        cls.register_host_prefixes(*classdict.get('HOST_PREFIXES', ()))
+
+
+class RepositoryInfo(object):
+    """Base class for specific repository info objects.
+
+    Holds a registry of subclasses that it can use in the from_remote class
+    method for doing classification. Subclasses are registered in the order
+    they are defined.
+
+    To avoid trying every subclass on every remote, a subclass should list the
+    host prefixes of the URLs it matches (as matched by HOST_PREFIX_REGEX) in
+    HOST_PREFIXES, or add them later via register_host_prefixes. Subclasses
+    without host prefixes are tried, in order, for remotes with an unknown
+    host.
+    """
+
+    __metaclass__ = _MetaBaseRepository
+
+    HOST_PREFIXES = ()
+    REPOSITORY_TYPE_REGISTRY = []
+    _HOST_PREFIX_TABLE = {}
+    _FROM_REMOTE_CACHE = {}
+
+    def __init__(self, remote_url, match):
+        """Constructor for RepositoryInfo.
 
         Args:
             remote_url: String containing a remote URL for a repository.
@@ -766,17 +1688,79 @@ class RepositoryInfo(object):
         self._remote_url = remote_url
         self.populate_from_match(match)
 
+    @classmethod
+    def register_host_prefixes(cls, *host_prefixes):
+        """Class method to route remotes with the given host prefixes here.
+
+        Args:
+            *host_prefixes: Strings; host prefixes of remote URLs, as matched
+                by HOST_PREFIX_REGEX, e.g. 'https://gitlab.example.com/' or
+                'git@gitlab.example.com:'.
+        """
+        for host_prefix in host_prefixes:
+            classes = cls._HOST_PREFIX_TABLE.setdefault(host_prefix, [])
+            if cls not in classes:
+                classes.append(cls)
+        # Results for previously classified remotes may have changed.
+        cls._FROM_REMOTE_CACHE.clear()
+
     @classmethod
     def from_remote(cls, remote_url):
         """Class method to find the correct repository info class for a remote.
 
+        Tries the classes registered for the host prefix of the URL, then the
+        classes without host prefixes. The result is cached per URL.
+
         Args:
             remote_url: String containing a remote URL for a repository.
+
+        Returns:
+            Instance of the first matching RepositoryInfo subclass, or None if
+                no subclass matches.
         """
-        for klass in cls.REPOSITORY_TYPE_REGISTRY:
+        if not _COMMIT_LINK_TEMPLATES_LOADED:
+            ConfiguredRepositoryInfo.load_from_config()
+            _COMMIT_LINK_TEMPLATES_LOADED.append(True)
+
+        if remote_url in cls._FROM_REMOTE_CACHE:
+            return cls._FROM_REMOTE_CACHE[remote_url]
+
+        host_match = HOST_PREFIX_REGEX.match(remote_url)
+        candidates = []
+        if host_match is not None:
+            candidates.extend(
+                    cls._HOST_PREFIX_TABLE.get(host_match.group(0), []))
+        registered_classes = cls._registered_classes()
+        candidates.extend(klass for klass in cls.REPOSITORY_TYPE_REGISTRY
+                          if klass not in registered_classes)
+
+        result = None
+        for klass in candidates:
             match = klass.match(remote_url)
             if match is not None:
-                return klass(remote_url, match)
+                result = klass(remote_url, match)
+                break
+
+        cls._FROM_REMOTE_CACHE[remote_url] = result
+        return result
+
+    @classmethod
+    def _registered_classes(cls):
+        """Class method to get the classes which have host prefixes.
+
+        Returns:
+            Set of RepositoryInfo subclasses in the host prefix table.
+        """
+        return set(klass for classes in cls._HOST_PREFIX_TABLE.itervalues()
+                   for klass in classes)
+
+    @property
+    def commit_link_template(self):
+        """Describes the template used to create commit links.
+
+        Subclasses should override this.
+        """
+        return None
 
     @classmethod
     def match(cls, unused_value):
@@ -800,6 +1784,7 @@ class GoogleCodehostingRepositoryInfo(RepositoryInfo):
     GOOGLE_CODEHOSTING_REGEX = re.compile('^(http|https)://code.google.com/p/'
                                           '(?P<project>((?!(\.git|/)).)+)'
                                           '(.git)?/?$')
+    HOST_PREFIXES = ('http://code.google.com/', 'https://code.google.com/')
     GOOGLE_CODEHOSTING_COMMIT_LINK_TEMPLATE = ('https://code.google.com/p/%s/'
                                                'source/detail?%s')
 
@@ -841,6 +1826,7 @@ class GoogleCodehostingRepositoryInfo(RepositoryInfo):
         Returns:
             URI linking to the commit specific to the current project.
         """
+        import urllib
         query_params = {'r': commit_hash}
         if self.repository is not None:
             query_params['repo'] = self.repository
@@ -848,6 +1834,11 @@ class GoogleCodehostingRepositoryInfo(RepositoryInfo):
         return self.GOOGLE_CODEHOSTING_COMMIT_LINK_TEMPLATE % (self.project,
                                                                query_string)
 
+    @property
+    def commit_link_template(self):
+        """Describes the template used to create commit links."""
+        return self.GOOGLE_CODEHOSTING_COMMIT_LINK_TEMPLATE
+
     @classmethod
     def match(cls, value):
         """Matcher to check code hosting regular expressions for links.
@@ -873,6 +1864,9 @@ class GoogleCodehostingHgRepositoryInfo(GoogleCodehostingRepositoryInfo):
                                           'code.google.com/p/'
                                           '(?P<project>((?!/).)+)'
                                           '/?$')
+    HOST_PREFIXES = ('hg::http://code.google.com/',
+                     'hg::https://code.google.com/')
+
     def __init__(self, remote_url, match):
         """Constructor for GoogleCodehostingHgRepositoryInfo.
 
@@ -902,6 +1896,7 @@ class GoogleCodehostingHgRepositoryInfo(GoogleCodehostingRepositoryInfo):
         Raises:
             GitRvException: if the remote URL doesn't start with hg::.
         """
+        import urllib
         if not remote_url.startswith('hg::'):
             raise GitRvException(
                     GOOGLE_CODEHOSTING_HG_BAD_REMOTE_TEMPLATE % (remote_url,))
@@ -913,17 +1908,41 @@ class GoogleCodehostingHgRepositoryInfo(GoogleCodehostingRepositoryInfo):
                 project_root, '.git', 'hgremotes',
                 hgremote_directory, '.hg', 'git-mapfile')
 
-    def __commit_mapping(self):
-        """Dictionary mapping git commits to Mercurial commits.
+    def __hg_commit(self, commit_hash):
+        """Finds the Mercurial commit corresponding to a git commit.
+
+        The mapping is created by git-remote-hg and stored in the file at
+        mapfile_path, one git commit hash, a space and a Mercurial commit hash
+        per row. Rather than loading the mapfile, it is mapped into memory and
+        searched for the git commit, so the file is read once at the speed of
+        a string search and nothing else has to be kept up to date when
+        git-remote-hg rewrites it.
+
+        Args:
+            commit_hash: String; the hash of a git commit.
 
         Returns:
-          A dictionary mapping SHA1 git commit strings to SHA1 Mercurial commit
-              strings. This mapping is created by git-remote-hg and stored in
-              the file at mapfile_path.
+            String containing the hash of the Mercurial commit, or None if
+                the git commit is not in the mapping.
         """
-        with open(self.mapfile_path, 'rU') as fh:
-            content = fh.read().rstrip()
-        return dict(row.split(' ', 1) for row in content.split('\n'))
+        prefix = commit_hash + ' '
+        with open(self.mapfile_path, 'rb') as fh:
+            if os.fstat(fh.fileno()).st_size == 0:
+                return None
+            mapped = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                offset = mapped.find(prefix)
+                # Only a match at the start of a row is a git commit.
+                while offset > 0 and mapped[offset - 1] != '\n':
+                    offset = mapped.find(prefix, offset + 1)
+                if offset == -1:
+                    return None
+                row_end = mapped.find('\n', offset)
+                if row_end == -1:
+                    row_end = len(mapped)
+                return mapped[offset + len(prefix):row_end].strip()
+            finally:
+                mapped.close()
 
     def commit_link(self, commit_hash):
         """Creates a commit link for a commit in the current repository.
@@ -941,11 +1960,10 @@ class GoogleCodehostingHgRepositoryInfo(GoogleCodehostingRepositoryInfo):
             GitRvException: If the commit hash is not containing in commit
                 mapping.
         """
-        commit_mapping = self.__commit_mapping()
-        if commit_hash not in commit_mapping:
+        hg_commit_hash = self.__hg_commit(commit_hash)
+        if hg_commit_hash is None:
             msg = GOOGLE_CODEHOSTING_HG_NO_MAPPING_TEMPLATE % (commit_hash,)
             raise GitRvException(msg)
-        hg_commit_hash = commit_mapping[commit_hash]
 
         return super(GoogleCodehostingHgRepositoryInfo, self).commit_link(
                 hg_commit_hash)
@@ -958,14 +1976,15 @@ class GithubRepositoryInfo(RepositoryInfo):
     ending in .git.
     """
 
-    # TODO(dhermes): See if there is a way to combine these so that one group
-    #                can influence another conditionally.
-    GITHUB_PATTERN_SUFFIX = ('(?P<organization>([^/]+))/'
-                             '(?P<repository>((?!(\.git|/)).)+)'
-                             '(.git)?/?$')
-    SIMPLE_PROTOCOL = re.compile('^(http|https|git)://(www|)github.com/' +
-                                      GITHUB_PATTERN_SUFFIX)
-    SSH = re.compile('^git@github.com:' + GITHUB_PATTERN_SUFFIX)
+    GITHUB_REGEX = re.compile('^((http|https|git)://(www\.|)github.com/|'
+                              'git@github.com:)'
+                              '(?P<organization>([^/]+))/'
+                              '(?P<repository>((?!(\.git|/)).)+)'
+                              '(.git)?/?$')
+    HOST_PREFIXES = ('http://github.com/', 'https://github.com/',
+                     'git://github.com/', 'http://www.github.com/',
+                     'https://www.github.com/', 'git://www.github.com/',
+                     'git@github.com:')
 
     GITHUB_COMMIT_LINK_TEMPLATE = 'https://github.com/%s/%s/commit/%s'
 
@@ -1003,50 +2022,173 @@ class GithubRepositoryInfo(RepositoryInfo):
         return self.GITHUB_COMMIT_LINK_TEMPLATE % (self.organization,
                                                    self.repository, commit_hash)
 
+    @property
+    def commit_link_template(self):
+        """Describes the template used to create commit links."""
+        return self.GITHUB_COMMIT_LINK_TEMPLATE
+
     @classmethod
     def match(cls, value):
-        """Matcher to use one or several regular expressions for links.
+        """Matcher to use the Github regular expression for links.
 
         Args:
             value: String containing a value to be matched.
 
         Returns:
-            An _sre.SRE_Match object if any of the regular expressions for
-                Github repositories match, otherwise None.
+            An _sre.SRE_Match object if the regular expression for Github
+                repositories matches, otherwise None.
         """
-        return cls.SIMPLE_PROTOCOL.match(value) or cls.SSH.match(value)
+        return cls.GITHUB_REGEX.match(value)
 
 
-class _UpdateInfoBase(object):
+class ConfiguredRepositoryInfo(RepositoryInfo):
+    """Repository info class for commit link templates set in git config.
 
-    def __init__(self, **kwargs):
-        """Constuctor for an info base class.
+    A subclass is created for each rv-commitlink.{$NAME} section in the git
+    config by load_from_config, with the compiled PATTERN and the TEMPLATE
+    for the section. Built-in repository classes take precedence for the
+    hosts they know about.
+    """
+
+    NAME = None
+    PATTERN = None
+    TEMPLATE = None
 
-        All arguments must come from _properties.
+    def populate_from_match(self, match):
+        """Populate instance data from a match.
+
+        Args:
+            match: A regex match corresponding to the match method for
+                this class.
 
         Raises:
-            GitRvException: If one of the attributes being set is not among
-                _properties.
+            GitRvException: If the match is None.
         """
-        for key, value in kwargs.iteritems():
-            if key not in self._properties:
-                raise GitRvException('Property %r not supported for %r object.'
-                                     % (key, self.__class__.__name__))
-            setattr(self, key, value)
+        if match is None:
+            raise GitRvException('Expected match, received None.')
+        self.groups = match.groupdict('')
 
-    def to_dict(self):
-        """Converts the current object into dictionary for serialization.
+    def commit_link(self, commit_hash):
+        """Creates a commit link for a commit in the current repository.
+
+        Args:
+            commit_hash: String; the hash of the commit we wish to link to.
 
         Returns:
-            Dictionary containing all properties from _properties that have
-                non-null values.
+            URI created from TEMPLATE using the named groups matched in the
+                remote URL and the commit hash.
         """
-        result = {}
-        for prop_name in self._properties:
-            value = getattr(self, prop_name, None)
-            if value is not None:
-                result[prop_name] = value
-        return result
+        values = dict(self.groups)
+        values[COMMIT_HASH] = commit_hash
+        return self.TEMPLATE % values
+
+    @property
+    def commit_link_template(self):
+        """Describes the template used to create commit links."""
+        return '%s: %s' % (RV_COMMIT_LINK_KEY_TEMPLATE % (self.NAME,),
+                           self.TEMPLATE)
+
+    @classmethod
+    def match(cls, value):
+        """Matcher to use the configured regular expression for links.
+
+        Args:
+            value: String containing a value to be matched.
+
+        Returns:
+            An _sre.SRE_Match object if the configured regular expression
+                matches, otherwise None.
+        """
+        if cls.PATTERN is None:
+            return None
+        return cls.PATTERN.match(value)
+
+    @classmethod
+    def from_config_section(cls, name, section_options):
+        """Class method to create a subclass for a commit link template.
+
+        Args:
+            name: String; the name of the rv-commitlink.{$NAME} section.
+            section_options: Dictionary mapping the options in the section to
+                their values.
+
+        Returns:
+            A subclass of ConfiguredRepositoryInfo for the section.
+
+        Raises:
+            GitRvException: If the section is missing its pattern or template,
+                or if either is invalid.
+        """
+        section_key = RV_COMMIT_LINK_KEY_TEMPLATE % (name,)
+        pattern = section_options.get(RV_COMMIT_LINK_PATTERN)
+        template = section_options.get(RV_COMMIT_LINK_TEMPLATE)
+        if pattern is None or template is None:
+            raise GitRvException('%s must have both a pattern and a '
+                                 'template.' % (section_key,))
+        try:
+            compiled_pattern = re.compile(pattern)
+        except re.error, exc:  # Syntax for python<2.6
+            raise GitRvException('Invalid pattern for %s: %s' %
+                                 (section_key, exc))
+
+        values = dict.fromkeys(compiled_pattern.groupindex, '')
+        values[COMMIT_HASH] = ''
+        try:
+            template % values
+        except KeyError, exc:  # Syntax for python<2.6
+            raise GitRvException('Invalid template for %s: %s is not a '
+                                 'named group of the pattern or %r.' %
+                                 (section_key, exc, COMMIT_HASH))
+        except (TypeError, ValueError), exc:
+            raise GitRvException('Invalid template for %s: %s' %
+                                 (section_key, exc))
+
+        return type('ConfiguredRepositoryInfo', (cls,), {
+            'NAME': name,
+            'PATTERN': compiled_pattern,
+            'TEMPLATE': template,
+        })
+
+    @classmethod
+    def load_from_config(cls):
+        """Class method to register the commit link templates in git config.
+
+        Reads every rv-commitlink.{$NAME} option with a single "git config"
+        call and compiles each pattern, so this only needs to happen once.
+        An invalid section is reported on stderr and ignored, so a typo in the
+        config doesn't stop every command; remotes it was meant for get no
+        commit link.
+        """
+        proc_result, config_output, _ = capture_command(
+                'git', 'config', '--get-regexp', RV_COMMIT_LINK_KEY_REGEX,
+                expect_success=False)
+        if proc_result != 0:
+            return
+
+        # Sections in the order they first appear in the config.
+        sections = []
+        options = {}
+        prefix_length = len(RV_COMMIT_LINK_KEY_TEMPLATE % ('',))
+        for line in config_output.splitlines():
+            key, _, value = line.partition(' ')
+            name, _, option = key[prefix_length:].rpartition('.')
+            if name not in options:
+                sections.append(name)
+                options[name] = {}
+            options[name][option] = value
+
+        for name in sections:
+            try:
+                klass = cls.from_config_section(name, options[name])
+            except GitRvException, exc:  # Syntax for python<2.6
+                sys.stderr.write(INVALID_COMMIT_LINK_CONFIG_TEMPLATE % (exc,))
+                continue
+            host_prefix = options[name].get(RV_COMMIT_LINK_HOST_PREFIX)
+            if host_prefix is not None:
+                klass.register_host_prefixes(host_prefix)
+
+
+class _UpdateInfoBase(_Record):
 
     def update(self, other):
         """Updates using another instance of RemoteInfo.
@@ -1067,21 +2209,21 @@ class RemoteInfo(_UpdateInfoBase):
     Will ensure that only last_synced can be changed once set.
     """
 
-    _properties = ('last_synced', 'commit_hash', 'remote', 'branch', 'url')
-
     # TODO(dhermes): Make some of these required. Since we only care about this
     #                at serialization time, could enforce it in to_dict(). It
     #                makes sense to allow __init__ to allow partial attrs, since
     #                these instances may be created just to pass to update() for
     #                a pre-existing instance.
 
-    last_synced = simple_update_property('_last_synced', can_change=True,
-                                         type_cast_method=_hash_type_cast)
-    commit_hash = simple_update_property('_commit_hash', can_change=False,
-                                         type_cast_method=_hash_type_cast)
-    remote = simple_update_property('_remote', can_change=False)
-    branch = simple_update_property('_branch', can_change=False)
-    url = simple_update_property('_url', can_change=False)
+    _fields = (
+        RecordField('last_synced', can_change=True,
+                    type_cast_method=_hash_type_cast),
+        RecordField('commit_hash', can_change=False,
+                    type_cast_method=_hash_type_cast),
+        RecordField('remote', can_change=False),
+        RecordField('branch', can_change=False),
+        RecordField('url', can_change=False),
+    )
 
     @property
     def repository_info(self):
@@ -1106,40 +2248,164 @@ class ReviewInfo(_UpdateInfoBase):
     Will ensure that issue can't be changed once set.
     """
 
-    _properties = ('issue', 'subject', 'description', 'last_commit')
+    _fields = (
+        RecordField('issue', can_change=False,
+                    type_cast_method=_int_type_cast),
+        RecordField('subject', can_change=True),
+        RecordField('description', can_change=True),
+        RecordField('last_commit', can_change=True,
+                    type_cast_method=_hash_type_cast),
+        RecordField('last_message_index', can_change=True,
+                    type_cast_method=_int_type_cast),
+    )
+
+
+def _upgrade_metadata_from_v1(branch_info):
+    """Migrates branch metadata from version 1 to version 2.
+
+    Only the encoding changed, so the values are kept as is.
+
+    Args:
+        branch_info: Dictionary of version 1 branch metadata.
+
+    Returns:
+        Dictionary of version 2 branch metadata.
+    """
+    return branch_info
+
+
+# Each maps a metadata version to the function which migrates metadata of that
+# version to the next (or previous) version. Downgrades allow metadata written
+# by a newer git-rv to be read, if the newer version provides one.
+_METADATA_UPGRADES = {1: _upgrade_metadata_from_v1}
+_METADATA_DOWNGRADES = {}
 
-    issue = simple_update_property('_issue', can_change=False,
-                                   type_cast_method=_int_type_cast)
-    subject = simple_update_property('_subject', can_change=True)
-    description = simple_update_property('_description', can_change=True)
-    last_commit = simple_update_property('_last_commit', can_change=True,
-                                         type_cast_method=_hash_type_cast)
 
+def encode_metadata(branch_info):
+    """Serializes branch metadata for storage in the git config.
+
+    Args:
+        branch_info: Dictionary of branch metadata at METADATA_VERSION.
 
-class RietveldInfo(object):
+    Returns:
+        String containing compact JSON, including the metadata version.
+    """
+    branch_info = dict(branch_info)
+    branch_info[VERSION] = METADATA_VERSION
+    return json.dumps(branch_info, separators=(',', ':'))
+
+
+def decode_metadata(opaque_info):
+    """Deserializes branch metadata stored in the git config.
+
+    Metadata stored in an older (or newer) format is migrated to
+    METADATA_VERSION.
+
+    Args:
+        opaque_info: String; the serialized data stored in the git config.
+
+    Returns:
+        Dictionary of branch metadata at METADATA_VERSION, without the
+            version itself.
+
+    Raises:
+        GitRvException: If the metadata can't be decoded or migrated.
+    """
+    opaque_info = opaque_info.strip()
+    try:
+        if opaque_info.startswith('{'):
+            branch_info = json.loads(opaque_info)
+        else:
+            branch_info = json.loads(base64.b64decode(opaque_info))
+            if isinstance(branch_info, dict):
+                branch_info[VERSION] = 1
+    except (TypeError, ValueError), exc:  # Syntax for python<2.6
+        raise GitRvException('Could not be decoded (%s).' % (exc,))
+
+    if not isinstance(branch_info, dict):
+        raise GitRvException('Expected a JSON object, found %r.' %
+                             (branch_info,))
+    version = branch_info.pop(VERSION, None)
+    if not isinstance(version, int) or version < 1:
+        raise GitRvException('Unknown metadata version %r.' % (version,))
+
+    while version < METADATA_VERSION:
+        branch_info = _METADATA_UPGRADES[version](branch_info)
+        version += 1
+    while version > METADATA_VERSION:
+        downgrade = _METADATA_DOWNGRADES.get(version)
+        if downgrade is None:
+            raise GitRvException('Metadata version %d was written by a newer '
+                                 'version of git-rv.' % (version,))
+        branch_info = downgrade(branch_info)
+        version -= 1
+    return branch_info
+
+
+class RietveldInfo(_Record):
     """Object for holding, reading and saving Rietveld review metadata.
 
     Defines properties needed to act as gatekeepers, methods for saving the info
     to the local machine, and class methods for creating an instance from the
     local config.
+
+    Keys in stored metadata which are not fields (e.g. written by a newer
+    version of git-rv) are kept in _extra and saved again unchanged.
+
+    A review stacked on the review in another branch has that branch as its
+    parent_branch, and is diffed against the last commit exported in the
+    parent review which it has merged (parent_last_synced) rather than
+    against the remote branch. Its remote info is copied from the parent,
+    since that is where it is eventually submitted.
     """
+
     # TODO(dhermes): Consider protecting the values of host/private.
-    server = simple_update_property('_server', can_change=False)
+    _fields = (
+        RecordField('server', can_change=False),
+        RecordField('approved', can_change=True,
+                    type_cast_method=_bool_type_cast),
+        RecordField('cc', can_change=True, type_cast_method=_json_type_cast),
+        RecordField('host', can_change=True),
+        RecordField('private', can_change=True,
+                    type_cast_method=_bool_type_cast),
+        RecordField('reviewers', can_change=True,
+                    type_cast_method=_json_type_cast),
+        RecordField('sync_halted', can_change=True,
+                    type_cast_method=_bool_type_cast),
+        RecordField('parent_branch', can_change=True,
+                    type_cast_method=_branch_type_cast),
+        RecordField('parent_last_synced', can_change=True,
+                    type_cast_method=_hash_type_cast),
+    )
+    _extra_slots = ('_branch_name', '_remote_info', '_review_info', '_extra')
 
     def __init__(self, branch_name, **kwargs):
         """Constuctor for RietveldInfo.
 
-        Uses key for saving, all other arguments are optional. They will be set
-        on the instance via setattr, which will either just add a new property
-        or invoke the @property associated with the keyword from kwargs.
+        Uses key for saving, all other arguments are optional. Fields are
+        validated and set directly, remote and review info are set via their
+        properties and any other keys are kept in _extra.
 
         Args:
             branch_name: String; containing the name of a branch.
         """
         self._branch_name = branch_name
+        self._remote_info = None
+        self._review_info = None
+        self._extra = {}
+        super(RietveldInfo, self).__init__(**kwargs)
 
-        for key, value in kwargs.iteritems():
+    def _unknown_key(self, key, value):
+        """Handles a key passed to the constructor which is not a field.
+
+        Args:
+            key: String; the key which is not a field.
+            value: The value for the key.
+        """
+        if key in (REMOTE_INFO, REVIEW_INFO):
             setattr(self, key, value)
+        else:
+            self._extra[key] = value
 
     @classmethod
     def from_branch(cls, branch_name=None):
@@ -1161,13 +2427,91 @@ class RietveldInfo(object):
         branch_name = branch_name or get_current_branch()
         metadata_key = RIETVELD_KEY_TEMPLATE % (branch_name,)
 
-        proc_result, opaque_info, _ = capture_command(
-                'git', 'config', metadata_key, expect_success=False)
+        try:
+            # Metadata is only ever stored in the repository config, so a
+            # missing key means there is no metadata.
+            opaque_info = gitdir.get_config_value(metadata_key)
+            if opaque_info is None:
+                return None
+        except gitdir.UnsupportedLayout:
+            proc_result, opaque_info, _ = capture_command(
+                    'git', 'config', metadata_key, expect_success=False)
+            if proc_result != 0:
+                return None
+
+        return cls.from_config_value(branch_name, opaque_info)
+
+    @classmethod
+    def from_config_value(cls, branch_name, opaque_info):
+        """Class method to create an object from a stored config value.
+
+        The stored value is migrated to the current metadata version and
+        validated, so that invalid metadata is reported up front.
+
+        Args:
+            branch_name: String; containing the name of a branch.
+            opaque_info: String; the serialized data stored in the git config
+                for the branch.
+
+        Returns:
+            Instance of RietveldInfo created using the deserialized values.
+
+        Raises:
+            GitRvException: If the stored value is invalid.
+        """
+        try:
+            branch_info = decode_metadata(opaque_info)
+            return cls(branch_name, **branch_info)
+        except GitRvException, exc:  # Syntax for python<2.6
+            raise GitRvException(CORRUPT_METADATA_TEMPLATE % {
+                BRANCH: branch_name,
+                ERROR: exc,
+                KEY: RIETVELD_KEY_TEMPLATE % (branch_name,),
+            })
+
+    @classmethod
+    def all_branches(cls):
+        """Class method to load the Rietveld info for every review branch.
+
+        Uses a single "git config" call rather than one per branch.
+
+        NOTE: git reports the last part of each config variable name in lower
+        case (but keeps the case of the part before it, for branch names with
+        dots), so the case of each branch name is recovered from the existing
+        branches by comparing in lower case. Metadata for a branch which no
+        longer exists is keyed by the name as git reports it.
+
+        Branches with invalid metadata are reported and skipped.
+
+        Returns:
+            Dictionary with each key a branch name and each value the
+                RietveldInfo object stored for that branch.
+        """
+        proc_result, config_output, _ = capture_command(
+                'git', 'config', '--get-regexp', RIETVELD_KEY_REGEX,
+                expect_success=False)
         if proc_result != 0:
-            return None
+            return {}
+
+        # Recover the case of branch names from the actual branches.
+        branch_names = capture_command(
+                'git', 'for-each-ref', '--format=%(refname:short)',
+                'refs/heads/', single_line=False).split()
+        actual_names = dict((branch_name.lower(), branch_name)
+                            for branch_name in branch_names)
 
-        branch_info = json.loads(base64.b64decode(opaque_info))
-        return cls(branch_name, **branch_info)
+        result = {}
+        prefix_length = len(RIETVELD_KEY) + 1
+        for line in config_output.splitlines():
+            metadata_key, opaque_info = line.split(' ', 1)
+            branch_name = metadata_key[prefix_length:]
+            branch_name = actual_names.get(branch_name.lower(), branch_name)
+            try:
+                result[branch_name] = cls.from_config_value(branch_name,
+                                                            opaque_info)
+            except GitRvException, exc:  # Syntax for python<2.6
+                print 'Skipping branch %r. %s' % (branch_name, exc)
+        return result
 
     @property
     def key(self):
@@ -1181,7 +2525,7 @@ class RietveldInfo(object):
     @property
     def remote_info(self):
         """Simple getter for remote info."""
-        return getattr(self, '_remote_info', None)
+        return self._remote_info
 
     @remote_info.setter
     def remote_info(self, value):
@@ -1201,7 +2545,7 @@ class RietveldInfo(object):
                                  'dictionary or RemoteInfo instance. Received '
                                  '%r for metadata key %r.' % (value, self.key))
 
-        if getattr(self, '_remote_info', None) is None:
+        if self._remote_info is None:
             self._remote_info = value
         else:
             self._remote_info.update(value)
@@ -1209,7 +2553,7 @@ class RietveldInfo(object):
     @property
     def review_info(self):
         """Simple getter for review info."""
-        return getattr(self, '_review_info', None)
+        return self._review_info
 
     @review_info.setter
     def review_info(self, value):
@@ -1229,23 +2573,53 @@ class RietveldInfo(object):
                                  'dictionary or ReviewInfo instance. Received '
                                  '%r for metadata key %r.' % (value, self.key))
 
-        if getattr(self, '_review_info', None) is None:
+        if self._review_info is None:
             self._review_info = value
         else:
             self._review_info.update(value)
 
+    @property
+    def last_synced(self):
+        """The commit hash the review is diffed against.
+
+        This is parent_last_synced for a stacked review, otherwise the
+        last_synced value of the remote info.
+        """
+        if self.parent_branch is not None:
+            return self.parent_last_synced
+        elif self._remote_info is not None:
+            return self._remote_info.last_synced
+
+    @last_synced.setter
+    def last_synced(self, value):
+        """Setter for the commit hash the review is diffed against.
+
+        Args:
+            value: String; the hash of the commit last synced from the parent
+                review or from the remote branch.
+        """
+        if self.parent_branch is not None:
+            self.parent_last_synced = value
+        else:
+            self._remote_info.last_synced = value
+
     def remove_key(self, key):
         """Removes a specified key from Rietveld info.
 
-        Intentionally doesn't allow removal of properties.
+        Intentionally doesn't allow removal of fields which can't change.
 
         Args:
             key: String; a key to be removed from the current Rietveld info.
         """
-        if key not in self.__dict__:
+        field = self._field_table.get(key)
+        if key in self._extra:
+            del self._extra[key]
+        elif (field is not None and field.can_change and
+              getattr(self, field.slot_name, None) is not None):
+            delattr(self, field.slot_name)
+        else:
             return
 
-        del self.__dict__[key]
         self.save()
 
     @staticmethod
@@ -1262,68 +2636,185 @@ class RietveldInfo(object):
 
         capture_command('git', 'config', '--unset',
                         metadata_key, single_line=False)
+        prompt_record_path = get_rv_path(PROMPT_DIRECTORY, branch_name)
+        if os.path.exists(prompt_record_path):
+            os.remove(prompt_record_path)
 
         proc_result, _, _ = capture_command(
                 'git', 'config', '--get-regexp',
                 RIETVELD_KEY_REGEX, expect_success=False)
 
         if proc_result != 0:
-            # Remove the section since empty
+            # Remove the section since empty. Newer versions of git remove
+            # empty sections on their own, so this is allowed to fail.
             capture_command('git', 'config', '--remove-section',
-                            RIETVELD_KEY, single_line=False)
+                            RIETVELD_KEY, expect_success=False)
 
     def to_dict(self):
         """Converts the current object to a dictionary for serialization.
 
-        Pulls non-properties from self.__dict__. Otherwise, adds the property
-        directly or uses to_dict for nested/complex properties.
+        Adds the fields and unknown keys directly and uses to_dict for the
+        nested remote and review info.
 
         Returns:
             Dictionary representing the current object.
         """
-        result = {}
-
-        # Nested {@property}s
-        if self.remote_info is not None:
-            result[REMOTE_INFO] = self.remote_info.to_dict()
-        if self.review_info is not None:
-            result[REVIEW_INFO] = self.review_info.to_dict()
+        result = dict(self._extra)
+        result.update(super(RietveldInfo, self).to_dict())
+        if self._remote_info is not None:
+            result[REMOTE_INFO] = self._remote_info.to_dict()
+        if self._review_info is not None:
+            result[REVIEW_INFO] = self._review_info.to_dict()
+        return result
 
-        # Simple {@property}s
-        if self.server is not None:
-            result[SERVER] = self.server
+    def write_prompt_record(self):
+        """Writes the status record for this branch read by shell prompts.
 
-        # Other values.
-        for key, value in self.__dict__.iteritems():
-            if not key.startswith('_') and value is not None:
-                result[key] = value
-        return result
+        The record is a single line in PROMPT_RECORD_TEMPLATE format, replaced
+        atomically so a prompt never reads a partially written record.
+        """
+        issue = last_commit = '-'
+        if self.review_info is not None:
+            if self.review_info.issue is not None:
+                issue = self.review_info.issue
+            last_commit = self.review_info.last_commit or '-'
+
+        record = PROMPT_RECORD_TEMPLATE % {
+            ISSUE: issue,
+            APPROVED: '-' if self.approved is None else int(self.approved),
+            SYNC_HALTED: int(bool(self.sync_halted)),
+            LAST_COMMIT: last_commit,
+        }
+        write_file_atomically(get_rv_path(PROMPT_DIRECTORY, self._branch_name),
+                              record)
 
     def save(self):
         """Writes serialized form of current object to local config.
 
+        Also updates the status record read by shell prompts.
+
         Returns:
             Dictionary containing the serialized form of the current object.
         """
         as_dict = self.to_dict()
-        opaque_info = base64.b64encode(json.dumps(as_dict))
+        opaque_info = encode_metadata(as_dict)
         result = capture_command('git', 'config', self.key,
                                  opaque_info, single_line=False)
         if result:
             raise GitRvException('Unexpected output %r from "git config".' %
                                  (result,))
+        self.write_prompt_record()
         return as_dict
 
 
-def in_clean_state():
+def in_clean_state(trust_index=None):
     """Checks if the current branch is in a clean state.
 
+    The branch is clean if no tracked file has staged or unstaged changes.
+    Untracked files are ignored, so they are never scanned for.
+
+    By default "git status --porcelain=v2 -uno" is used, which checks the
+    working tree using core.fsmonitor if it is configured and refreshes the
+    stat information in the index for later commands. git computes the whole
+    status before printing any of it, so there is no early exit at the first
+    change; the cost is one pass over the (fsmonitor filtered) tracked files.
+
+    If the index is trusted (RV_TRUST_INDEX_KEY), the working tree is assumed
+    to match the index, so only the index is compared with HEAD and no files
+    are checked at all.
+
+    Args:
+        trust_index: Boolean; whether to only compare the index with HEAD.
+            Defaults to None, in which case RV_TRUST_INDEX_KEY is used.
+
     Returns:
         A boolean indicating whether or not the branch is in a clean state.
     """
-    proc_result, _, _ = capture_command(
-            'git', 'diff', '--exit-code', '--quiet', expect_success=False)
-    return proc_result == 0
+    if trust_index is None:
+        trust_index = get_config_bool(RV_TRUST_INDEX_KEY)
+
+    if trust_index:
+        with profile('clean state check (index only)'):
+            proc_result, _, _ = capture_command(
+                    'git', 'diff-index', '--cached', '--quiet', 'HEAD',
+                    expect_success=False)
+        return proc_result == 0
+
+    with profile('clean state check (status)'):
+        # Not capture_command, which waits for the process before reading its
+        # output and so would block if many files changed.
+        with open(os.devnull, 'wb') as null_fh:
+            proc = subprocess.Popen(
+                    ['git', 'status', '--porcelain=v2', '-uno', '--no-renames'],
+                    stdout=subprocess.PIPE, stderr=null_fh)
+        status_output = proc.communicate()[0]
+    if proc.returncode != 0:
+        raise GitRvException('Could not check for changes with "git status".')
+    return not any(line.startswith(STATUS_CHANGE_PREFIXES)
+                   for line in status_output.splitlines())
+
+
+def remove_git_rv_args(argv):
+    """Removes the flags upload.py doesn't know about from command line args.
+
+    Args:
+        argv: List of strings; command line arguments of a git-rv command.
+
+    Returns:
+        List of strings; the arguments without any in GIT_RV_ONLY_ARGS (and
+            their values).
+    """
+    result = []
+    skip_value = False
+    for value in argv:
+        if skip_value:
+            skip_value = False
+            continue
+        name = value.split('=', 1)[0]
+        if name in GIT_RV_ONLY_ARGS:
+            skip_value = name in GIT_RV_ONLY_VALUE_ARGS and '=' not in value
+        else:
+            result.append(value)
+    return result
+
+
+def print_unclean_state(branch, full_diff=False):
+    """Tells the user why a command won't run on an unclean branch.
+
+    By default, summarizes the changes to tracked files with the number of
+    lines added and removed in each of the first UNCLEAN_SUMMARY_MAX_FILES.
+    The "git diff --numstat" output is read as it is produced and the process
+    is stopped once enough files are listed, so the summary is quick no
+    matter how large the changes are.
+
+    Args:
+        branch: String; the name of the branch which is not clean.
+        full_diff: Boolean; whether to show the full diff through the git
+            pager instead of the summary. Defaults to False.
+    """
+    print 'Branch %r not in clean state:' % (branch,)
+    sys.stdout.flush()
+    if full_diff:
+        subprocess.call(['git', '--paginate', 'diff', 'HEAD'])
+        return
+
+    proc = subprocess.Popen(['git', 'diff', '--numstat', '--no-renames',
+                             'HEAD'], stdout=subprocess.PIPE)
+    listed = 0
+    for line in iter(proc.stdout.readline, ''):
+        if listed == UNCLEAN_SUMMARY_MAX_FILES:
+            print '    ... and more files.'
+            proc.terminate()
+            break
+        added, removed, path = line.rstrip('\n').split('\t', 2)
+        if added == '-':
+            print '    %s (binary)' % (path,)
+        else:
+            print '    %s (+%s -%s)' % (path, added, removed)
+        listed += 1
+    proc.stdout.close()
+    proc.wait()
+    print 'Run with %s to see the full diff.' % (FULL_DIFF_ARG,)
 
 
 def in_review(current_branch=None, rietveld_info=None):
@@ -1348,9 +2839,222 @@ def in_review(current_branch=None, rietveld_info=None):
     return rietveld_info.review_info is not None
 
 
-def get_issue_metadata(issue=None, current_branch=None, server=CODE_REVIEW):
+class RietveldRequestError(GitRvException):
+    """Exception raised when a request to the Rietveld server fails.
+
+    Attributes:
+        status: Integer; the HTTP status code of the failed response.
+        retry_after: Integer; the number of seconds the server asked clients
+            to wait before retrying, or None if it didn't say.
+    """
+
+    def __init__(self, message, status, retry_after=None):
+        super(RietveldRequestError, self).__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+def _get_connection(server):
+    """Creates an HTTP connection to a Rietveld server.
+
+    Mirrors upload.py by using plain HTTP for servers on localhost (or ones
+    explicitly given with http://), which allows a local stand-in server to
+    be used. All other servers use HTTPS.
+
+    Args:
+        server: String; the address of the Rietveld server.
+
+    Returns:
+        An httplib.HTTPConnection or httplib.HTTPSConnection to the server.
+    """
+    import httplib
+    if server.startswith('http://'):
+        return httplib.HTTPConnection(server[len('http://'):].rstrip('/'))
+    elif server.startswith('https://'):
+        return httplib.HTTPSConnection(server[len('https://'):].rstrip('/'))
+    elif LOCALHOST_REGEX.match(server):
+        return httplib.HTTPConnection(server)
+    # TODO(dhermes): httplib doesn't check certs, should we use a different
+    #                library not packaged in stdlib? SSL must be used because
+    #                without it the API request returns a 301.
+    return httplib.HTTPSConnection(server)
+
+
+def _get_retry_after(response):
+    """Gets the number of seconds a server asked clients to wait.
+
+    Args:
+        response: An httplib.HTTPResponse from a Rietveld server.
+
+    Returns:
+        Integer; the value of the Retry-After header, or None if the header is
+            not set to a number of seconds.
+    """
+    retry_after = response.getheader('Retry-After')
+    if retry_after is not None and retry_after.isdigit():
+        return int(retry_after)
+
+
+def read_server_paths(server, paths):
+    """Reads several paths from a Rietveld server over a single connection.
+
+    Args:
+        server: String; the address of the Rietveld server.
+        paths: List of strings; the paths to request, in order.
+
+    Returns:
+        List of strings containing the response bodies, in the same order as
+            paths.
+
+    Raises:
+        RietveldRequestError: If any of the requests does not return a 200
+            status code.
+    """
+    with contextlib.closing(_get_connection(server)) as connection:
+        return [_read_path(connection, server, path) for path in paths]
+
+
+def _read_path(connection, server, path):
+    """Reads a path from a Rietveld server over an open connection.
+
+    Args:
+        connection: An httplib.HTTPConnection to the server.
+        server: String; the address of the Rietveld server.
+        path: String; the path to request.
+
+    Returns:
+        String containing the response body.
+
+    Raises:
+        RietveldRequestError: If the request does not return a 200 status code.
+    """
+    connection.request('GET', path)
+
+    response = connection.getresponse()
+    # The body must be read before the connection can be reused.
+    payload = response.read()
+    if response.status != 200:
+        template_values = {PATH: path, SERVER: server,
+                           STATUS: response.status, REASON: response.reason}
+        raise RietveldRequestError(
+                SERVER_REQUEST_ERROR_TEMPLATE % template_values,
+                response.status, retry_after=_get_retry_after(response))
+    return payload
+
+
+def _issue_cache_path(issue, server):
+    """Gets the path of the local cache file for an issue.
+
+    Args:
+        issue: Integer; containing an ID of a code review issue.
+        server: String; the address of the Rietveld server hosting the code
+            review.
+
+    Returns:
+        String containing the path of the cache file.
+    """
+    import urllib
+    return get_rv_path(ISSUE_CACHE_DIRECTORY, urllib.quote_plus(server),
+                       '%d.json' % (issue,))
+
+
+def read_cached_issue_metadata(issue, server, max_age=None):
+    """Reads metadata for a code review issue from the local cache.
+
+    Args:
+        issue: Integer; containing an ID of a code review issue.
+        server: String; the address of the Rietveld server hosting the code
+            review.
+        max_age: Number of seconds a cached value stays fresh. Defaults to
+            None, in which case the cached value is returned regardless of
+            its age.
+
+    Returns:
+        Dictionary containing the cached entry, with the metadata stored under
+            METADATA and the time it was fetched under FETCHED. If there is no
+            entry or it is older than max_age, returns None.
+    """
+    try:
+        with open(_issue_cache_path(issue, server), 'rb') as fh:
+            entry = json.load(fh)
+    except (IOError, ValueError):
+        return None
+
+    if max_age is not None and time.time() - entry[FETCHED] > max_age:
+        return None
+    return entry
+
+
+def cache_issue_metadata(issue, server, metadata):
+    """Stores metadata for a code review issue in the local cache.
+
+    Args:
+        issue: Integer; containing an ID of a code review issue.
+        server: String; the address of the Rietveld server hosting the code
+            review.
+        metadata: Parsed dictionary from the JSON payload for the issue.
+    """
+    entry = {FETCHED: time.time(), METADATA: metadata}
+    write_file_atomically(_issue_cache_path(issue, server), json.dumps(entry))
+
+
+def fetch_issue_metadata(issue, server=CODE_REVIEW):
+    """Fetches metadata JSON for a code review issue from the server.
+
+    The result is also stored in the local issue cache. If the issue is
+    already cached, the issue is first requested without its messages, and if
+    it hasn't been modified since it was cached, the cached messages are
+    reused instead of transferring the full message history again.
+
+    Args:
+        issue: Integer; containing an ID of a code review issue.
+        server: String; the address of the Rietveld server hosting the code
+            review. Defaults to CODE_REVIEW.
+
+    Returns:
+        Parsed dictionary from JSON payload.
+
+    Raises:
+        RietveldRequestError: If the API request for the issue info does not
+            return a 200 status code.
+    """
+    issue_path = ISSUE_URI_PATH_TEMPLATE % {ISSUE: issue}
+    entry = read_cached_issue_metadata(issue, server)
+
+    with contextlib.closing(_get_connection(server)) as connection:
+        if entry is not None and entry[METADATA].get(MODIFIED) is not None:
+            summary = json.loads(_read_path(
+                    connection, server,
+                    ISSUE_SUMMARY_URI_PATH_TEMPLATE % {ISSUE: issue}))
+            if summary.get(MODIFIED) == entry[METADATA][MODIFIED]:
+                cache_issue_metadata(issue, server, entry[METADATA])
+                return entry[METADATA]
+
+        connection.request('GET', issue_path)
+
+        response = connection.getresponse()
+        if response.status != 200:
+            template_values = {ISSUE: issue, SERVER: server,
+                               STATUS: response.status,
+                               REASON: response.reason}
+            raise RietveldRequestError(
+                    ISSUE_INFO_ERROR_TEMPLATE % template_values,
+                    response.status, retry_after=_get_retry_after(response))
+
+        payload = response.read()
+
+    metadata = json.loads(payload)
+    cache_issue_metadata(issue, server, metadata)
+    return metadata
+
+
+def get_issue_metadata(issue=None, current_branch=None, server=CODE_REVIEW,
+                       max_age=ISSUE_METADATA_MAX_AGE):
     """Gets metadata JSON for a code review issue.
 
+    Uses the local issue cache (kept warm by "git rv daemon") if the cached
+    value is fresh enough, otherwise revalidates with the server.
+
     Args:
         issue: Integer; containing an ID of a code review issue. Defaults to
             None and in this case is replaced by a call to get_current_issue.
@@ -1358,6 +3062,8 @@ def get_issue_metadata(issue=None, current_branch=None, server=CODE_REVIEW):
             Defaults to None.
         server: String; the address of the Rietveld server hosting the code
             review. Defaults to CODE_REVIEW.
+        max_age: Number of seconds a cached value stays fresh. Defaults to
+            ISSUE_METADATA_MAX_AGE. If 0, the server is always contacted.
 
     Returns:
         Parsed dictionary from JSON payload.
@@ -1367,28 +3073,35 @@ def get_issue_metadata(issue=None, current_branch=None, server=CODE_REVIEW):
             200 status code.
     """
     issue = issue or get_current_issue(current_branch=current_branch)
-    issue_path = ISSUE_URI_PATH_TEMPLATE % {ISSUE: issue}
 
-    # TODO(dhermes): httplib doesn't check certs, should we use a different
-    #                library not packaged in stdlib? SSL must be used because
-    #                without it the API request returns a 301.
-    with contextlib.closing(httplib.HTTPSConnection(server)) as connection:
-      connection.request('GET', issue_path)
+    if max_age:
+        entry = read_cached_issue_metadata(issue, server, max_age=max_age)
+        if entry is not None:
+            return entry[METADATA]
 
-      response = connection.getresponse()
-      if response.status != 200:
-          template_values = {ISSUE: issue, SERVER: server,
-                             STATUS: response.status,
-                             REASON: response.reason}
-          raise GitRvException(ISSUE_INFO_ERROR_TEMPLATE % template_values)
+    return fetch_issue_metadata(issue, server=server)
 
-      payload = response.read()
 
-    return json.loads(payload)
+def issue_approved(issue_metadata):
+    """Determines if issue metadata shows the issue has been approved.
+
+    Args:
+        issue_metadata: Parsed dictionary from JSON payload for an issue.
+
+    Returns:
+        Boolean indicating that any of the messages in the code review
+            contained LGTM.
+    """
+    messages = issue_metadata[MESSAGES]
+    # TODO(dhermes): Consider checking for 'disapproval' as well and making sure
+    #                that the most recent approval happened before the most
+    #                recent disapproval.
+    return any(message.get(APPROVAL, False) for message in messages)
 
 
 def is_current_issue_approved(issue=None, current_branch=None,
-                              server=CODE_REVIEW):
+                              server=CODE_REVIEW,
+                              max_age=ISSUE_METADATA_MAX_AGE):
     """Determines if the current issue has been approved in code review.
 
     Args:
@@ -1398,22 +3111,22 @@ def is_current_issue_approved(issue=None, current_branch=None,
             Defaults to None.
         server: String; the address of the Rietveld server hosting the code
             review. Defaults to CODE_REVIEW.
+        max_age: Number of seconds cached issue metadata stays fresh. Defaults
+            to ISSUE_METADATA_MAX_AGE.
 
     Returns:
         Boolean indicating that any of the messages in the code review for the
             current issue contained LGTM.
     """
     issue_metadata = get_issue_metadata(
-            issue=issue, current_branch=current_branch, server=server)
-    messages = issue_metadata[MESSAGES]
-    # TODO(dhermes): Consider checking for 'disapproval' as well and making sure
-    #                that the most recent approval happened before the most
-    #                recent disapproval.
-    return any(message.get(APPROVAL, False) for message in messages)
+            issue=issue, current_branch=current_branch, server=server,
+            max_age=max_age)
+    return issue_approved(issue_metadata)
 
 
 def update_rietveld_metadata_from_issue(current_branch=None,
-                                        rietveld_info=None):
+                                        rietveld_info=None,
+                                        max_age=ISSUE_METADATA_MAX_AGE):
     """Updates the Rietveld metadata for a branch from the issue metadata.
 
     Args:
@@ -1422,6 +3135,8 @@ def update_rietveld_metadata_from_issue(current_branch=None,
         rietveld_info: RietveldInfo object containing metadata associated with
             the current branch. Defaults to None and here will be replaced by
             info for current branch.
+        max_age: Number of seconds cached issue metadata stays fresh. Defaults
+            to ISSUE_METADATA_MAX_AGE.
 
     Returns:
         A tuple containing a boolean indicating success or failure of the update
@@ -1438,7 +3153,8 @@ def update_rietveld_metadata_from_issue(current_branch=None,
         return (False, rietveld_info)
 
     issue = review_info.issue
-    issue_metadata = get_issue_metadata(issue=issue, server=server)
+    issue_metadata = get_issue_metadata(issue=issue, server=server,
+                                        max_age=max_age)
 
     success = False
     if (REVIEWERS in issue_metadata and CC in issue_metadata and
@@ -1451,6 +3167,9 @@ def update_rietveld_metadata_from_issue(current_branch=None,
                 review_info.description = issue_metadata[ISSUE_DESCRIPTION]
             else:
                 review_info.description = ''
+        if MESSAGES in issue_metadata:
+            # Cached so "git rv status" can report it without the network.
+            rietveld_info.approved = issue_approved(issue_metadata)
         rietveld_info.save()
         success = True
 
@@ -0,0 +1,289 @@
+# Copyright 2013 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Wait command for git-rv command line tool.
+
+Waits for the reviews of one or more branches to be approved, and optionally
+submits each of them as soon as it is.
+"""
+
+
+import heapq
+import random
+import time
+
+import daemon
+import submit
+import utils
+
+
+class WaitAction(object):
+    """A state machine which waits for reviews to be approved.
+
+    All branches are watched from a single schedule. Each branch is polled
+    again after a delay which doubles (up to a maximum) every time its issue
+    is found unchanged, and drops back to the minimum when the issue changes.
+
+    Attributes:
+        state: The current state of the WaitAction state machine.
+        __branches: List of strings; the branches to wait for.
+        __min_interval: Number of seconds between polls of an issue which has
+            just changed.
+        __max_interval: Maximum number of seconds between polls of an issue.
+        __timeout: Number of seconds to wait before giving up, or None to wait
+            until every review is approved or closed.
+        __rpc_server_args: A dictionary of arguments to be passed to
+            GetRpcServer when submitting, or None if approved branches should
+            not be submitted.
+        __do_close: Boolean; Represents whether issues should be closed after
+            submitting.
+        __skip_presubmit: Boolean; whether to skip the presubmit checks when
+            submitting.
+        __rietveld_infos: Dictionary mapping each branch to its RietveldInfo.
+    """
+
+    CHECK_BRANCHES = 0
+    WAIT_FOR_APPROVALS = 1
+    FINISHED = 2
+
+    def __init__(self, branches, min_interval, max_interval, timeout=None,
+                 rpc_server_args=None, do_close=True, skip_presubmit=False):
+        """Constructor for WaitAction.
+
+        Args:
+            branches: List of strings; the branches to wait for. If empty, the
+                current branch is used.
+            min_interval: Number of seconds between polls of an issue which has
+                just changed.
+            max_interval: Maximum number of seconds between polls of an issue.
+            timeout: Number of seconds to wait before giving up. Defaults to
+                None, in which case there is no limit.
+            rpc_server_args: A dictionary of arguments to be passed to
+                GetRpcServer when submitting. Defaults to None, in which case
+                approved branches are not submitted.
+            do_close: Boolean; Represents whether issues should be closed after
+                submitting. Defaults to True.
+            skip_presubmit: Boolean; whether to skip the presubmit checks when
+                submitting. Defaults to False.
+        """
+        self.__branches = []
+        for branch in branches or [utils.get_current_branch()]:
+            if branch not in self.__branches:
+                self.__branches.append(branch)
+        self.__min_interval = min_interval
+        self.__max_interval = max(min_interval, max_interval)
+        self.__timeout = timeout
+        self.__rpc_server_args = rpc_server_args
+        self.__do_close = do_close
+        self.__skip_presubmit = skip_presubmit
+        self.__rietveld_infos = {}
+
+        self.state = self.CHECK_BRANCHES
+        self.advance()
+
+    @classmethod
+    def callback(cls, args, unused_argv):
+        """A callback to begin a WaitAction after arguments are parsed.
+
+        Args:
+            args: An argparse.Namespace object to extract parameters from.
+            unused_argv: The original command line arguments that were parsed
+                to create args. These are unused.
+
+        Returns:
+            An instance of WaitAction. Just by instantiating the instance, the
+                state machine will begin working.
+        """
+        rpc_server_args = None
+        if args.submit:
+            rpc_server_args = submit.get_rpc_server_args(args)
+        return cls(args.branches, args.min_interval, args.max_interval,
+                   timeout=args.timeout, rpc_server_args=rpc_server_args,
+                   do_close=args.do_close, skip_presubmit=args.skip_presubmit)
+
+    def check_branches(self):
+        """Checks that every branch is in review.
+
+        If they all are, sets state to WAIT_FOR_APPROVALS, otherwise notifies
+        the user and sets state to FINISHED. In either case, advances the
+        state machine.
+        """
+        self.state = self.WAIT_FOR_APPROVALS
+        for branch in self.__branches:
+            rietveld_info = utils.RietveldInfo.from_branch(branch_name=branch)
+            if (rietveld_info is None or rietveld_info.server is None or
+                rietveld_info.review_info is None):
+                print 'No review data found in branch %r.' % (branch,)
+                self.state = self.FINISHED
+                break
+            self.__rietveld_infos[branch] = rietveld_info
+
+        self.advance()
+
+    def __poll(self, branch, delay):
+        """Gets the current metadata for the issue of a branch.
+
+        If the issue cache was refreshed in the last half delay (for example
+        by "git rv daemon"), the cached value is used. Otherwise it is
+        revalidated with the server, which only transfers the messages if the
+        issue has been modified.
+
+        Args:
+            branch: String; the name of the branch.
+            delay: Number of seconds since the issue was last polled.
+
+        Returns:
+            Parsed dictionary from the JSON payload for the issue.
+        """
+        rietveld_info = self.__rietveld_infos[branch]
+        issue = rietveld_info.review_info.issue
+        entry = utils.read_cached_issue_metadata(
+                issue, rietveld_info.server, max_age=delay / 2.0)
+        if entry is not None:
+            return entry[utils.METADATA]
+        return utils.fetch_issue_metadata(issue, server=rietveld_info.server)
+
+    def __submit(self, branch):
+        """Submits an approved branch.
+
+        The current branch is submitted by a SubmitAction. Any other branch is
+        submitted by a SubmitQueueAction, since that doesn't need the branch
+        to be checked out. Either will find the approval in the issue cache.
+
+        Args:
+            branch: String; the name of the branch.
+        """
+        # Both actions add the server to the arguments they are given.
+        rpc_server_args = dict(self.__rpc_server_args)
+        if branch == utils.get_current_branch():
+            submit.SubmitAction(rpc_server_args=rpc_server_args,
+                                do_close=self.__do_close,
+                                skip_presubmit=self.__skip_presubmit)
+        else:
+            submit.SubmitQueueAction([branch], rpc_server_args=rpc_server_args,
+                                     do_close=self.__do_close,
+                                     skip_presubmit=self.__skip_presubmit)
+
+    def wait_for_approvals(self):
+        """Polls the issues of all branches until they are approved.
+
+        A branch stops being polled once its review is approved or its issue
+        is closed. Approved branches are submitted right away if requested. If
+        a submit fails, the error is reported and the other branches are still
+        waited for.
+
+        If successful, sets state to FINISHED and advances the state machine.
+        """
+        start_time = time.time()
+        schedule = [(start_time, branch) for branch in self.__branches]
+        heapq.heapify(schedule)
+        delays = dict((branch, self.__min_interval)
+                      for branch in self.__branches)
+        last_modified = {}
+
+        for branch in self.__branches:
+            print 'Waiting for approval of branch %r (issue %d).' % (
+                    branch, self.__rietveld_infos[branch].review_info.issue)
+
+        while schedule:
+            due_time, branch = heapq.heappop(schedule)
+            if (self.__timeout is not None and
+                due_time > start_time + self.__timeout):
+                heapq.heappush(schedule, (due_time, branch))
+                waiting = sorted(branch for _, branch in schedule)
+                print 'Timed out waiting for approval of %s.' % (
+                        ', '.join(repr(branch) for branch in waiting),)
+                break
+            time.sleep(max(due_time - time.time(), 0))
+
+            delay = delays[branch]
+            try:
+                issue_metadata = self.__poll(branch, delay)
+            except utils.RietveldRequestError, exc:
+                if exc.status not in daemon.RATE_LIMIT_STATUSES:
+                    print 'Checking branch %r failed: %s' % (branch, exc)
+                if exc.retry_after is not None:
+                    delay = exc.retry_after
+                else:
+                    delay = min(2 * delay, self.__max_interval)
+            except (IOError, utils.GitRvException), exc:
+                print 'Checking branch %r failed: %s' % (branch, exc)
+                delay = min(2 * delay, self.__max_interval)
+            else:
+                if utils.issue_approved(issue_metadata):
+                    print 'The review for branch %r has been approved.' % (
+                            branch,)
+                    # The branch may have been exported, synced or submitted
+                    # while waiting, so its metadata is read again.
+                    rietveld_info = utils.RietveldInfo.from_branch(
+                            branch_name=branch)
+                    if (rietveld_info is None or
+                        rietveld_info.review_info is None):
+                        print 'Branch %r is no longer in review.' % (branch,)
+                        continue
+                    self.__rietveld_infos[branch] = rietveld_info
+                    # The metadata was just cached, so this makes no request.
+                    utils.update_rietveld_metadata_from_issue(
+                            rietveld_info=rietveld_info)
+                    if self.__rpc_server_args is not None:
+                        try:
+                            self.__submit(branch)
+                        except (IOError, utils.GitRvException), exc:
+                            print 'Submitting branch %r failed: %s' % (branch,
+                                                                       exc)
+                    continue
+                elif issue_metadata.get(utils.CLOSED):
+                    print 'The issue for branch %r has been closed.' % (branch,)
+                    continue
+
+                modified = issue_metadata.get(utils.MODIFIED)
+                if branch in last_modified:
+                    if last_modified[branch] != modified:
+                        # Someone is active in the review, so a reply may
+                        # follow soon.
+                        delay = self.__min_interval
+                    else:
+                        delay = min(2 * delay, self.__max_interval)
+                last_modified[branch] = modified
+
+            delays[branch] = delay
+            next_time = time.time() + delay * random.uniform(
+                    1 - daemon.JITTER, 1 + daemon.JITTER)
+            heapq.heappush(schedule, (next_time, branch))
+
+        self.state = self.FINISHED
+        self.advance()
+
+    def advance(self, *args, **kwargs):
+        """Advances by calling the method corresponding to the current state.
+
+        Args:
+            *args: Arguments to be passed to the specified method based on
+                the current state.
+            **kwargs: Keyword arguments to be passed to the specified method
+                based on the current state.
+
+        Raises:
+            GitRvException: If this method is called and the state is not one
+                of the valid states.
+        """
+        if self.state == self.CHECK_BRANCHES:
+            self.check_branches(*args, **kwargs)
+        elif self.state == self.WAIT_FOR_APPROVALS:
+            self.wait_for_approvals(*args, **kwargs)
+        elif self.state == self.FINISHED:
+            return
+        else:
+            raise utils.GitRvException('Unexpected state %r in WaitAction.' %
+                                       (self.state,))